@@ -0,0 +1,244 @@
+"""
+Keep repeat customer metrics up to date as new orders come in
+"""
+
+from collections import Counter
+from datetime import datetime
+import statistics
+from analyze_data import MIN_STATE_CUSTOMERS
+from money import mean_of_sums
+
+
+class OrderAggregator:
+    """
+    Running tallies behind the analyze_data metrics, updated one order at a
+    time.
+
+    Each order is added in constant time. When a customer places their second
+    order, their first order is moved from the single-order tallies to the
+    repeat tallies.
+
+    Attributes:
+        num_orders: Int with how many orders have been added
+        single_by_month: List with the number of orders placed in each month
+        by customers with one order
+        multiple_by_month: List with the number of orders placed in each
+        month by customers with more than one order
+    """
+
+    def __init__(self):
+        self.num_orders = 0
+        self.single_by_month = [0] * 12
+        self.multiple_by_month = [0] * 12
+        # buyer id -> [number of orders, first (currency, divisor), first
+        # amount, first month index]
+        self._customers = {}
+        self._customers_by_num_orders = Counter()
+        # (currency, divisor) -> sum of amounts and currency -> number of
+        # orders, for orders of each class of customer
+        self._single_amount = Counter()
+        self._multiple_amount = Counter()
+        self._single_count = Counter()
+        self._multiple_count = Counter()
+        # (state, buyer id) -> number of orders
+        self._orders_by_state_customer = Counter()
+        self._customers_by_state = Counter()
+        self._repeat_customers_by_state = Counter()
+
+    def add(self, order):
+        """
+        Adds one order to the tallies
+
+        Args:
+            order: Dict in the format saved by clean_anonymize
+        """
+        buyer_user_id = order["buyer_user_id"]
+        amount = order["subtotal"]["amount"]
+        currency = order["subtotal"].get("currency_code", "")
+        key = (currency, order["subtotal"]["divisor"])
+        month = datetime.fromtimestamp(order["create_timestamp"]).month - 1
+
+        self.num_orders += 1
+
+        customer = self._customers.get(buyer_user_id)
+        if customer is None:
+            self._customers[buyer_user_id] = [1, key, amount, month]
+            self._customers_by_num_orders[1] += 1
+            self._single_amount[key] += amount
+            self._single_count[currency] += 1
+            self.single_by_month[month] += 1
+        else:
+            num_orders = customer[0]
+            customer[0] += 1
+            self._customers_by_num_orders[num_orders] -= 1
+            self._customers_by_num_orders[num_orders + 1] += 1
+            if num_orders == 1:
+                # Move the first order over to the repeat customer tallies.
+                _, first_key, first_amount, first_month = customer
+                self._single_amount[first_key] -= first_amount
+                self._multiple_amount[first_key] += first_amount
+                self._single_count[first_key[0]] -= 1
+                self._multiple_count[first_key[0]] += 1
+                self.single_by_month[first_month] -= 1
+                self.multiple_by_month[first_month] += 1
+            self._multiple_amount[key] += amount
+            self._multiple_count[currency] += 1
+            self.multiple_by_month[month] += 1
+
+        state_customer = (order["state"], buyer_user_id)
+        self._orders_by_state_customer[state_customer] += 1
+        orders_in_state = self._orders_by_state_customer[state_customer]
+        if orders_in_state == 1:
+            self._customers_by_state[order["state"]] += 1
+        elif orders_in_state == 2:
+            self._repeat_customers_by_state[order["state"]] += 1
+
+    def add_many(self, orders):
+        """
+        Adds a batch of orders to the tallies
+
+        Args:
+            orders: Iterable of dicts in the format saved by clean_anonymize
+        """
+        for order in orders:
+            self.add(order)
+
+    @property
+    def num_customers(self):
+        """
+        Int with how many different customers placed orders
+        """
+        return len(self._customers)
+
+    def reorder_rate(self):
+        """
+        Calculates the share of customers that placed more than one order
+
+        Returns:
+            Float between 0 and 1, or 0 if there are no orders
+        """
+        if not self._customers:
+            return 0.0
+        single = self._customers_by_num_orders[1]
+        return (len(self._customers) - single) / len(self._customers)
+
+    def orders_per_customer(self):
+        """
+        Tallies customers by their number of orders, like
+        calculate_orders_per_customer
+
+        Returns:
+            num_reorders (list): The number of orders placed by customers, in
+            increasing order
+            num_customers (list): The number of customers placing a certain
+            number of orders
+        """
+        tally = +self._customers_by_num_orders
+        num_reorders = sorted(tally)
+        return num_reorders, [tally[count] for count in num_reorders]
+
+    def avg_order_size(self, currency=None):
+        """
+        Calculates the average order value for single-order and
+        multiple-order customers, like calculate_avg_order_size
+
+        Args:
+            currency: Optional currency code of the orders to average, such as
+            "USD". Needed when the orders are in more than one currency.
+
+        Returns:
+            single_order_value (float): The average value of non-repeat orders
+            multiple_order_value (float): The average value of repeat orders
+
+        Raises:
+            ValueError: If the orders are in more than one currency and no
+            currency is given
+        """
+        if currency is None:
+            currencies = sorted(+(self._single_count + self._multiple_count))
+            if len(currencies) > 1:
+                raise ValueError(
+                    "The orders are in more than one currency ("
+                    + ", ".join(currencies)
+                    + "). Pass a currency."
+                )
+            currency = currencies[0] if currencies else ""
+        return (
+            _mean(self._single_amount, self._single_count[currency], currency),
+            _mean(
+                self._multiple_amount, self._multiple_count[currency], currency
+            ),
+        )
+
+    def order_dates(self):
+        """
+        Copies the monthly order tallies, like find_order_dates
+
+        Returns:
+            single_by_month (list): A tally of the number of orders happening
+            in a given month for non-repeat customers.
+            multiple_by_month (list): A tally of the number of orders
+            happening in a given month for repeat customers.
+        """
+        return list(self.single_by_month), list(self.multiple_by_month)
+
+    def reorder_rate_by_state(self, min_customers=MIN_STATE_CUSTOMERS):
+        """
+        Calculates the percentage of customers that place more than one order
+        by US state, like calculate_reorder_rate_by_state
+
+        Args:
+            min_customers: Int, states with this many customers or fewer are
+            left out
+
+        Returns:
+            state_reorder_df (df): A DataFrame mapping the reorder percentages
+            to the state name
+        """
+        import pandas as pd  # pylint: disable=import-outside-toplevel
+
+        states = [
+            state
+            for state, num_customers in self._customers_by_state.items()
+            if num_customers > min_customers
+        ]
+        state_reorder_df = pd.DataFrame(
+            {
+                "state": pd.Series(states, dtype=object),
+                "reorder_rate": [
+                    self._repeat_customers_by_state[state]
+                    / self._customers_by_state[state]
+                    for state in states
+                ],
+            }
+        )
+        state_reorder_df["reorder_rate"] = (
+            state_reorder_df["reorder_rate"] * 100
+        )
+        return state_reorder_df
+
+
+def _mean(amount_by_key, count, currency):
+    """
+    Averages amounts in one currency kept as integer sums per divisor,
+    dividing only once
+
+    Args:
+        amount_by_key: Counter mapping (currency, divisor) pairs to sums of
+        amounts
+        count: Int with the number of amounts in currency summed
+        currency: String currency code of the amounts to average
+
+    Returns:
+        Float average in whole currency units
+    """
+    if count == 0:
+        raise statistics.StatisticsError(
+            "mean requires at least one data point"
+        )
+    divisors = [key[1] for key in amount_by_key if key[0] == currency]
+    return mean_of_sums(
+        divisors,
+        [amount_by_key[currency, divisor] for divisor in divisors],
+        count,
+    )
@@ -2,126 +2,161 @@
 Analyze repeat customer order data from an Etsy shop
 """
 
-from collections import Counter
-from datetime import datetime
+import argparse
+import json
+import os
 import statistics
-import pandas as pd
-from api_lib import extract_data
+import numpy as np
+from api_lib import save_to_json
+from metrics import JsonLinesSink, PrometheusSink, instrument, set_sink
+from money import divide, mean_of_sums, sum_by_group
+from order_table import (
+    SECONDS_PER_DAY,
+    CustomerTimeline,
+    OrderTable,
+    as_order_table,
+    factorize,
+    load_order_table,
+    local_months,
+    local_seconds,
+    read_order_table,
+)
 
 KEY_PATH = "keys.json"
 ORDERS_PATH = "orders.json"
 SHOP_ID = 23574688
+# States need more than this many customers for a reorder rate to be listed
+MIN_STATE_CUSTOMERS = 20
 
 
-def calculate_orders_per_customer(orders):
+@instrument
+def calculate_orders_per_customer(orders, start=None, end=None, outliers=None):
     """
-    Calculates the distribution of orders per customer, excluding a specific
-    outlier.
+    Calculates the distribution of orders per customer.
 
     Args:
-        orders (list): A list of all order data
+        orders (iterable or OrderTable): All order data, such as a list of
+        order dicts or the output of iter_orders
+        start (int): Optional unix timestamp, orders created before it are
+        left out
+        end (int): Optional unix timestamp, orders created at or after it are
+        left out
+        outliers (OutlierFilter or list): Optional rules, or buyer ids, of the
+        customers whose orders are left out
 
     Returns:
+        buyer_user_id (list or array): The ids of customers that placed each
+        order, as an array if orders is an OrderTable
         num_reorders (list): The number of orders placed by customers
         num_customers (list): The number of customers placing a certain number
         of orders
     """
-    buyer_user_id = extract_data(orders, "buyer_user_id")
-
-    num_orders_by_customers = list(Counter(buyer_user_id).values())
-
-    if 37 in num_orders_by_customers:
-        num_orders_by_customers.remove(37)
+    table = as_order_table(
+        orders, "buyer_user_id", start=start, end=end, outliers=outliers
+    )
 
-    orders_per_customer = Counter(num_orders_by_customers)
+    buyer_codes, _ = factorize(table.buyer_user_id)
+    num_reorders, num_customers = orders_per_customer(np.bincount(buyer_codes))
 
-    num_reorders = orders_per_customer.keys()
-    num_customers = orders_per_customer.values()
+    buyer_user_id = table.buyer_user_id
+    if not isinstance(orders, OrderTable):
+        buyer_user_id = buyer_user_id.tolist()
 
     return buyer_user_id, num_reorders, num_customers
 
 
-def calculate_avg_order_size(buyer_user_id, orders):
+@instrument
+def calculate_avg_order_size(
+    buyer_user_id, orders, start=None, end=None, outliers=None, currency=None
+):
     """
     Calculate the average order value for single-order and multiple-order
     customers.
 
     Args:
-        buyer_user_id (list): A list of all ids of customers that placed orders
-        orders (list): A list of all order data
+        buyer_user_id (list): A list of all ids of customers that placed orders,
+        in the time window and without outliers if they are given
+        orders (iterable or OrderTable): All order data, such as a list of
+        order dicts or the output of iter_orders
+        start (int): Optional unix timestamp, orders created before it are
+        left out
+        end (int): Optional unix timestamp, orders created at or after it are
+        left out
+        outliers (OutlierFilter or list): Optional rules, or buyer ids, of the
+        customers whose orders are left out
+        currency (str): Currency code of the orders to average, such as
+        "USD". Needed when the orders are in more than one currency.
 
     Returns:
         single_order_value (float): The average value of non-repeat orders
         multiple_order_value (float): The average value of repeat orders
-    """
-    id_subtotal_dict = extract_data(orders, "buyer_user_id", "subtotal")
-    num_orders_by_id = Counter(buyer_user_id)
 
-    id_subtotal = []
-    for customer in id_subtotal_dict:
-        id_subtotal.append(
-            [customer[0], customer[1]["amount"] / customer[1]["divisor"]]
-        )
-
-    single_order_customers = []
-    multiple_order_customers = []
-
-    for customer in id_subtotal:
-        if num_orders_by_id[customer[0]] > 1:
-            multiple_order_customers.append(customer[1])
-        else:
-            single_order_customers.append(customer[1])
+    Raises:
+        ValueError: If the orders are in more than one currency and no
+        currency is given
+    """
+    table = as_order_table(
+        orders,
+        "buyer_user_id",
+        "subtotal",
+        start=start,
+        end=end,
+        outliers=outliers,
+    )
 
-    single_order_value = statistics.mean(single_order_customers)
-    multiple_order_value = statistics.mean(multiple_order_customers)
+    is_repeat = _is_repeat_order(table.buyer_user_id, buyer_user_id)
 
-    return single_order_value, multiple_order_value
+    return _avg_order_size(table, is_repeat, currency)
 
 
-def calculate_time_between_orders(buyer_user_id, orders):
+@instrument
+def calculate_time_between_orders(
+    buyer_user_id, orders, start=None, end=None, outliers=None
+):
     """
     Calculate the time delta in years between orders for repeat customers.
 
     Args:
-        buyer_user_id (list): A list of all ids of customers that placed orders
-        orders (list): A list of all order data
+        buyer_user_id (list): A list of all ids of customers that placed orders,
+        in the time window and without outliers if they are given
+        orders (iterable or OrderTable): All order data, such as a list of
+        order dicts or the output of iter_orders
+        start (int): Optional unix timestamp, orders created before it are
+        left out
+        end (int): Optional unix timestamp, orders created at or after it are
+        left out
+        outliers (OutlierFilter or list): Optional rules, or buyer ids, of the
+        customers whose orders are left out
 
     Returns:
-        years (list): A list of time deltas between orders
+        years (list or array): A list of time deltas between orders
+        orders_by_customer (dict or CustomerTimeline): The order times of
+        each customer, sorted. If orders is an OrderTable, years is an array
+        and the order times are kept as a CustomerTimeline of timestamps
+        instead of a dict of datetimes.
     """
-    order_time = extract_data(orders, "create_timestamp")
-
-    for i, timestamp in enumerate(order_time):
-        order_time[i] = datetime.fromtimestamp(timestamp)
-
-    orders_by_customer = {}
-
-    for customer_id, order_time in zip(buyer_user_id, order_time):
-        if customer_id not in orders_by_customer:
-            orders_by_customer[customer_id] = []
-        orders_by_customer[customer_id].append(order_time)
-
-    all_time_diffs = []
-
-    for times in orders_by_customer.values():
-        times.sort()
-        if len(times) > 1:
-            all_time_diffs.extend(
-                [times[i] - times[i - 1] for i in range(1, len(times))]
-            )
+    table = as_order_table(
+        orders, "create_timestamp", start=start, end=end, outliers=outliers
+    )
+    buyer_codes, customers = factorize(np.asarray(buyer_user_id))
 
-    years = [t.days / 365.25 for t in all_time_diffs]
+    years, timeline = time_between_orders(
+        buyer_codes, customers, table.create_timestamp
+    )
 
-    return years, orders_by_customer
+    if isinstance(orders, OrderTable):
+        return years, timeline
+    return years.tolist(), timeline.to_dict()
 
 
+@instrument
 def find_order_dates(orders_by_customer):
     """
     Counts the number of orders that occur in any given month.
 
     Args:
-        orders_by_customer (dict): A dictionary linking customer ids to their
-        order times
+        orders_by_customer (dict or CustomerTimeline): A dictionary linking
+        customer ids to their order times
 
     Returns:
         single_by_month (list): A tally of the number of orders happening in a
@@ -130,6 +165,15 @@ def find_order_dates(orders_by_customer):
         a given month for repeat customers.
 
     """
+    if isinstance(orders_by_customer, CustomerTimeline):
+        month = local_months(orders_by_customer.create_timestamp) % 12
+        num_orders = orders_by_customer.num_orders
+        is_repeat = np.repeat(num_orders > 1, num_orders)
+        return (
+            np.bincount(month[~is_repeat], minlength=12).tolist(),
+            np.bincount(month[is_repeat], minlength=12).tolist(),
+        )
+
     mult_cust_times = {}
     single_cust_times = {}
 
@@ -153,75 +197,753 @@ def find_order_dates(orders_by_customer):
     return single_by_month, multiple_by_month
 
 
-def count_orders_by_state(orders):
+@instrument
+def calculate_cohort_retention(orders, start=None, end=None, outliers=None):
+    """
+    Calculates monthly retention of customers grouped by their first month.
+
+    Orders are sorted once by customer and time, then every customer's first
+    order in each month after their first month is tallied for their cohort.
+
+    Args:
+        orders (iterable or OrderTable): All order data, such as a list of
+        order dicts or the output of iter_orders
+        start (int): Optional unix timestamp, orders created before it are
+        left out
+        end (int): Optional unix timestamp, orders created at or after it are
+        left out
+        outliers (OutlierFilter or list): Optional rules, or buyer ids, of the
+        customers whose orders are left out
+
+    Returns:
+        cohorts (array): The local month of each cohort as datetime64[M],
+        every month from the first order to the last
+        retention (array): 2-D float array where row i, column k is the share
+        of customers with their first order in cohorts[i] who ordered again
+        k months later. Column 0 is 1. Cells for months after the last order
+        and rows of months without new customers are NaN.
+    """
+    table = as_order_table(
+        orders,
+        "buyer_user_id",
+        "create_timestamp",
+        start=start,
+        end=end,
+        outliers=outliers,
+    )
+    if len(table) == 0:
+        return np.zeros(0, dtype="datetime64[M]"), np.zeros((0, 0))
+
+    order = np.lexsort((table.create_timestamp, table.buyer_user_id))
+    buyers = table.buyer_user_id[order]
+    month = local_months(table.create_timestamp[order])
+
+    new_customer = np.ones(len(buyers), dtype=bool)
+    new_customer[1:] = buyers[1:] != buyers[:-1]
+    first_month = month[new_customer][np.cumsum(new_customer) - 1]
+    offset = month - first_month
+
+    # Offsets only grow within a customer, so a customer's first order in a
+    # month is where the offset changes.
+    is_active = new_customer.copy()
+    is_active[1:] |= offset[1:] != offset[:-1]
+
+    start = int(month.min())
+    num_months = int(month.max()) - start + 1
+    active = np.bincount(
+        (first_month[is_active] - start) * num_months + offset[is_active],
+        minlength=num_months * num_months,
+    ).reshape(num_months, num_months)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        retention = active / active[:, :1]
+    months_left = np.arange(num_months)[::-1]
+    retention[np.arange(num_months) > months_left[:, None]] = np.nan
+
+    cohorts = np.arange(start, start + num_months).astype("datetime64[M]")
+
+    return cohorts, retention
+
+
+@instrument
+def calculate_rolling_metrics(
+    orders, window_days=90, step_days=7, outliers=None, currency=None
+):
+    """
+    Calculates the reorder rate and average order values over a sliding
+    window of time.
+
+    Windows end every step_days days, counting back from just after the last
+    order, and each covers the window_days days before its end. Only orders
+    in the window count, so a customer is a repeat customer in a window if
+    they placed more than one order in it.
+
+    Args:
+        orders (iterable or OrderTable): All order data, such as a list of
+        order dicts or the output of iter_orders
+        window_days (int): The length of each window in days
+        step_days (int): The number of days between window ends
+        outliers (OutlierFilter or list): Optional rules, or buyer ids, of the
+        customers whose orders are left out, found once over all the orders
+        currency (str): Currency code of the orders to average, as in
+        calculate_avg_order_size
+
+    Returns:
+        rolling_df (df): A DataFrame with a row for each window, oldest
+        first, of the window_end as a UTC datetime, the reorder_rate as a
+        percentage of customers, and the single_order_value and
+        multiple_order_value, which are NaN when no order of that kind was
+        placed in the window
+    """
+    table = as_order_table(
+        orders,
+        "buyer_user_id",
+        "subtotal",
+        "create_timestamp",
+        outliers=outliers,
+    )
+    window = int(window_days * SECONDS_PER_DAY)
+    step = int(step_days * SECONDS_PER_DAY)
+    in_currency = currency_mask(table, currency)
+
+    ends = np.zeros(0, dtype=np.int64)
+    if len(table) > 0:
+        first = int(table.create_timestamp.min())
+        last = int(table.create_timestamp.max()) + 1
+        ends = np.arange(last, first, -step, dtype=np.int64)[::-1]
+
+    columns = {
+        "window_end": ends.astype("datetime64[s]"),
+        "reorder_rate": np.full(len(ends), np.nan),
+        "single_order_value": np.full(len(ends), np.nan),
+        "multiple_order_value": np.full(len(ends), np.nan),
+    }
+    for row, end in enumerate(ends):
+        window_table = table.window(end - window, end)
+        buyer_codes, _ = factorize(window_table.buyer_user_id)
+        order_counts = np.bincount(buyer_codes)
+        is_repeat = order_counts[buyer_codes] > 1
+        if len(order_counts) == 0:
+            continue
+
+        columns["reorder_rate"][row] = (
+            np.count_nonzero(order_counts > 1) / len(order_counts) * 100
+        )
+        amount, divisor = window_table.amount, window_table.divisor
+        if in_currency is not None:
+            kept = in_currency[table.time_index.positions(end - window, end)]
+            amount, divisor, is_repeat = (
+                amount[kept],
+                divisor[kept],
+                is_repeat[kept],
+            )
+        if not is_repeat.all():
+            columns["single_order_value"][row] = mean_subtotal(
+                amount[~is_repeat], divisor[~is_repeat]
+            )
+        if is_repeat.any():
+            columns["multiple_order_value"][row] = mean_subtotal(
+                amount[is_repeat], divisor[is_repeat]
+            )
+
+    return data_frame(columns)
+
+
+@instrument
+def count_orders_by_state(orders, start=None, end=None, outliers=None):
     """
     Counts the number of orders shipped to each US state
 
     Args:
-        orders (list): A list of all order data
+        orders (iterable or OrderTable): All order data, such as a list of
+        order dicts or the output of iter_orders
+        start (int): Optional unix timestamp, orders created before it are
+        left out
+        end (int): Optional unix timestamp, orders created at or after it are
+        left out
+        outliers (OutlierFilter or list): Optional rules, or buyer ids, of the
+        customers whose orders are left out
 
     Returns:
         state_list (dict): A dictionary mapping the number of orders occurring
         in a state to the state name
 
     """
-    state = extract_data(orders, "state")
-
-    state_list = Counter(state)
-    state_list = pd.DataFrame.from_dict(
-        state_list, orient="index"
-    ).reset_index()
-    state_list = state_list.rename(
-        columns={"index": "state", 0: "number_of_orders"}
+    table = as_order_table(
+        orders, "state", start=start, end=end, outliers=outliers
     )
 
+    state_list = data_frame(_orders_by_state(table))
+
     return state_list
 
 
-def calculate_reorder_rate_by_state(orders):
+@instrument
+def calculate_reorder_rate_by_state(
+    orders, start=None, end=None, outliers=None
+):
     """
     Calculates the percentage of customer that place more than one order by
     US state.
 
     Args:
-        orders (list): A list of all order data
+        orders (iterable or OrderTable): All order data, such as a list of
+        order dicts or the output of iter_orders
+        start (int): Optional unix timestamp, orders created before it are
+        left out
+        end (int): Optional unix timestamp, orders created at or after it are
+        left out
+        outliers (OutlierFilter or list): Optional rules, or buyer ids, of the
+        customers whose orders are left out
 
     Returns:
         state_reorder_df (df): A DataFrame mapping the reorder percentages to
         the state name
 
     """
-    id_state = extract_data(orders, "buyer_user_id", "state")
-    state = extract_data(orders, "state")
-
-    all_states_list = list(Counter(state).keys())
-    states_dict = {key: [] for key in all_states_list}
-
-    for customer in id_state:
-        states_dict[customer[1]].append(customer[0])
-
-    percent_reorder_by_state = {}
-    for state, _ in states_dict.items():
-        num_orders = Counter(Counter(states_dict[state]).values())
-        one_order = 0
-        multiple_orders = 0
-        for number_of_orders, number_of_customers in num_orders.items():
-            if number_of_orders == 1:
-                one_order += number_of_customers
-            if number_of_orders > 1:
-                multiple_orders += number_of_customers
-        if one_order + multiple_orders > 20:
-            percent_reorder_by_state[state] = multiple_orders / (
-                one_order + multiple_orders
+    table = as_order_table(
+        orders,
+        "buyer_user_id",
+        "state",
+        start=start,
+        end=end,
+        outliers=outliers,
+    )
+    _, buyer_codes = np.unique(table.buyer_user_id, return_inverse=True)
+
+    return data_frame(_reorder_rate_by_state(table, buyer_codes.reshape(-1)))
+
+
+@instrument
+def calculate_order_value_by_group(
+    orders, by="customer_type", start=None, end=None, outliers=None
+):
+    """
+    Totals and averages order subtotals in each group, per currency.
+
+    Subtotals are summed as integer minor units, such as cents, and divided
+    once per group, so the totals are exact and orders in different
+    currencies are never added together.
+
+    Args:
+        orders (iterable or OrderTable): All order data, such as a list of
+        order dicts or the output of iter_orders
+        by (str): How to group orders: "customer_type" for single-order and
+        multiple-order customers, "state", or "month" for local calendar
+        months
+        start (int): Optional unix timestamp, orders created before it are
+        left out
+        end (int): Optional unix timestamp, orders created at or after it are
+        left out
+        outliers (OutlierFilter or list): Optional rules, or buyer ids, of the
+        customers whose orders are left out
+
+    Returns:
+        order_value_df (df): A DataFrame with a row for each group and
+        currency with orders, of the group named by, the currency_code, the
+        number_of_orders, the amount and divisor of the total subtotal like
+        the subtotals of orders, the total in whole currency units, and the
+        mean subtotal
+
+    Raises:
+        ValueError: If by isn't one of the groupings
+    """
+    columns = {
+        "customer_type": ("buyer_user_id", "subtotal"),
+        "state": ("state", "subtotal"),
+        "month": ("subtotal", "create_timestamp"),
+    }
+    if by not in columns:
+        raise ValueError(
+            f"Can't group orders by {by!r}, only by " + ", ".join(columns)
+        )
+    table = as_order_table(
+        orders, *columns[by], start=start, end=end, outliers=outliers
+    )
+
+    if by == "customer_type":
+        buyer_codes, _ = factorize(table.buyer_user_id)
+        group_codes = (np.bincount(buyer_codes)[buyer_codes] > 1).astype(
+            np.int64
+        )
+        groups = np.array(["single", "multiple"], dtype=object)
+    elif by == "state":
+        group_codes, groups = table.state_codes, table.states
+    else:
+        months = local_months(table.create_timestamp)
+        first_month = int(months.min()) if len(months) > 0 else 0
+        group_codes = months - first_month
+        groups = (
+            np.arange(
+                first_month, first_month + group_codes.max(initial=-1) + 1
+            )
+            .astype("datetime64[M]")
+            .astype(str)
+            .astype(object)
+        )
+
+    currency_codes = table.currency_codes
+    currencies = table.currencies
+    if currency_codes is None:
+        currency_codes = np.zeros(len(table), dtype=np.int32)
+        currencies = np.array([""], dtype=object)
+
+    num_currencies = len(currencies)
+    sums, counts, common = sum_by_group(
+        table.amount,
+        table.divisor,
+        group_codes.astype(np.int64) * num_currencies + currency_codes,
+        len(groups) * num_currencies,
+    )
+    has_orders = np.flatnonzero(counts > 0)
+
+    return data_frame(
+        {
+            by: groups[has_orders // num_currencies],
+            "currency_code": currencies[has_orders % num_currencies],
+            "number_of_orders": counts[has_orders],
+            "amount": sums[has_orders],
+            "divisor": np.full(len(has_orders), common, dtype=sums.dtype),
+            "total": divide(sums[has_orders], common),
+            "mean": divide(sums[has_orders], counts[has_orders] * common),
+        }
+    )
+
+
+@instrument
+def analyze_all(
+    orders, frames=True, start=None, end=None, outliers=None, currency=None
+):
+    """
+    Calculates every metric of this module with one pass over the orders.
+
+    The orders are loaded once, customers are encoded once, and the order
+    count and sorted order times of each customer are shared by all metrics.
+    The results are the same as calling each function on its own.
+
+    Args:
+        orders (iterable or OrderTable): All order data, such as a list of
+        order dicts or the output of iter_orders
+        frames (bool): If False, state_list and state_reorder_df are dicts
+        mapping column names to lists instead of DataFrames, and pandas is
+        never imported
+        start (int): Optional unix timestamp, orders created before it are
+        left out
+        end (int): Optional unix timestamp, orders created at or after it are
+        left out
+        outliers (OutlierFilter or list): Optional rules, or buyer ids, of the
+        customers whose orders are left out
+        currency (str): Currency code of the orders to average, as in
+        calculate_avg_order_size
+
+    Returns:
+        results (dict): The results of each function, keyed by the names
+        used for them in the essay: buyer_user_id, num_reorders,
+        num_customers, single_order_value, multiple_order_value, years,
+        orders_by_customer, single_by_month, multiple_by_month, state_list
+        and state_reorder_df
+    """
+    table = as_order_table(orders, start=start, end=end, outliers=outliers)
+
+    buyer_codes, customers = factorize(table.buyer_user_id)
+    order_counts = np.bincount(buyer_codes)
+    is_repeat = order_counts[buyer_codes] > 1
+
+    results = {}
+
+    results["buyer_user_id"] = table.buyer_user_id
+    if not isinstance(orders, OrderTable):
+        results["buyer_user_id"] = table.buyer_user_id.tolist()
+
+    results["num_reorders"], results["num_customers"] = orders_per_customer(
+        order_counts
+    )
+    (
+        results["single_order_value"],
+        results["multiple_order_value"],
+    ) = _avg_order_size(table, is_repeat, currency)
+    years, timeline = time_between_orders(
+        buyer_codes, customers, table.create_timestamp
+    )
+    (
+        results["single_by_month"],
+        results["multiple_by_month"],
+    ) = find_order_dates(timeline)
+    if isinstance(orders, OrderTable):
+        results["years"], results["orders_by_customer"] = years, timeline
+    else:
+        results["years"] = years.tolist()
+        results["orders_by_customer"] = timeline.to_dict()
+    for name, columns in (
+        ("state_list", _orders_by_state(table)),
+        ("state_reorder_df", _reorder_rate_by_state(table, buyer_codes)),
+    ):
+        if frames:
+            results[name] = data_frame(columns)
+        else:
+            results[name] = {
+                column: values.tolist() for column, values in columns.items()
+            }
+
+    return results
+
+
+def orders_per_customer(order_counts):
+    """
+    Tallies how many customers placed each number of orders.
+
+    Args:
+        order_counts (array): The number of orders placed by each customer,
+        in the order customers first appear
+
+    Returns:
+        num_reorders (list): The number of orders placed by customers
+        num_customers (list): The number of customers placing a certain number
+        of orders
+    """
+    tallies = dict(zip(*_unique_by_first_appearance(order_counts)))
+
+    return tallies.keys(), tallies.values()
+
+
+def time_between_orders(buyer_codes, customers, timestamps):
+    """
+    Sorts the order times of each customer and finds the gaps between them.
+
+    Gaps are measured in whole local days, like the days of a timedelta
+    between datetime.fromtimestamp values, using integer arrays only.
+
+    Args:
+        buyer_codes (array): The code of the customer that placed each order,
+        numbered in the order customers first appear
+        customers (array): The id of the customer with each code
+        timestamps (array): The unix timestamp of each order
+
+    Returns:
+        years (array): The time deltas between orders in years
+        timeline (CustomerTimeline): The sorted order times of each customer
+    """
+    timeline = CustomerTimeline.from_codes(buyer_codes, customers, timestamps)
+    local_time = local_seconds(timeline.create_timestamp)
+
+    same_customer = np.ones(len(local_time), dtype=bool)
+    same_customer[timeline.starts[:-1]] = False
+
+    gap_days = np.diff(local_time) // SECONDS_PER_DAY
+    years = gap_days[same_customer[1:]] / 365.25
+
+    return years, timeline
+
+
+def reorder_rate_columns(states, num_customers, multiple_orders):
+    """
+    Calculates the reorder rate columns from per-state customer tallies.
+
+    Args:
+        states (array): The name of each state
+        num_customers (array): The number of customers that ordered to each
+        state
+        multiple_orders (array): The number of customers with more than one
+        order to each state
+
+    Returns:
+        columns (dict): Arrays of the state name and reorder percentage of
+        each state with more than MIN_STATE_CUSTOMERS customers
+    """
+    enough_customers = num_customers > MIN_STATE_CUSTOMERS
+
+    return {
+        "state": states[enough_customers],
+        "reorder_rate": (
+            (
+                multiple_orders[enough_customers]
+                / num_customers[enough_customers]
             )
+            * 100
+        ),
+    }
+
+
+def data_frame(columns):
+    """
+    Builds a DataFrame, importing pandas only once one is needed.
+
+    Args:
+        columns (dict): Arrays of each column's values
+
+    Returns:
+        df (df): A DataFrame of the columns
+    """
+    import pandas as pd  # pylint: disable=import-outside-toplevel
+
+    return pd.DataFrame(columns)
+
+
+def mean_subtotal(amount, divisor):
+    """
+    Averages order subtotals exactly, without a float division per order.
+
+    Args:
+        amount (array): Integer subtotal amounts
+        divisor (array): Integer divisor of each amount
+
+    Returns:
+        mean (float): The average subtotal in whole currency units
+    """
+    divisors = np.unique(divisor)
+    sums = [amount[divisor == value].sum() for value in divisors]
+
+    return mean_of_subtotal_sums(divisors, sums, len(amount))
+
+
+def mean_of_subtotal_sums(divisors, sums, count):
+    """
+    Averages subtotals kept as integer sums per divisor, dividing only once.
+
+    Args:
+        divisors (array): Distinct integer divisors
+        sums (array): The sum of the amounts with each divisor
+        count (int): The number of amounts summed
+
+    Returns:
+        mean (float): The average subtotal in whole currency units
+    """
+    if count == 0:
+        raise statistics.StatisticsError(
+            "mean requires at least one data point"
+        )
+
+    return mean_of_sums(divisors, sums, count)
+
+
+def currency_mask(table, currency):
+    """
+    Selects the orders in one currency, so subtotals of different currencies
+    are never added together.
+
+    Args:
+        table (OrderTable): Order data with subtotals
+        currency (str): Currency code of the orders to select, or None
+
+    Returns:
+        in_currency (array): Boolean array that is True for every order in
+        currency, or None if every order counts
 
-    state_reorder_df = pd.DataFrame.from_dict(
-        percent_reorder_by_state, orient="index"
-    ).reset_index()
-    state_reorder_df = state_reorder_df.rename(
-        columns={"index": "state", 0: "reorder_rate"}
+    Raises:
+        ValueError: If currency is None and the orders are in more than one
+        currency, or if currency is given and the orders have no currency
+        codes
+    """
+    if table.currency_codes is None:
+        if currency is not None:
+            raise ValueError("The orders have no currency codes to select by")
+        return None
+
+    used = np.unique(table.currency_codes)
+    if currency is None:
+        if len(used) > 1:
+            raise mixed_currency_error(table.currencies[used])
+        return None
+
+    return np.isin(
+        table.currency_codes, np.flatnonzero(table.currencies == currency)
+    )
+
+
+def mixed_currency_error(currencies):
+    """
+    Makes the error for averaging subtotals in more than one currency.
+
+    Args:
+        currencies (iterable): The currency codes of the orders
+
+    Returns:
+        error (ValueError): Error naming the currencies
+    """
+    return ValueError(
+        "The orders are in more than one currency ("
+        + ", ".join(sorted(currencies))
+        + "). Pass a currency, or use calculate_order_value_by_group"
+        " for the values of each currency."
     )
 
-    state_reorder_df["reorder_rate"] = state_reorder_df["reorder_rate"] * 100
 
-    return state_reorder_df
+def main(argv=None):
+    """
+    Runs the full analysis on an orders file from the command line
+
+    Run `python -m analyze_data orders.json --output metrics.json` to save
+    every metric except the per-order and per-customer ones as JSON, or leave
+    out --output to print them. pandas is not imported. Pass --metrics to
+    also record the time and memory of each stage, as JSON lines or, for a
+    path ending in .prom, in Prometheus text format.
+
+    Args:
+        argv: Optional list of command line arguments, sys.argv by default
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument(
+        "orders_path",
+        nargs="?",
+        default=ORDERS_PATH,
+        help="JSON or JSON lines orders, or a directory of .npy columns",
+    )
+    parser.add_argument("--output", help="Path to save the metrics JSON to")
+    parser.add_argument(
+        "--metrics", help="Path to record the time of each stage to"
+    )
+    args = parser.parse_args(argv)
+
+    sink = None
+    if args.metrics is not None and args.metrics.endswith(".prom"):
+        sink = PrometheusSink(args.metrics)
+    elif args.metrics is not None:
+        sink = JsonLinesSink(args.metrics)
+
+    previous_sink = set_sink(sink)
+    try:
+        if os.path.isdir(args.orders_path):
+            table = load_order_table(args.orders_path)
+        else:
+            table = read_order_table(args.orders_path)
+        results = analyze_all(table, frames=False)
+    finally:
+        set_sink(previous_sink)
+
+    metrics = {
+        "num_reorders": list(results["num_reorders"]),
+        "num_customers": list(results["num_customers"]),
+        "single_order_value": results["single_order_value"],
+        "multiple_order_value": results["multiple_order_value"],
+        "years": results["years"].tolist(),
+        "single_by_month": results["single_by_month"],
+        "multiple_by_month": results["multiple_by_month"],
+        "state_list": results["state_list"],
+        "state_reorder_df": results["state_reorder_df"],
+    }
+    if args.output:
+        save_to_json(args.output, metrics)
+    else:
+        print(json.dumps(metrics, indent=4))
+
+
+def _avg_order_size(table, is_repeat, currency=None):
+    """
+    Averages the subtotals of single-order and multiple-order customers.
+
+    Args:
+        table (OrderTable): Order data with subtotals
+        is_repeat (array): Boolean array that is True for every order placed
+        by a repeat customer
+        currency (str): Optional currency code of the orders to average
+
+    Returns:
+        single_order_value (float): The average value of non-repeat orders
+        multiple_order_value (float): The average value of repeat orders
+    """
+    amount, divisor = table.amount, table.divisor
+    in_currency = currency_mask(table, currency)
+    if in_currency is not None:
+        amount, divisor, is_repeat = (
+            amount[in_currency],
+            divisor[in_currency],
+            is_repeat[in_currency],
+        )
+
+    single_order_value = mean_subtotal(amount[~is_repeat], divisor[~is_repeat])
+    multiple_order_value = mean_subtotal(amount[is_repeat], divisor[is_repeat])
+
+    return single_order_value, multiple_order_value
+
+
+def _reorder_rate_by_state(table, buyer_codes):
+    """
+    Calculates the percentage of customers in each state with more than one
+    order in that state.
+
+    Args:
+        table (OrderTable): Order data with states
+        buyer_codes (array): Non-negative integer code of the customer that
+        placed each order
+
+    Returns:
+        columns (dict): Arrays of the state name and reorder percentage of
+        each state with more than MIN_STATE_CUSTOMERS customers
+    """
+    num_states = len(table.states)
+
+    # Count orders for every (customer, state) pair, then tally the pairs
+    # with one order and with several orders for each state.
+    pairs, orders_per_pair = np.unique(
+        buyer_codes.astype(np.int64) * num_states + table.state_codes,
+        return_counts=True,
+    )
+    pair_state = pairs % num_states
+
+    num_customers = np.bincount(pair_state, minlength=num_states)
+    multiple_orders = np.bincount(
+        pair_state[orders_per_pair > 1], minlength=num_states
+    )
+
+    return reorder_rate_columns(table.states, num_customers, multiple_orders)
+
+
+def _orders_by_state(table):
+    """
+    Counts the orders shipped to each state.
+
+    Args:
+        table (OrderTable): Order data with states
+
+    Returns:
+        columns (dict): Arrays of the state name and number of orders of each
+        state with orders
+    """
+    number_of_orders = np.bincount(
+        table.state_codes, minlength=len(table.states)
+    )
+    has_orders = number_of_orders > 0
+
+    return {
+        "state": table.states[has_orders],
+        "number_of_orders": number_of_orders[has_orders],
+    }
+
+
+def _unique_by_first_appearance(values):
+    """
+    Tallies distinct values, like Counter(values).items()
+
+    Args:
+        values (array): Values to tally
+
+    Returns:
+        uniques (list): The distinct values in the order they first appear
+        counts (list): The number of occurrences of each distinct value
+    """
+    codes, uniques = factorize(values)
+    return uniques.tolist(), np.bincount(codes).tolist()
+
+
+def _is_repeat_order(order_buyer_ids, buyer_user_id):
+    """
+    Flags the orders placed by customers with more than one order.
+
+    Args:
+        order_buyer_ids (array): The id of the customer that placed each order
+        buyer_user_id (list): A list of all ids of customers that placed
+        orders, used to count the orders of each customer
+
+    Returns:
+        is_repeat (array): Boolean array that is True for every order placed
+        by a repeat customer
+    """
+    ids, counts = np.unique(np.asarray(buyer_user_id), return_counts=True)
+    if len(ids) == 0:
+        return np.zeros(len(order_buyer_ids), dtype=bool)
+    position = np.minimum(np.searchsorted(ids, order_buyer_ids), len(ids) - 1)
+    return (ids[position] == order_buyer_ids) & (counts[position] > 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,10 +2,36 @@
 Library to handle accessing Etsy API to pull order data and store keys
 """
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from itertools import chain, count
 import json
-import requests
+import os
+import random
+import re
+import threading
+import time
+from id_map import IdMap
+import metrics
+from metrics import instrument
 
+API_URL = "https://openapi.etsy.com/v3/application"
+TOKEN_URL = "https://api.etsy.com/v3/public/oauth/token"
 
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+# Characters that can continue a number decoded at the end of a chunk
+_NUMBER_CHARS = frozenset("0123456789.eE+-")
+
+# Responses worth trying again after waiting
+RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+
+# EtsyClients shared by get_orders calls, by absolute key path
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+@instrument
 def save_to_json(file_path, data):
     """
     Saves data to file_path as json
@@ -15,10 +41,13 @@ def save_to_json(file_path, data):
         data: Dict to save as json
 
     """
+    if isinstance(data, list):
+        metrics.increment("rows", len(data))
     with open(file_path, "w", encoding="utf-8") as file:
         json.dump(data, file, indent=4)
 
 
+@instrument
 def read_json(file_path):
     """
     Reads json at file_path and returns corresponding dict
@@ -35,6 +64,132 @@ def read_json(file_path):
     return data_dict
 
 
+def iter_json(file_path, chunk_size=65536):
+    """
+    Yields the items of the JSON array at file_path one at a time
+
+    The file is read chunk_size characters at a time, so only one chunk and
+    the item being parsed are held in memory.
+
+    Args:
+        file_path: String representing filepath of a JSON array
+        chunk_size: Int with how many characters to read at once
+
+    Yields:
+        Each item of the array, such as an order dict
+    """
+    decoder = json.JSONDecoder()
+    with open(file_path, "r", encoding="utf-8") as file:
+        buffer = ""
+        position = 0
+        in_array = False
+        while True:
+            chunk = file.read(chunk_size)
+            buffer = buffer[position:] + chunk
+            position = 0
+            while True:
+                position = _WHITESPACE.match(buffer, position).end()
+                if position == len(buffer):
+                    break
+                char = buffer[position]
+                if not in_array:
+                    if char != "[":
+                        raise ValueError(f"{file_path} is not a JSON array")
+                    in_array = True
+                    position += 1
+                elif char == "]":
+                    return
+                elif char == ",":
+                    position += 1
+                else:
+                    try:
+                        item, end = decoder.raw_decode(buffer, position)
+                    except json.JSONDecodeError:
+                        if not chunk:
+                            raise
+                        break
+                    if chunk and (
+                        end == len(buffer) or buffer[end] in _NUMBER_CHARS
+                    ):
+                        # A number or literal may continue in the next chunk,
+                        # such as the 5 of a 1.5 split after its point.
+                        break
+                    yield item
+                    position = end
+            if not chunk:
+                raise ValueError(f"{file_path} ends before the array closes")
+
+
+def iter_jsonl(file_path):
+    """
+    Yields the items of the newline-delimited JSON file at file_path
+
+    Args:
+        file_path: String representing filepath with one JSON value per line
+
+    Yields:
+        The value on each non-empty line, such as an order dict
+    """
+    with open(file_path, "r", encoding="utf-8") as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def append_jsonl(file_path, data):
+    """
+    Appends each item of data to file_path as one line of compact JSON
+
+    Args:
+        file_path: String representing filepath to append data to
+        data: Iterable of JSON serializable items, such as order dicts
+
+    Returns:
+        Int with the number of items written
+    """
+    count = 0
+    with open(file_path, "a", encoding="utf-8") as file:
+        for item in data:
+            file.write(json.dumps(item, separators=(",", ":")))
+            file.write("\n")
+            count += 1
+    return count
+
+
+def is_jsonl(file_path):
+    """
+    Checks whether file_path holds newline-delimited JSON or a JSON array
+
+    Args:
+        file_path: String representing filepath to check
+
+    Returns:
+        True unless the file starts with a JSON array
+    """
+    with open(file_path, "r", encoding="utf-8") as file:
+        for line in file:
+            if line.strip():
+                return not line.lstrip().startswith("[")
+    return True
+
+
+def iter_orders(file_path):
+    """
+    Yields the orders saved at file_path one at a time
+
+    Args:
+        file_path: String representing filepath of orders saved as a JSON
+        array by save_to_json or as newline-delimited JSON by append_jsonl
+
+    Yields:
+        Dict for each order
+    """
+    if is_jsonl(file_path):
+        yield from iter_jsonl(file_path)
+    else:
+        yield from iter_json(file_path)
+
+
 def save_key(file_path, new_key):
     """
     Updates the access and refresh token in file_path
@@ -53,7 +208,8 @@ def save_key(file_path, new_key):
         json.dump(keys, file, indent=4)
 
 
-def refresh_key(key_path):
+@instrument
+def refresh_key(key_path, session=None):
     """
     Updates the key at path key_path with new access and refresh tokens
 
@@ -62,7 +218,9 @@ def refresh_key(key_path):
 
     Args:
         key_path: String with path to json containing key
+        session: Optional requests.Session to send the request with
     """
+    http = _requests() if session is None else session
 
     old_key = read_json(key_path)
 
@@ -76,21 +234,214 @@ def refresh_key(key_path):
         "refresh_token": old_key["refresh_token"],
     }
 
-    new_key = requests.post(
-        "https://api.etsy.com/v3/public/oauth/token",
+    metrics.increment("http_requests")
+    new_key = http.post(
+        TOKEN_URL,
         headers=headers,
         data=data,
         timeout=100,
     )
 
+    metrics.increment("token_refreshes")
     save_key(key_path, new_key.json())
 
 
-def get_orders(key_path, shop_id, limit=100, offset=0):
+class EtsyClient:
+    """
+    Sends Etsy API requests for one key, shared by any number of threads.
+
+    The key is read from key_path once and kept in memory. When the access
+    token has expired, one thread refreshes it while the others wait and then
+    use the new token. Rate-limited and server error responses are retried
+    after a backoff with jitter, and when the rate limit headers show no
+    requests are left this second, every thread waits for the next second.
+
+    Attributes:
+        key_path: String with path to json containing key
+        session: Optional requests.Session to send requests with
+        max_retries: Int with how many times to retry a request
+        backoff: Float with the most seconds to wait before the first retry,
+        doubling for each retry after
+        max_backoff: Float with the most seconds to wait before any retry
+        key: Dict with the current key
+    """
+
+    def __init__(
+        self, key_path, session=None, max_retries=5, backoff=0.5, max_backoff=60
+    ):
+        self.key_path = key_path
+        self.session = session
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.key = read_json(key_path)
+        self._refresh_lock = threading.Lock()
+        self._rate_lock = threading.Lock()
+        self._not_before = 0.0
+
+    def get_json(self, url, session=None):
+        """
+        Sends a GET request to the Etsy API and returns the response JSON
+
+        Args:
+            url: String with the URL to request
+            session: Optional requests.Session to send this request with
+            instead of the client's session
+
+        Returns:
+            JSON data of the response
+
+        Raises:
+            requests.HTTPError: If the request fails with a status that isn't
+            retried, or is still failing after max_retries retries
+        """
+        requests = _requests()
+        if session is None:
+            session = self.session
+        http = requests if session is None else session
+        refreshed = False
+
+        for attempt in count():
+            self._wait_for_rate_limit()
+            key = self.key
+            headers = {
+                "Authorization": f"Bearer {key['access_token']}",
+                "x-api-key": key["keystring"],
+            }
+
+            metrics.increment("http_requests")
+            try:
+                response = http.get(url, headers=headers, timeout=100)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.max_retries:
+                    raise
+                metrics.increment("retries")
+                time.sleep(self._backoff_delay(attempt))
+                continue
+            if metrics.enabled():
+                metrics.increment("bytes_downloaded", len(response.content))
+
+            if response.headers.get("x-remaining-this-second") == "0":
+                self._delay_all(1)
+
+            if response.status_code == 200:
+                return response.json()
+            if response.status_code == 401 and not refreshed:
+                self.refresh(key["access_token"], session=session)
+                refreshed = True
+                continue
+            if (
+                response.status_code in RETRY_STATUSES
+                and attempt < self.max_retries
+            ):
+                metrics.increment("retries")
+                delay = self._retry_delay(response, attempt)
+                if response.status_code == 429:
+                    self._delay_all(delay)
+                else:
+                    time.sleep(delay)
+                continue
+
+            response.raise_for_status()
+            return response.json()
+
+    def refresh(self, expired_token, session=None):
+        """
+        Gets a new access token unless another thread or process already
+        replaced it
+
+        Args:
+            expired_token: String with the access token that was rejected
+            session: Optional requests.Session to send the request with
+            instead of the client's session
+        """
+        with self._refresh_lock:
+            if self.key["access_token"] != expired_token:
+                return
+            self.key = read_json(self.key_path)
+            if self.key["access_token"] != expired_token:
+                return
+            if session is None:
+                session = self.session
+            refresh_key(self.key_path, session=session)
+            self.key = read_json(self.key_path)
+
+    def _wait_for_rate_limit(self):
+        """
+        Sleeps until requests are allowed again
+        """
+        with self._rate_lock:
+            delay = self._not_before - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _delay_all(self, delay):
+        """
+        Holds back every request for delay seconds
+        """
+        with self._rate_lock:
+            self._not_before = max(self._not_before, time.monotonic() + delay)
+
+    def _retry_delay(self, response, attempt):
+        """
+        Finds how long to wait before retrying a failed response
+
+        Uses the Retry-After header when the API sends one.
+        """
+        retry_after = response.headers.get("retry-after")
+        if retry_after is not None:
+            try:
+                return min(float(retry_after), self.max_backoff)
+            except ValueError:
+                pass
+        return self._backoff_delay(attempt)
+
+    def _backoff_delay(self, attempt):
+        """
+        Picks a random wait of up to backoff doubled for each attempt
+        """
+        return random.uniform(
+            0, min(self.max_backoff, self.backoff * 2**attempt)
+        )
+
+
+def shared_client(key_path):
+    """
+    Gets the EtsyClient shared by every call using the key at key_path
+
+    The key is read once when the client is made, so calls that don't bring
+    their own client use the token in memory and an expired token is
+    refreshed once for all of them.
+
+    Args:
+        key_path: String with path to json containing key
+
+    Returns:
+        EtsyClient for key_path
+    """
+    path = os.path.abspath(key_path)
+    with _clients_lock:
+        client = _clients.get(path)
+        if client is None:
+            client = _clients[path] = EtsyClient(key_path)
+        return client
+
+
+@instrument
+def get_orders(
+    key_path,
+    shop_id,
+    limit=100,
+    offset=0,
+    session=None,
+    min_created=None,
+    client=None,
+):
     """
     Gets up to 100 order receipts from shop using Etsy API
 
-    If the key at key_path has expired, it gets a new key.
+    If the key at key_path has expired, it gets a new key. Rate-limited and
+    failed requests are retried.
     The function skips cancelled orders.
 
     Args:
@@ -98,56 +449,279 @@ def get_orders(key_path, shop_id, limit=100, offset=0):
         shop_id: String with shop id to get orders from
         limit: Int of range 0-100 representing how many orders to get
         offset: First how many orders to skip chronologically
+        session: Optional requests.Session to reuse connections across calls
+        min_created: Optional unix timestamp, only orders created at or after
+        it are returned
+        client: Optional EtsyClient to send the request with, the client
+        shared by every call with key_path by default
 
     Returns:
         Dict of orders with all data provided by API
     """
-    key = read_json(key_path)
-
-    headers = {
-        "Authorization": f"Bearer {key['access_token']}",
-        "x-api-key": key["keystring"],
-    }
+    if client is None:
+        client = shared_client(key_path)
 
     orders_url = (
-        f"https://openapi.etsy.com/v3/application/shops/{shop_id}"
+        f"{API_URL}/shops/{shop_id}"
         + f"/receipts?limit={limit}&offset={offset}&was_canceled=false"
     )
-    orders = requests.get(orders_url, headers=headers, timeout=100)
-    if orders.status_code != 200:
-        refresh_key(key_path)
-        key = read_json(key_path)
-        headers["Authorization"] = f"Bearer {key['access_token']}"
-        orders = requests.get(orders_url, headers=headers, timeout=100)
+    if min_created is not None:
+        orders_url += f"&min_created={min_created}"
 
-    return orders.json()
+    return client.get_json(orders_url, session=session)
 
 
-def get_all_orders(key_path, data_path, shop_id):
+@instrument
+def get_all_orders(
+    key_path, data_path, shop_id, workers=1, id_map_path=None, stream=False
+):
     """
     Gets all order receipts from an Etsy shop and saves them to a JSON
 
+    Once the first request returns the number of orders, every page offset is
+    known, so the pages are fetched by a pool of worker threads sharing one
+    connection pool. Pages are put back in offset order before cleaning.
+
     Args:
         key_path: String with path to json containing api key
         data_path: String with path to where to save order data
         shop_id: Int representing Etsy shop id
+        workers: Int with the number of pages to fetch at the same time
+        id_map_path: Optional string with path to the IdMap database to save
+        the anonymized id of each buyer to, so sync_orders can keep using the
+        same ids. Ids already saved there are reused, so buyers keep their
+        anonymized id across full fetches.
+        stream: If True, save orders as newline-delimited JSON, writing each
+        page as it arrives instead of holding every order in memory. Pages
+        are written to data_path + ".partial", which replaces data_path only
+        once every page is saved, so a failed fetch leaves data_path as it
+        was.
+    """
+    pages = iter_order_pages(key_path, shop_id, workers=workers)
+
+    with open_id_map(id_map_path) as id_dict:
+        pages = _remember_receipts(pages, id_dict)
+        if stream:
+            partial_path = data_path + ".partial"
+            with open(partial_path, "w", encoding="utf-8"):
+                pass
+            for page in pages:
+                append_jsonl(partial_path, iter_clean_anonymize(page, id_dict))
+            os.replace(partial_path, data_path)
+        else:
+            cleaned_orders = clean_anonymize(
+                chain.from_iterable(pages), id_dict
+            )
+            save_to_json(data_path, cleaned_orders)
+
+
+@instrument
+def sync_orders(key_path, data_path, shop_id, id_map_path, workers=1):
+    """
+    Adds the order receipts newer than the ones saved at data_path
+
+    Only orders created from the second of the newest saved order on are
+    requested, and receipts of that second that were already saved are left
+    out. If the id map doesn't list the saved receipts of that second, such
+    as for an id map from before they were kept, only orders created after
+    it are requested. New orders are anonymized with the ids saved at
+    id_map_path, so returning buyers keep their id. New orders are appended
+    to newline-delimited JSON files and added in front of the orders in JSON
+    array files. If no orders are saved yet, all orders are fetched.
+
+    Args:
+        key_path: String with path to json containing api key
+        data_path: String with path to saved order data
+        shop_id: Int representing Etsy shop id
+        id_map_path: String with path to the IdMap database of anonymized ids
+        workers: Int with the number of pages to fetch at the same time
+
+    Returns:
+        Int with the number of new orders
+    """
+    newest = None
+    if os.path.exists(data_path):
+        newest = max(
+            (order["create_timestamp"] for order in iter_orders(data_path)),
+            default=None,
+        )
+
+    if newest is not None and not os.path.exists(id_map_path):
+        raise FileNotFoundError(
+            f"{data_path} has orders but no id map exists at {id_map_path}."
+            " Run get_all_orders with id_map_path to create it."
+        )
+
+    with IdMap(id_map_path) as id_dict:
+        saved = set() if newest is None else id_dict.saved_receipts(newest)
+        min_created = None
+        if newest is not None:
+            min_created = newest if saved else newest + 1
+        pages = _remember_receipts(
+            (
+                [
+                    receipt
+                    for receipt in page
+                    if receipt.get("receipt_id") not in saved
+                ]
+                for page in iter_order_pages(
+                    key_path, shop_id, workers=workers, min_created=min_created
+                )
+            ),
+            id_dict,
+        )
+
+        if newest is not None and is_jsonl(data_path):
+            return sum(
+                append_jsonl(data_path, iter_clean_anonymize(page, id_dict))
+                for page in pages
+            )
+
+        cleaned_orders = clean_anonymize(chain.from_iterable(pages), id_dict)
+
+    saved_orders = read_json(data_path) if newest is not None else []
+    save_to_json(data_path, cleaned_orders + saved_orders)
+
+    return len(cleaned_orders)
+
+
+def fetch_all_orders(key_path, shop_id, workers=1, min_created=None):
     """
+    Gets all order receipts from an Etsy shop, in the order the API lists them
 
-    first_order = get_orders(key_path, shop_id, limit=1)
-    num_orders = int(first_order["count"])
+    Args:
+        key_path: String with path to json containing api key
+        shop_id: Int representing Etsy shop id
+        workers: Int with the number of pages to fetch at the same time
+        min_created: Optional unix timestamp, only orders created at or after
+        it are fetched
 
-    orders = []
+    Returns:
+        List of dicts of Etsy order data from reciepts endpoint
+    """
+    return list(
+        chain.from_iterable(
+            iter_order_pages(
+                key_path, shop_id, workers=workers, min_created=min_created
+            )
+        )
+    )
 
-    for index in range(0, num_orders + 1, 100):
-        new_orders = get_orders(key_path, shop_id, offset=index)
-        orders.extend(new_orders["results"])
 
-    cleaned_orders = clean_anonymize(orders)
+def iter_order_pages(key_path, shop_id, workers=1, min_created=None):
+    """
+    Yields pages of order receipts from an Etsy shop in offset order
 
-    save_to_json(data_path, cleaned_orders)
+    At most workers pages are requested at the same time, and at most that
+    many pages are held waiting to be yielded.
 
+    Args:
+        key_path: String with path to json containing api key
+        shop_id: Int representing Etsy shop id
+        workers: Int with the number of pages to fetch at the same time
+        min_created: Optional unix timestamp, only orders created at or after
+        it are fetched
 
-def clean_anonymize(order_data):
+    Yields:
+        List of up to 100 dicts of Etsy order data from reciepts endpoint
+    """
+    requests = _requests()
+    with requests.Session() as session:
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=workers
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        client = shared_client(key_path)
+
+        first_order = get_orders(
+            key_path,
+            shop_id,
+            limit=1,
+            session=session,
+            min_created=min_created,
+            client=client,
+        )
+        num_orders = int(first_order["count"])
+
+        def get_page(offset):
+            return get_orders(
+                key_path,
+                shop_id,
+                offset=offset,
+                session=session,
+                min_created=min_created,
+                client=client,
+            )["results"]
+
+        # Only a few pages are requested ahead of the page being yielded, so
+        # a slow consumer holds back the requests instead of the pages
+        # piling up, and a failed page stops the requests after it.
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            try:
+                for offset in range(0, num_orders + 1, 100):
+                    pending.append(executor.submit(get_page, offset))
+                    if len(pending) >= workers:
+                        yield pending.popleft().result()
+                while pending:
+                    yield pending.popleft().result()
+            finally:
+                for future in pending:
+                    future.cancel()
+
+
+def _requests():
+    """
+    Imports requests the first time an API call needs it, so reading and
+    writing local order files doesn't pay for importing it
+    """
+    import requests  # pylint: disable=import-outside-toplevel
+
+    return requests
+
+
+def _remember_receipts(pages, id_dict):
+    """
+    Passes pages through, saving the newest receipts to the IdMap
+
+    Args:
+        pages: Iterable of lists of receipt dicts
+        id_dict: IdMap, or a plain dict that keeps no receipts
+
+    Yields:
+        Each page of receipts
+    """
+    for page in pages:
+        remember_page(page, id_dict)
+        yield page
+
+
+def remember_page(page, id_dict):
+    """
+    Saves the newest receipts of a page to id_dict if it is an IdMap
+    """
+    if isinstance(id_dict, IdMap):
+        id_dict.add_receipts(page)
+
+
+def open_id_map(id_map_path):
+    """
+    Opens the IdMap at id_map_path, or a plain dict if no path is given
+
+    Args:
+        id_map_path: String with path to an IdMap database, or None
+
+    Returns:
+        Context manager that gives a dict-like mapping of anonymized ids
+    """
+    if id_map_path is None:
+        return nullcontext({})
+    return IdMap(id_map_path)
+
+
+@instrument
+def clean_anonymize(order_data, id_dict=None):
     """
     Filters data so only relavant data is left show and anonymizes IDs
 
@@ -156,30 +730,50 @@ def clean_anonymize(order_data):
 
     Args:
         order_data: List of dicts of Etsy order data from reciepts endpoint
+        id_dict: Optional dict or IdMap mapping real buyer ids to anonymized
+        ids from an earlier run. New buyers are added to it.
 
     Returns:
         List of dicts with only relavant data and anonymized ids
     """
+    cleaned_orders = list(iter_clean_anonymize(order_data, id_dict))
+    metrics.increment("rows", len(cleaned_orders))
+
+    return cleaned_orders
+
+
+def iter_clean_anonymize(order_data, id_dict=None):
+    """
+    Cleans and anonymizes orders one at a time, like clean_anonymize
 
-    cleaned_data = []
+    Only one order is handled at a time, so with an IdMap as id_dict the
+    orders and ids don't need to fit in memory.
 
-    new_id = 1
-    id_dict = {}
+    Args:
+        order_data: Iterable of dicts of Etsy order data from reciepts
+        endpoint
+        id_dict: Optional dict or IdMap mapping real buyer ids to anonymized
+        ids from an earlier run. New buyers are added to it.
+
+    Yields:
+        Dict with only relavant data and an anonymized id for each order
+    """
+    if id_dict is None:
+        id_dict = {}
+    new_id = len(id_dict) + 1
 
     for order in order_data:
-        order_dict = {}
-        if order["buyer_user_id"] not in id_dict:
+        buyer_user_id = id_dict.get(order["buyer_user_id"])
+        if buyer_user_id is None:
+            buyer_user_id = new_id
             id_dict[order["buyer_user_id"]] = new_id
-            order_dict["buyer_user_id"] = new_id
             new_id += 1
-        else:
-            order_dict["buyer_user_id"] = id_dict[order["buyer_user_id"]]
-        order_dict["state"] = order["state"]
-        order_dict["subtotal"] = order["subtotal"]
-        order_dict["create_timestamp"] = order["create_timestamp"]
-        cleaned_data.append(order_dict)
-
-    return cleaned_data
+        yield {
+            "buyer_user_id": buyer_user_id,
+            "state": order["state"],
+            "subtotal": order["subtotal"],
+            "create_timestamp": order["create_timestamp"],
+        }
 
 
 def extract_data(data, parameter_1, parameter_2=None):
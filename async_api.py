@@ -0,0 +1,399 @@
+"""
+Asyncio version of the api_lib Etsy client, for use inside an event loop
+
+The functions here work like the api_lib functions of the same name, but send
+requests with an httpx.AsyncClient that keeps connections alive between
+requests:
+
+    import asyncio
+    from async_api import get_all_orders
+
+    asyncio.run(get_all_orders("keys.json", "orders.json", shop_id))
+"""
+
+import asyncio
+from collections import deque
+from itertools import count
+import os
+import random
+import time
+import api_lib
+from api_lib import (
+    RETRY_STATUSES,
+    append_jsonl,
+    iter_clean_anonymize,
+    open_id_map,
+    read_json,
+    remember_page,
+    save_key,
+    save_to_json,
+)
+import metrics
+
+
+async def refresh_key(key_path, client=None):
+    """
+    Updates the key at path key_path with new access and refresh tokens
+
+    Args:
+        key_path: String with path to json containing key
+        client: Optional httpx.AsyncClient to send the request with
+    """
+    old_key = read_json(key_path)
+
+    headers = {
+        "Content-Type": "application/x-www-form-urlencoded",
+    }
+
+    data = {
+        "grant_type": "refresh_token",
+        "client_id": old_key["keystring"],
+        "refresh_token": old_key["refresh_token"],
+    }
+
+    metrics.increment("http_requests")
+    if client is None:
+        async with _httpx().AsyncClient(timeout=100) as new_client:
+            new_key = await new_client.post(
+                api_lib.TOKEN_URL, headers=headers, data=data
+            )
+    else:
+        new_key = await client.post(
+            api_lib.TOKEN_URL, headers=headers, data=data, timeout=100
+        )
+
+    metrics.increment("token_refreshes")
+    save_key(key_path, new_key.json())
+
+
+class AsyncEtsyClient:
+    """
+    Sends Etsy API requests for one key, shared by any number of tasks.
+
+    Works like api_lib.EtsyClient: when the access token has expired, one
+    task refreshes it while the others wait, rate-limited and server error
+    responses are retried after a backoff with jitter, and when no requests
+    are left this second every task waits for the next second. Use it as an
+    async context manager, or call aclose, to close the connections it
+    opened.
+
+    Attributes:
+        key_path: String with path to json containing key
+        client: httpx.AsyncClient to send requests with. If none is given,
+        one keeping up to max_connections connections alive is opened.
+        max_retries: Int with how many times to retry a request
+        backoff: Float with the most seconds to wait before the first retry,
+        doubling for each retry after
+        max_backoff: Float with the most seconds to wait before any retry
+        key: Dict with the current key
+    """
+
+    def __init__(
+        self,
+        key_path,
+        client=None,
+        max_retries=5,
+        backoff=0.5,
+        max_backoff=60,
+        max_connections=10,
+    ):
+        # pylint: disable=too-many-arguments
+        self.key_path = key_path
+        self._owns_client = client is None
+        if client is None:
+            httpx = _httpx()
+            client = httpx.AsyncClient(
+                timeout=100,
+                limits=httpx.Limits(
+                    max_connections=max_connections,
+                    max_keepalive_connections=max_connections,
+                ),
+            )
+        self.client = client
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.key = read_json(key_path)
+        self._refresh_lock = asyncio.Lock()
+        self._not_before = 0.0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def aclose(self):
+        """
+        Closes the connections of the client, if this object opened it
+        """
+        if self._owns_client:
+            await self.client.aclose()
+
+    async def get_json(self, url):
+        """
+        Sends a GET request to the Etsy API and returns the response JSON
+
+        Args:
+            url: String with the URL to request
+
+        Returns:
+            JSON data of the response
+
+        Raises:
+            httpx.HTTPStatusError: If the request fails with a status that
+            isn't retried, or is still failing after max_retries retries
+        """
+        httpx = _httpx()
+        refreshed = False
+
+        for attempt in count():
+            await self._wait_for_rate_limit()
+            key = self.key
+            headers = {
+                "Authorization": f"Bearer {key['access_token']}",
+                "x-api-key": key["keystring"],
+            }
+
+            metrics.increment("http_requests")
+            try:
+                response = await self.client.get(
+                    url, headers=headers, timeout=100
+                )
+            except httpx.TransportError:
+                if attempt >= self.max_retries:
+                    raise
+                metrics.increment("retries")
+                await asyncio.sleep(self._backoff_delay(attempt))
+                continue
+            if metrics.enabled():
+                metrics.increment("bytes_downloaded", len(response.content))
+
+            if response.headers.get("x-remaining-this-second") == "0":
+                self._delay_all(1)
+
+            if response.status_code == 200:
+                return response.json()
+            if response.status_code == 401 and not refreshed:
+                await self.refresh(key["access_token"])
+                refreshed = True
+                continue
+            if (
+                response.status_code in RETRY_STATUSES
+                and attempt < self.max_retries
+            ):
+                metrics.increment("retries")
+                delay = self._retry_delay(response, attempt)
+                if response.status_code == 429:
+                    self._delay_all(delay)
+                else:
+                    await asyncio.sleep(delay)
+                continue
+
+            response.raise_for_status()
+            return response.json()
+
+    async def refresh(self, expired_token):
+        """
+        Gets a new access token unless another task already replaced it
+
+        Args:
+            expired_token: String with the access token that was rejected
+        """
+        async with self._refresh_lock:
+            if self.key["access_token"] != expired_token:
+                return
+            await refresh_key(self.key_path, client=self.client)
+            self.key = read_json(self.key_path)
+
+    async def _wait_for_rate_limit(self):
+        """
+        Sleeps until requests are allowed again
+        """
+        delay = self._not_before - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def _delay_all(self, delay):
+        """
+        Holds back every request for delay seconds
+        """
+        self._not_before = max(self._not_before, time.monotonic() + delay)
+
+    def _retry_delay(self, response, attempt):
+        """
+        Finds how long to wait before retrying a failed response
+
+        Uses the Retry-After header when the API sends one.
+        """
+        retry_after = response.headers.get("retry-after")
+        if retry_after is not None:
+            try:
+                return min(float(retry_after), self.max_backoff)
+            except ValueError:
+                pass
+        return self._backoff_delay(attempt)
+
+    def _backoff_delay(self, attempt):
+        """
+        Picks a random wait of up to backoff doubled for each attempt
+        """
+        return random.uniform(
+            0, min(self.max_backoff, self.backoff * 2**attempt)
+        )
+
+
+async def get_orders(
+    key_path,
+    shop_id,
+    limit=100,
+    offset=0,
+    min_created=None,
+    client=None,
+):
+    """
+    Gets up to 100 order receipts from shop using Etsy API
+
+    If the key at key_path has expired, it gets a new key. Rate-limited and
+    failed requests are retried.
+    The function skips cancelled orders.
+
+    Args:
+        key_path: String with path to json containing key
+        shop_id: String with shop id to get orders from
+        limit: Int of range 0-100 representing how many orders to get
+        offset: First how many orders to skip chronologically
+        min_created: Optional unix timestamp, only orders created at or after
+        it are returned
+        client: Optional AsyncEtsyClient to send the request with, so its
+        key, connections and rate limit are shared with other calls
+
+    Returns:
+        Dict of orders with all data provided by API
+    """
+    orders_url = (
+        f"{api_lib.API_URL}/shops/{shop_id}"
+        + f"/receipts?limit={limit}&offset={offset}&was_canceled=false"
+    )
+    if min_created is not None:
+        orders_url += f"&min_created={min_created}"
+
+    if client is None:
+        async with AsyncEtsyClient(key_path) as new_client:
+            return await new_client.get_json(orders_url)
+    return await client.get_json(orders_url)
+
+
+async def iter_order_pages(
+    key_path, shop_id, concurrency=4, min_created=None, client=None
+):
+    """
+    Yields pages of order receipts from an Etsy shop in offset order
+
+    At most concurrency pages are requested at the same time, and at most
+    that many pages are held waiting to be yielded.
+
+    Args:
+        key_path: String with path to json containing api key
+        shop_id: Int representing Etsy shop id
+        concurrency: Int with the number of pages to fetch at the same time
+        min_created: Optional unix timestamp, only orders created at or after
+        it are fetched
+        client: Optional AsyncEtsyClient to send the requests with
+
+    Yields:
+        List of up to 100 dicts of Etsy order data from reciepts endpoint
+    """
+    if client is None:
+        async with AsyncEtsyClient(
+            key_path, max_connections=concurrency
+        ) as new_client:
+            async for page in iter_order_pages(
+                key_path, shop_id, concurrency, min_created, new_client
+            ):
+                yield page
+        return
+
+    first_order = await get_orders(
+        key_path, shop_id, limit=1, min_created=min_created, client=client
+    )
+    offsets = iter(range(0, int(first_order["count"]) + 1, 100))
+    pending = deque()
+    try:
+        for offset in offsets:
+            pending.append(
+                asyncio.ensure_future(
+                    get_orders(
+                        key_path,
+                        shop_id,
+                        offset=offset,
+                        min_created=min_created,
+                        client=client,
+                    )
+                )
+            )
+            if len(pending) >= concurrency:
+                yield (await pending.popleft())["results"]
+        while pending:
+            yield (await pending.popleft())["results"]
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def get_all_orders(
+    key_path,
+    data_path,
+    shop_id,
+    concurrency=4,
+    id_map_path=None,
+    stream=False,
+):
+    """
+    Gets all order receipts from an Etsy shop and saves them to a JSON
+
+    Pages are cleaned and anonymized as they arrive, in offset order, so the
+    saved orders match api_lib.get_all_orders.
+
+    Args:
+        key_path: String with path to json containing api key
+        data_path: String with path to where to save order data
+        shop_id: Int representing Etsy shop id
+        concurrency: Int with the number of pages to fetch at the same time
+        id_map_path: Optional string with path to the IdMap database to save
+        the anonymized id of each buyer to. Ids already saved there are
+        reused, so buyers keep their anonymized id across full fetches.
+        stream: If True, save orders as newline-delimited JSON, writing each
+        page as it arrives instead of holding every order in memory. Pages
+        are written to data_path + ".partial", which replaces data_path only
+        once every page is saved, so a failed fetch leaves data_path as it
+        was.
+    """
+    # pylint: disable=too-many-arguments
+    pages = iter_order_pages(key_path, shop_id, concurrency=concurrency)
+
+    with open_id_map(id_map_path) as id_dict:
+        if stream:
+            partial_path = data_path + ".partial"
+            with open(partial_path, "w", encoding="utf-8"):
+                pass
+            async for page in pages:
+                remember_page(page, id_dict)
+                append_jsonl(partial_path, iter_clean_anonymize(page, id_dict))
+            os.replace(partial_path, data_path)
+        else:
+            cleaned_orders = []
+            async for page in pages:
+                remember_page(page, id_dict)
+                cleaned_orders.extend(iter_clean_anonymize(page, id_dict))
+            metrics.increment("rows", len(cleaned_orders))
+            save_to_json(data_path, cleaned_orders)
+
+
+def _httpx():
+    """
+    Imports httpx the first time an async API call needs it
+    """
+    import httpx  # pylint: disable=import-outside-toplevel
+
+    return httpx
@@ -0,0 +1,210 @@
+"""
+Fetch and analyze the orders of many Etsy shops in one run
+
+Run `python batch.py shops.json --output-dir batch_results` to fetch and
+analyze every shop listed in shops.json and save a combined results table.
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+import numpy as np
+import pandas as pd
+from analyze_data import analyze_all
+from api_lib import append_jsonl, get_all_orders, iter_jsonl, read_json
+from order_table import read_order_table
+
+PROGRESS_FILE = "progress.jsonl"
+RESULTS_FILE = "results.csv"
+
+RESULT_COLUMNS = [
+    "shop_id",
+    "status",
+    "error",
+    "num_orders",
+    "num_customers",
+    "repeat_customers",
+    "single_order_value",
+    "multiple_order_value",
+    "mean_years_between_orders",
+]
+
+
+def read_shops(file_path):
+    """
+    Reads the list of shops to analyze
+
+    Args:
+        file_path: String with path to a JSON array of dicts, each with the
+        shop_id of a shop and the key_path of the keys.json to access it with
+
+    Returns:
+        List of shop dicts
+    """
+    return read_json(file_path)
+
+
+def run_batch(
+    shops, output_dir, max_connections=8, fetch_workers=4, shop_workers=None
+):
+    """
+    Fetches and analyzes every shop, several at a time, and saves a combined
+    results table
+
+    Each shop's orders are saved to output_dir/<shop_id>/orders.json. A shop
+    that fails is recorded with its error and doesn't stop the others. Every
+    finished shop is logged to output_dir/progress.jsonl, so running the
+    batch again after a crash skips shops that already succeeded, and shops
+    whose orders were saved are analyzed again without being refetched.
+
+    Args:
+        shops: List of dicts with the shop_id and key_path of each shop
+        output_dir: String with path to the directory to save to
+        max_connections: Int with the most API connections open at once
+        across all shops
+        fetch_workers: Int with the number of pages to fetch at the same time
+        for one shop
+        shop_workers: Int with the number of shops to process at the same
+        time. Defaults to enough shops to use every connection.
+
+    Returns:
+        DataFrame with a row of RESULT_COLUMNS for each shop, in the order
+        shops are listed, also saved to output_dir/results.csv
+    """
+    fetch_workers = max(min(fetch_workers, max_connections), 1)
+    fetch_slots = threading.BoundedSemaphore(
+        max(max_connections // fetch_workers, 1)
+    )
+    if shop_workers is None:
+        shop_workers = max(max_connections // fetch_workers, 1)
+
+    os.makedirs(output_dir, exist_ok=True)
+    progress_path = os.path.join(output_dir, PROGRESS_FILE)
+    progress_lock = threading.Lock()
+
+    finished = {}
+    if os.path.exists(progress_path):
+        for row in iter_jsonl(progress_path):
+            finished[str(row["shop_id"])] = row
+
+    def process(shop):
+        shop_id = str(shop["shop_id"])
+        if finished.get(shop_id, {}).get("status") == "ok":
+            return finished[shop_id]
+
+        try:
+            orders_path = fetch_shop(
+                shop,
+                os.path.join(output_dir, shop_id),
+                fetch_slots,
+                fetch_workers,
+            )
+            row = summarize_shop(orders_path)
+            row.update(shop_id=shop_id, status="ok", error=None)
+        except Exception as error:  # pylint: disable=broad-exception-caught
+            row = {
+                "shop_id": shop_id,
+                "status": "failed",
+                "error": f"{type(error).__name__}: {error}",
+            }
+
+        with progress_lock:
+            append_jsonl(progress_path, [row])
+        return row
+
+    with ThreadPoolExecutor(max_workers=shop_workers) as executor:
+        rows = list(executor.map(process, shops))
+
+    results = pd.DataFrame(rows, columns=RESULT_COLUMNS)
+    results.to_csv(os.path.join(output_dir, RESULTS_FILE), index=False)
+
+    return results
+
+
+def fetch_shop(shop, shop_dir, fetch_slots, fetch_workers):
+    """
+    Fetches a shop's orders unless an earlier run already saved them
+
+    Orders are written to a temporary file that is renamed once every order
+    is saved, so an interrupted fetch is never mistaken for a finished one.
+
+    Args:
+        shop: Dict with the shop_id and key_path of the shop
+        shop_dir: String with path to the directory to save the shop's
+        orders to
+        fetch_slots: Semaphore to hold while fetching, limiting how many
+        shops fetch at once
+        fetch_workers: Int with the number of pages to fetch at the same time
+
+    Returns:
+        String with path to the saved orders
+    """
+    orders_path = os.path.join(shop_dir, "orders.json")
+    if os.path.exists(orders_path):
+        return orders_path
+
+    os.makedirs(shop_dir, exist_ok=True)
+    partial_path = orders_path + ".partial"
+    with fetch_slots:
+        get_all_orders(
+            shop["key_path"],
+            partial_path,
+            shop["shop_id"],
+            workers=fetch_workers,
+        )
+    os.replace(partial_path, orders_path)
+
+    return orders_path
+
+
+def summarize_shop(orders_path):
+    """
+    Analyzes a shop's orders and sums up the results in one row
+
+    Args:
+        orders_path: String with path to the shop's saved orders
+
+    Returns:
+        Dict with the num_orders, num_customers, repeat_customers,
+        single_order_value, multiple_order_value and
+        mean_years_between_orders of the shop
+    """
+    results = analyze_all(read_order_table(orders_path))
+    timeline = results["orders_by_customer"]
+    years = results["years"]
+
+    return {
+        "num_orders": len(results["buyer_user_id"]),
+        "num_customers": len(timeline),
+        "repeat_customers": int(np.count_nonzero(timeline.num_orders > 1)),
+        "single_order_value": results["single_order_value"],
+        "multiple_order_value": results["multiple_order_value"],
+        "mean_years_between_orders": (
+            float(years.mean()) if len(years) > 0 else None
+        ),
+    }
+
+
+def main():
+    """
+    Runs a batch from the command line and prints the results table
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("shops", help="JSON list of shop_id and key_path")
+    parser.add_argument("--output-dir", default="batch_results")
+    parser.add_argument("--max-connections", type=int, default=8)
+    parser.add_argument("--fetch-workers", type=int, default=4)
+    args = parser.parse_args()
+
+    results = run_batch(
+        read_shops(args.shops),
+        args.output_dir,
+        max_connections=args.max_connections,
+        fetch_workers=args.fetch_workers,
+    )
+    print(results.to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
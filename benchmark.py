@@ -0,0 +1,607 @@
+"""
+Benchmark analyze_data and api_lib on synthetic shops of different sizes
+
+Run `python benchmark.py --sizes 1000 100000 10000000` to time and memory
+profile every benchmarked function and save the results as JSON.
+"""
+
+import argparse
+from datetime import datetime, timezone
+import functools
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import analyze_data
+import api_lib
+import customer_value
+from order_table import OrderTable
+import parallel
+
+US_STATES = [
+    "AL", "AK", "AZ", "AR", "CA", "CO", "CT", "DE", "DC", "FL", "GA",
+    "HI", "ID", "IL", "IN", "IA", "KS", "KY", "LA", "ME", "MD", "MA",
+    "MI", "MN", "MS", "MO", "MT", "NE", "NV", "NH", "NJ", "NM", "NY",
+    "NC", "ND", "OH", "OK", "OR", "PA", "RI", "SC", "SD", "TN", "TX",
+    "UT", "VT", "VA", "WA", "WV", "WI", "WY",
+]  # fmt: skip
+
+# Share of customers placing each number of orders
+DEFAULT_ORDERS_PER_CUSTOMER = {1: 0.86, 2: 0.09, 3: 0.03, 4: 0.01, 6: 0.01}
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+
+
+def generate_order_table(
+    num_orders,
+    orders_per_customer=None,
+    state_weights=None,
+    start="2018-01-01",
+    end="2024-03-27",
+    seed=0,
+):
+    """
+    Generates a synthetic shop's cleaned orders as an OrderTable
+
+    Orders are listed newest first, like the Etsy receipts endpoint. Each
+    customer ships all of their orders to one state.
+
+    Args:
+        num_orders: Int with how many orders to generate
+        orders_per_customer: Dict mapping a number of orders to the share of
+        customers placing that many orders
+        state_weights: Dict mapping state names to how likely a customer is
+        to live there. All US states are equally likely by default.
+        start: ISO date string of the earliest order, in UTC
+        end: ISO date string the latest order is before, in UTC
+        seed: Int seed for the random number generator
+
+    Returns:
+        OrderTable with num_orders orders
+    """
+    rng = np.random.default_rng(seed)
+
+    if orders_per_customer is None:
+        orders_per_customer = DEFAULT_ORDERS_PER_CUSTOMER
+    if state_weights is None:
+        state_weights = dict.fromkeys(US_STATES, 1)
+
+    counts = np.array(list(orders_per_customer), dtype=np.int64)
+    shares = np.array(list(orders_per_customer.values()), dtype=float)
+    mean_orders = (counts * shares).sum() / shares.sum()
+
+    # Draw a few more customers than needed and cut the last one short.
+    num_buyers = int(num_orders / mean_orders * 1.1) + 10
+    buyer_counts = rng.choice(counts, size=num_buyers, p=shares / shares.sum())
+    cumulative = np.cumsum(buyer_counts)
+    num_buyers = int(np.searchsorted(cumulative, num_orders)) + 1
+    buyer_counts = buyer_counts[:num_buyers]
+    buyer_counts[-1] -= cumulative[num_buyers - 1] - num_orders
+
+    buyer_user_id = rng.permutation(
+        np.repeat(np.arange(1, num_buyers + 1, dtype=np.int64), buyer_counts)
+    )
+
+    weights = np.array(list(state_weights.values()), dtype=float)
+    buyer_state = rng.choice(
+        len(weights), size=num_buyers + 1, p=weights / weights.sum()
+    ).astype(np.int32)
+    states = np.empty(len(weights), dtype=object)
+    states[:] = list(state_weights)
+
+    first = int(_to_timestamp(start))
+    last = int(_to_timestamp(end))
+    create_timestamp = np.sort(rng.integers(first, last, size=num_orders))[
+        ::-1
+    ].copy()
+
+    amount = np.maximum(
+        rng.lognormal(np.log(3500), 0.5, size=num_orders).astype(np.int64), 1
+    )
+
+    return OrderTable(
+        buyer_user_id=buyer_user_id,
+        state_codes=buyer_state[buyer_user_id],
+        states=states,
+        amount=amount,
+        divisor=np.full(num_orders, 100, dtype=np.int64),
+        create_timestamp=create_timestamp,
+    )
+
+
+def generate_orders(num_orders, **kwargs):
+    """
+    Generates a synthetic shop's cleaned orders in the orders.json format
+
+    Args:
+        num_orders: Int with how many orders to generate
+        kwargs: Any other arguments of generate_order_table
+
+    Returns:
+        List of order dicts like the output of clean_anonymize
+    """
+    return _order_dicts(generate_order_table(num_orders, **kwargs))
+
+
+class BenchmarkInputs:
+    """
+    Inputs of the benchmark cases for one synthetic shop
+
+    Each input is built the first time a case asks for it, so cases that are
+    filtered out don't pay for building the list of order dicts or writing
+    the JSON file.
+
+    Attributes:
+        num_orders: Int with how many orders the shop has
+        directory: String with path to a directory for temporary files
+        kwargs: Dict of any other arguments of generate_order_table
+    """
+
+    def __init__(self, num_orders, directory, **kwargs):
+        self.num_orders = num_orders
+        self.directory = directory
+        self.kwargs = kwargs
+
+    @functools.cached_property
+    def table(self):
+        """
+        OrderTable of the shop's orders
+        """
+        return generate_order_table(self.num_orders, **self.kwargs)
+
+    @functools.cached_property
+    def orders(self):
+        """
+        List of order dicts with the same orders as table
+        """
+        return _order_dicts(self.table)
+
+    @functools.cached_property
+    def buyer_list(self):
+        """
+        List with the buyer id of each order dict
+        """
+        return [order["buyer_user_id"] for order in self.orders]
+
+    @functools.cached_property
+    def json_path(self):
+        """
+        String with path to the orders saved by save_to_json
+        """
+        json_path = os.path.join(self.directory, "orders.json")
+        api_lib.save_to_json(json_path, self.orders)
+        return json_path
+
+    @functools.cached_property
+    def timeline(self):
+        """
+        CustomerTimeline returned by calculate_time_between_orders for table
+        """
+        return analyze_data.calculate_time_between_orders(
+            self.table.buyer_user_id, self.table
+        )[1]
+
+    def data(self, input_name):
+        """
+        Returns the orders as a list for "list" or as the table for "table"
+        """
+        return self.orders if input_name == "list" else self.table
+
+    def buyer_user_id(self, input_name):
+        """
+        Returns the buyer ids as a list for "list" or an array for "table"
+        """
+        return (
+            self.buyer_list
+            if input_name == "list"
+            else self.table.buyer_user_id
+        )
+
+
+def benchmark_cases(inputs):
+    """
+    Lists the calls to benchmark for one synthetic shop
+
+    Args:
+        inputs: BenchmarkInputs of the shop
+
+    Returns:
+        List of (function name, input name, setup) tuples. Calling setup
+        builds the inputs the case needs and returns the callable to time.
+    """
+    directory = inputs.directory
+
+    cases = []
+    for input_name in ("list", "table"):
+        cases += [
+            (
+                "calculate_orders_per_customer",
+                input_name,
+                lambda name=input_name: functools.partial(
+                    analyze_data.calculate_orders_per_customer,
+                    inputs.data(name),
+                ),
+            ),
+            (
+                "calculate_avg_order_size",
+                input_name,
+                lambda name=input_name: functools.partial(
+                    analyze_data.calculate_avg_order_size,
+                    inputs.buyer_user_id(name),
+                    inputs.data(name),
+                ),
+            ),
+            (
+                "calculate_time_between_orders",
+                input_name,
+                lambda name=input_name: functools.partial(
+                    analyze_data.calculate_time_between_orders,
+                    inputs.buyer_user_id(name),
+                    inputs.data(name),
+                ),
+            ),
+            (
+                "count_orders_by_state",
+                input_name,
+                lambda name=input_name: functools.partial(
+                    analyze_data.count_orders_by_state, inputs.data(name)
+                ),
+            ),
+            (
+                "calculate_reorder_rate_by_state",
+                input_name,
+                lambda name=input_name: functools.partial(
+                    analyze_data.calculate_reorder_rate_by_state,
+                    inputs.data(name),
+                ),
+            ),
+            (
+                "calculate_cohort_retention",
+                input_name,
+                lambda name=input_name: functools.partial(
+                    analyze_data.calculate_cohort_retention, inputs.data(name)
+                ),
+            ),
+            (
+                "analyze_all",
+                input_name,
+                lambda name=input_name: functools.partial(
+                    analyze_data.analyze_all, inputs.data(name)
+                ),
+            ),
+            (
+                "analyze_parallel",
+                input_name,
+                lambda name=input_name: functools.partial(
+                    parallel.analyze_parallel, inputs.data(name)
+                ),
+            ),
+            (
+                "calculate_customer_value",
+                input_name,
+                lambda name=input_name: functools.partial(
+                    customer_value.calculate_customer_value,
+                    inputs.data(name),
+                ),
+            ),
+        ]
+
+    cases += [
+        (
+            "find_order_dates",
+            "dict",
+            lambda: functools.partial(
+                analyze_data.find_order_dates, inputs.timeline.to_dict()
+            ),
+        ),
+        (
+            "find_order_dates",
+            "table",
+            lambda: functools.partial(
+                analyze_data.find_order_dates, inputs.timeline
+            ),
+        ),
+        (
+            "clean_anonymize",
+            "list",
+            lambda: functools.partial(api_lib.clean_anonymize, inputs.orders),
+        ),
+        (
+            "extract_data",
+            "list",
+            lambda: functools.partial(
+                api_lib.extract_data, inputs.orders, "buyer_user_id", "state"
+            ),
+        ),
+        (
+            "import analyze_data",
+            "process",
+            lambda: functools.partial(_run_python, "-c", "import analyze_data"),
+        ),
+        (
+            "analyze_data cli",
+            "file",
+            lambda: functools.partial(
+                _run_python,
+                "-m",
+                "analyze_data",
+                inputs.json_path,
+                "--output",
+                os.path.join(directory, "metrics.json"),
+            ),
+        ),
+        (
+            "read_json",
+            "file",
+            lambda: functools.partial(api_lib.read_json, inputs.json_path),
+        ),
+        (
+            "save_to_json",
+            "list",
+            lambda: functools.partial(
+                api_lib.save_to_json,
+                os.path.join(directory, "saved.json"),
+                inputs.orders,
+            ),
+        ),
+    ]
+
+    return cases
+
+
+def measure(function, repeat=3):
+    """
+    Times function and measures the peak memory it allocates
+
+    Args:
+        function: Callable taking no arguments
+        repeat: Int with how many timed runs to take the fastest of
+
+    Returns:
+        seconds: Float with the fastest wall time of the timed runs
+        peak_bytes: Int with the most memory allocated at once during a
+        separate run traced by tracemalloc
+    """
+    seconds = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        seconds = min(seconds, time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        function()
+        _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return seconds, peak_bytes
+
+
+def run_benchmarks(sizes=None, repeat=3, functions=None, **kwargs):
+    """
+    Benchmarks every function on synthetic shops of each size
+
+    Args:
+        sizes: List of ints with the number of orders of each shop
+        repeat: Int with how many timed runs to take the fastest of
+        functions: Optional collection of function names to benchmark. All
+        functions are benchmarked by default.
+        kwargs: Any other arguments of generate_order_table
+
+    Returns:
+        Dict with information about the environment under "environment" and a
+        list of dicts with the function, input, num_orders, seconds and
+        peak_bytes of each measurement under "results"
+    """
+    if sizes is None:
+        sizes = DEFAULT_SIZES
+
+    results = []
+    for num_orders in sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            inputs = BenchmarkInputs(num_orders, directory, **kwargs)
+            for name, input_name, setup in benchmark_cases(inputs):
+                if functions is not None and name not in functions:
+                    continue
+                seconds, peak_bytes = measure(setup(), repeat=repeat)
+                results.append(
+                    {
+                        "function": name,
+                        "input": input_name,
+                        "num_orders": num_orders,
+                        "seconds": seconds,
+                        "peak_bytes": peak_bytes,
+                    }
+                )
+
+    return {"environment": _environment(), "results": results}
+
+
+def compare_benchmarks(baseline, current):
+    """
+    Compares two sets of benchmark results measurement by measurement
+
+    Args:
+        baseline: Dict returned by run_benchmarks, or read from its JSON
+        current: Dict returned by run_benchmarks, or read from its JSON
+
+    Returns:
+        List of dicts with the function, input and num_orders of each
+        measurement in both sets and the ratio of current to baseline
+        seconds and peak_bytes. Ratios above 1 are regressions.
+    """
+    baseline_results = {
+        (result["function"], result["input"], result["num_orders"]): result
+        for result in baseline["results"]
+    }
+
+    comparison = []
+    for result in current["results"]:
+        key = (result["function"], result["input"], result["num_orders"])
+        if key not in baseline_results:
+            continue
+        old = baseline_results[key]
+        comparison.append(
+            {
+                "function": key[0],
+                "input": key[1],
+                "num_orders": key[2],
+                "seconds_ratio": result["seconds"] / max(old["seconds"], 1e-9),
+                "peak_bytes_ratio": (
+                    result["peak_bytes"] / max(old["peak_bytes"], 1)
+                ),
+            }
+        )
+
+    return comparison
+
+
+def parallel_speedups(results):
+    """
+    Compares analyze_parallel with analyze_all on the same inputs
+
+    Args:
+        results: Dict returned by run_benchmarks, or read from its JSON
+
+    Returns:
+        List of dicts with the input, num_orders and speedup of each input
+        both functions were measured on. The speedup is analyze_all's seconds
+        divided by analyze_parallel's, so above 1 means parallel was faster.
+    """
+    seconds = {
+        (result["function"], result["input"], result["num_orders"]): result[
+            "seconds"
+        ]
+        for result in results["results"]
+    }
+
+    speedups = []
+    for (function, input_name, num_orders), serial in seconds.items():
+        key = ("analyze_parallel", input_name, num_orders)
+        if function != "analyze_all" or key not in seconds:
+            continue
+        speedups.append(
+            {
+                "input": input_name,
+                "num_orders": num_orders,
+                "speedup": serial / max(seconds[key], 1e-9),
+            }
+        )
+
+    return speedups
+
+
+def _order_dicts(table):
+    """
+    Converts an OrderTable to cleaned order dicts in the orders.json format
+    """
+    return [
+        {
+            "buyer_user_id": buyer_user_id,
+            "state": state,
+            "subtotal": {
+                "amount": amount,
+                "divisor": divisor,
+                "currency_code": "USD",
+            },
+            "create_timestamp": create_timestamp,
+        }
+        for buyer_user_id, state, amount, divisor, create_timestamp in zip(
+            table.buyer_user_id.tolist(),
+            table.state.tolist(),
+            table.amount.tolist(),
+            table.divisor.tolist(),
+            table.create_timestamp.tolist(),
+        )
+    ]
+
+
+def _to_timestamp(date):
+    """
+    Converts an ISO date string in UTC to a unix timestamp
+    """
+    return datetime.fromisoformat(date).replace(tzinfo=timezone.utc).timestamp()
+
+
+def _run_python(*args):
+    """
+    Runs a new Python process from this directory, so startup time counts
+    """
+    subprocess.run(
+        [sys.executable, *args],
+        check=True,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=subprocess.DEVNULL,
+    )
+
+
+def _environment():
+    """
+    Describes the machine and library versions the benchmarks ran with
+    """
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "time": datetime.now(timezone.utc).isoformat(),
+    }
+
+
+def main():
+    """
+    Runs the benchmarks from the command line and saves the results
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--functions", nargs="+", default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument(
+        "--baseline", help="Earlier results JSON to compare against"
+    )
+    args = parser.parse_args()
+
+    results = run_benchmarks(
+        sizes=args.sizes,
+        repeat=args.repeat,
+        functions=args.functions,
+        seed=args.seed,
+    )
+    api_lib.save_to_json(args.output, results)
+
+    for result in results["results"]:
+        print(
+            f"{result['function']:32} {result['input']:6}"
+            f" {result['num_orders']:>9} {result['seconds']:10.4f} s"
+            f" {result['peak_bytes'] / 1e6:10.1f} MB"
+        )
+
+    for speedup in parallel_speedups(results):
+        print(
+            f"{'analyze_parallel speedup':32} {speedup['input']:6}"
+            f" {speedup['num_orders']:>9} x{speedup['speedup']:.2f}"
+            f" on {results['environment']['cpu_count']} CPUs"
+        )
+
+    if args.baseline:
+        for change in compare_benchmarks(
+            api_lib.read_json(args.baseline), results
+        ):
+            print(
+                f"{change['function']:32} {change['input']:6}"
+                f" {change['num_orders']:>9}"
+                f" time x{change['seconds_ratio']:.2f}"
+                f" memory x{change['peak_bytes_ratio']:.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
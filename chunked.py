@@ -0,0 +1,542 @@
+"""
+Analyze order histories that don't fit in memory, one chunk at a time
+"""
+
+import itertools
+import os
+import numpy as np
+from analyze_data import (
+    data_frame,
+    mean_of_subtotal_sums,
+    mean_subtotal,
+    mixed_currency_error,
+    orders_per_customer,
+    reorder_rate_columns,
+)
+from api_lib import iter_orders
+from metrics import instrument
+from order_table import OrderTable, load_order_table, local_months
+
+DEFAULT_MEMORY_BUDGET = 256 * 2**20
+# Order dicts and their columns take a little over 1 kB per order while a
+# chunk is converted, so this leaves some headroom.
+_BYTES_PER_ORDER = 2048
+
+
+class PartialAggregates:
+    """
+    Mergeable tallies of a range of orders, enough to compute the metrics of
+    analyze_data without keeping the orders.
+
+    Orders are identified by their position in the whole data, so partial
+    aggregates of any ranges can be merged in any order and give the same
+    result. Buyer and pair arrays are sorted by buyer id, and states are
+    listed in the order they first appear. Subtotals are tallied per
+    currency and divisor, so subtotals of different currencies are never
+    added together.
+
+    Attributes:
+        num_orders: Int with how many orders were tallied
+        buyers: int64 array of the distinct buyer ids
+        first_index: int64 array with the position of each buyer's first
+        order
+        buyer_orders: int64 array with the number of orders of each buyer
+        first_amount: int64 array with the subtotal amount of each buyer's
+        first order
+        first_divisor: int64 array with the subtotal divisor of each buyer's
+        first order
+        first_currency: int64 array with the index into currencies of the
+        subtotal currency of each buyer's first order
+        first_month: int64 array with the local month of each buyer's first
+        order, counting from 0 for January
+        states: Object array of state names
+        state_first_index: int64 array with the position of the first order
+        to each state
+        state_orders: int64 array with the number of orders to each state
+        pair_buyer: int64 array with the buyer of each (buyer, state) pair
+        pair_state: int64 array with the index into states of each pair
+        pair_orders: int64 array with the number of orders of each pair
+        month_orders: int64 array with the number of orders in each month
+        currencies: Object array of subtotal currency codes, or [None] if
+        the orders have no currency codes
+        divisor_currency: int64 array with the index into currencies of each
+        distinct (currency, divisor) pair of the subtotals
+        divisors: int64 array with the divisor of each pair
+        divisor_amount: int64 array with the sum of the amounts of each pair
+        divisor_orders: int64 array with the number of orders of each pair
+    """
+
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self):
+        self.num_orders = 0
+        self.buyers = np.zeros(0, dtype=np.int64)
+        self.first_index = np.zeros(0, dtype=np.int64)
+        self.buyer_orders = np.zeros(0, dtype=np.int64)
+        self.first_amount = np.zeros(0, dtype=np.int64)
+        self.first_divisor = np.zeros(0, dtype=np.int64)
+        self.first_currency = np.zeros(0, dtype=np.int64)
+        self.first_month = np.zeros(0, dtype=np.int64)
+        self.states = np.empty(0, dtype=object)
+        self.state_first_index = np.zeros(0, dtype=np.int64)
+        self.state_orders = np.zeros(0, dtype=np.int64)
+        self.pair_buyer = np.zeros(0, dtype=np.int64)
+        self.pair_state = np.zeros(0, dtype=np.int64)
+        self.pair_orders = np.zeros(0, dtype=np.int64)
+        self.month_orders = np.zeros(12, dtype=np.int64)
+        self.currencies = np.empty(0, dtype=object)
+        self.divisor_currency = np.zeros(0, dtype=np.int64)
+        self.divisors = np.zeros(0, dtype=np.int64)
+        self.divisor_amount = np.zeros(0, dtype=np.int64)
+        self.divisor_orders = np.zeros(0, dtype=np.int64)
+
+    @classmethod
+    def from_table(cls, table, start=0, positions=None):
+        """
+        Tallies the orders in a table
+
+        Args:
+            table: OrderTable with every column loaded
+            start: Int with the position of the table's first order in the
+            whole data, if its orders are contiguous
+            positions: Optional int64 array with the position of each of the
+            table's orders in the whole data, in increasing order. Overrides
+            start if given.
+
+        Returns:
+            PartialAggregates of the table's orders
+        """
+        part = cls()
+        part.num_orders = len(table)
+        if positions is None:
+            positions = start + np.arange(len(table), dtype=np.int64)
+
+        buyers, first, buyer_index, buyer_orders = np.unique(
+            table.buyer_user_id,
+            return_index=True,
+            return_inverse=True,
+            return_counts=True,
+        )
+        month = local_months(table.create_timestamp) % 12
+        part.buyers = buyers.astype(np.int64)
+        part.first_index = positions[first]
+        part.buyer_orders = buyer_orders.astype(np.int64)
+        part.first_amount = table.amount[first].astype(np.int64)
+        part.first_divisor = table.divisor[first].astype(np.int64)
+        part.first_month = month[first]
+        part.month_orders = np.bincount(month, minlength=12)
+
+        if table.currency_codes is None:
+            currency_codes = np.zeros(len(table), dtype=np.int64)
+            currencies = np.array([None], dtype=object)
+        else:
+            currency_codes = table.currency_codes
+            currencies = table.currencies
+        used, currency_index = np.unique(currency_codes, return_inverse=True)
+        currency_index = currency_index.reshape(-1).astype(np.int64)
+        part.currencies = currencies[used]
+        part.first_currency = currency_index[first]
+
+        # Renumber the states used in this table by first appearance.
+        used, state_first, state_index, state_orders = np.unique(
+            table.state_codes,
+            return_index=True,
+            return_inverse=True,
+            return_counts=True,
+        )
+        order = np.argsort(state_first, kind="stable")
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order))
+        part.states = table.states[used[order]]
+        part.state_first_index = positions[state_first[order]]
+        part.state_orders = state_orders[order].astype(np.int64)
+
+        num_states = max(len(part.states), 1)
+        pairs, pair_orders = np.unique(
+            buyer_index.reshape(-1).astype(np.int64) * num_states
+            + rank[state_index.reshape(-1)],
+            return_counts=True,
+        )
+        part.pair_buyer = part.buyers[pairs // num_states]
+        part.pair_state = pairs % num_states
+        part.pair_orders = pair_orders.astype(np.int64)
+
+        divisor = table.divisor.astype(np.int64)
+        order, starts = _group(divisor, currency_index)
+        part.divisor_currency = currency_index[order[starts]]
+        part.divisors = divisor[order[starts]]
+        part.divisor_amount = _group_sum(
+            table.amount.astype(np.int64)[order], starts
+        )
+        part.divisor_orders = np.diff(starts, append=len(order))
+
+        return part
+
+    def merge(self, other):
+        """
+        Combines the tallies of two disjoint ranges of orders
+
+        Args:
+            other: PartialAggregates of orders not tallied in self
+
+        Returns:
+            PartialAggregates of the orders of both
+        """
+        return PartialAggregates.merge_all([self, other])
+
+    @classmethod
+    def merge_all(cls, parts):
+        """
+        Combines the tallies of any number of disjoint sets of orders at once
+
+        Every buyer array is concatenated and reordered once, so merging many
+        parts costs about as much as merging two of the same total size.
+
+        Args:
+            parts: List of PartialAggregates, no two tallying the same order
+
+        Returns:
+            PartialAggregates of the orders of every part
+        """
+        parts = [part for part in parts if part.num_orders > 0]
+        if len(parts) <= 1:
+            return parts[0] if parts else cls()
+
+        def concat(name):
+            return np.concatenate([getattr(part, name) for part in parts])
+
+        merged = cls()
+        merged.num_orders = sum(part.num_orders for part in parts)
+        merged.month_orders = sum(part.month_orders for part in parts)
+
+        # Number the currencies of every part by their name.
+        lookup = {}
+        currency_code = np.array(
+            [
+                lookup.setdefault(name, len(lookup))
+                for part in parts
+                for name in part.currencies
+            ],
+            dtype=np.int64,
+        )
+        merged.currencies = np.empty(len(lookup), dtype=object)
+        merged.currencies[:] = list(lookup)
+        currency_offsets = np.cumsum(
+            [0] + [len(part.currencies) for part in parts]
+        )
+
+        def concat_currency(name):
+            return np.concatenate(
+                [
+                    currency_code[offset:][getattr(part, name)]
+                    for offset, part in zip(currency_offsets, parts)
+                ]
+            )
+
+        # Keep the earliest first order of each buyer. Every part is sorted
+        # by buyer, so a stable sort merges them like sorted runs.
+        buyers = concat("buyers")
+        first_index = concat("first_index")
+        order = np.argsort(buyers, kind="stable")
+        starts = _run_starts(buyers[order])
+        sorted_first = first_index[order]
+        earliest = np.minimum.reduceat(sorted_first, starts)
+        take = order[
+            sorted_first == np.repeat(
+                earliest, np.diff(starts, append=len(order))
+            )
+        ]
+        for name in (
+            "buyers",
+            "first_index",
+            "first_amount",
+            "first_divisor",
+            "first_month",
+        ):
+            setattr(merged, name, concat(name)[take])
+        merged.first_currency = concat_currency("first_currency")[take]
+        merged.buyer_orders = _group_sum(concat("buyer_orders")[order], starts)
+
+        # Number the states of every part by their earliest first order.
+        names, name_index = np.unique(concat("states"), return_inverse=True)
+        name_index = name_index.reshape(-1)
+        state_first_index = np.full(
+            len(names), np.iinfo(np.int64).max, dtype=np.int64
+        )
+        np.minimum.at(
+            state_first_index, name_index, concat("state_first_index")
+        )
+        state_order = np.argsort(state_first_index, kind="stable")
+        rank = np.empty(len(state_order), dtype=np.int64)
+        rank[state_order] = np.arange(len(state_order))
+        state_code = rank[name_index]
+        merged.states = names[state_order]
+        merged.state_first_index = state_first_index[state_order]
+        merged.state_orders = np.zeros(len(names), dtype=np.int64)
+        np.add.at(merged.state_orders, state_code, concat("state_orders"))
+
+        # Renumber the states of each part, then add up matching pairs.
+        state_offsets = np.cumsum([0] + [len(part.states) for part in parts])
+        pair_state = np.concatenate(
+            [
+                state_code[offset:][part.pair_state]
+                for offset, part in zip(state_offsets, parts)
+            ]
+        )
+        pair_buyer = concat("pair_buyer")
+        pair_key = (
+            np.searchsorted(merged.buyers, pair_buyer) * max(len(names), 1)
+            + pair_state
+        )
+        order = np.argsort(pair_key, kind="stable")
+        starts = _run_starts(pair_key[order])
+        merged.pair_buyer = pair_buyer[order[starts]]
+        merged.pair_state = pair_state[order[starts]]
+        merged.pair_orders = _group_sum(concat("pair_orders")[order], starts)
+
+        divisors = concat("divisors")
+        divisor_currency = concat_currency("divisor_currency")
+        order, starts = _group(divisors, divisor_currency)
+        merged.divisor_currency = divisor_currency[order[starts]]
+        merged.divisors = divisors[order[starts]]
+        merged.divisor_amount = _group_sum(
+            concat("divisor_amount")[order], starts
+        )
+        merged.divisor_orders = _group_sum(
+            concat("divisor_orders")[order], starts
+        )
+
+        return merged
+
+    def results(self, currency=None):
+        """
+        Calculates the metrics of analyze_data from the tallies
+
+        Args:
+            currency: Optional currency code of the orders to average, as in
+            analyze_all. Needed when the orders are in more than one
+            currency.
+
+        Returns:
+            results (dict): The results of each function, keyed like
+            analyze_all: num_reorders, num_customers, single_order_value,
+            multiple_order_value, single_by_month, multiple_by_month,
+            state_list and state_reorder_df
+
+        Raises:
+            ValueError: If the orders are in more than one currency and no
+            currency is given, or if currency is given and the orders have no
+            currency codes
+        """
+        results = {}
+
+        results["num_reorders"], results["num_customers"] = orders_per_customer(
+            self.buyer_orders[np.argsort(self.first_index, kind="stable")]
+        )
+
+        # Repeat customer tallies are the totals minus the single orders,
+        # both in the currency being averaged.
+        is_single = self.buyer_orders == 1
+        in_currency = self._currency_code(currency)
+        tallied = self.divisor_currency == in_currency
+        divisors = self.divisors[tallied]
+        counted = is_single & (self.first_currency == in_currency)
+        single_amount = self.first_amount[counted]
+        single_divisor = self.first_divisor[counted]
+        multiple_amount = self.divisor_amount[tallied]
+        np.subtract.at(
+            multiple_amount,
+            np.searchsorted(divisors, single_divisor),
+            single_amount,
+        )
+        results["single_order_value"] = mean_subtotal(
+            single_amount, single_divisor
+        )
+        results["multiple_order_value"] = mean_of_subtotal_sums(
+            divisors,
+            multiple_amount,
+            self.divisor_orders[tallied].sum() - len(single_amount),
+        )
+
+        single_by_month = np.bincount(self.first_month[is_single], minlength=12)
+        results["single_by_month"] = single_by_month.tolist()
+        results["multiple_by_month"] = (
+            self.month_orders - single_by_month
+        ).tolist()
+
+        results["state_list"] = data_frame(
+            {"state": self.states, "number_of_orders": self.state_orders}
+        )
+        results["state_reorder_df"] = data_frame(
+            reorder_rate_columns(
+                self.states,
+                np.bincount(self.pair_state, minlength=len(self.states)),
+                np.bincount(
+                    self.pair_state[self.pair_orders > 1],
+                    minlength=len(self.states),
+                ),
+            )
+        )
+
+        return results
+
+    def _currency_code(self, currency):
+        """
+        Finds the index into currencies of the orders to average
+
+        Args:
+            currency: Currency code of the orders to average, or None if the
+            orders are in one currency
+
+        Returns:
+            Int with the index into currencies, or -1 if no order is in
+            currency
+        """
+        if currency is None:
+            if len(self.currencies) > 1:
+                raise mixed_currency_error(self.currencies)
+            return 0
+        if None in self.currencies:
+            raise ValueError("The orders have no currency codes to select by")
+        matches = np.flatnonzero(self.currencies == currency)
+        return matches[0] if len(matches) else -1
+
+
+def chunk_size_for_budget(memory_budget):
+    """
+    Finds how many orders can be read at once within a memory budget
+
+    Args:
+        memory_budget: Int with the number of bytes available for the orders
+        being read
+
+    Returns:
+        Int with the number of orders per chunk, at least 1
+    """
+    return max(int(memory_budget) // _BYTES_PER_ORDER, 1)
+
+
+def iter_order_chunks(source, chunk_size):
+    """
+    Yields the orders of source in tables of at most chunk_size orders
+
+    Args:
+        source: OrderTable, path of a directory saved by save_order_table,
+        or path of orders saved as a JSON array or newline-delimited JSON
+        chunk_size: Int with the most orders to yield at once
+
+    Yields:
+        start: Int with the position of the chunk's first order
+        table: OrderTable with the chunk's orders
+    """
+    if isinstance(source, OrderTable):
+        for start in range(0, len(source), chunk_size):
+            yield start, source.rows(start, start + chunk_size)
+        return
+
+    if os.path.isdir(source):
+        yield from iter_order_chunks(load_order_table(source), chunk_size)
+        return
+
+    orders = iter_orders(source)
+    start = 0
+    while True:
+        chunk = list(itertools.islice(orders, chunk_size))
+        if not chunk:
+            return
+        yield start, OrderTable.from_orders(chunk)
+        start += len(chunk)
+
+
+@instrument
+def analyze_chunked(
+    source, memory_budget=DEFAULT_MEMORY_BUDGET, chunk_size=None, currency=None
+):
+    """
+    Calculates the order, subtotal, month and state metrics of analyze_data
+    reading a fixed number of orders at a time
+
+    Only one chunk of orders is in memory at once. The tallies kept between
+    chunks grow with the number of distinct buyers, taking about 100 bytes
+    per buyer, rather than with the number of orders.
+
+    Args:
+        source: OrderTable, path of a directory saved by save_order_table,
+        or path of orders saved as a JSON array or newline-delimited JSON
+        memory_budget: Int with the number of bytes to use for the orders
+        being read
+        chunk_size: Int with the number of orders to read at once. Overrides
+        memory_budget if given.
+        currency: Optional currency code of the orders to average, as in
+        analyze_all. Needed when the orders are in more than one currency.
+
+    Returns:
+        results (dict): The same results as analyze_all for num_reorders,
+        num_customers, single_order_value, multiple_order_value,
+        single_by_month, multiple_by_month, state_list and state_reorder_df
+
+    Raises:
+        ValueError: If the orders are in more than one currency and no
+        currency is given
+    """
+    if chunk_size is None:
+        chunk_size = chunk_size_for_budget(memory_budget)
+
+    # Merge chunks as a balanced tree, like adding one to a binary counter,
+    # so each buyer's tallies are merged about log2(chunks) times rather than
+    # once per chunk.
+    merging = []
+    for start, table in iter_order_chunks(source, chunk_size):
+        num_chunks, part = 1, PartialAggregates.from_table(table, start)
+        while merging and merging[-1][0] == num_chunks:
+            num_chunks, part = 2 * num_chunks, merging.pop()[1].merge(part)
+        merging.append((num_chunks, part))
+
+    aggregates = PartialAggregates()
+    for _, part in reversed(merging):
+        aggregates = part.merge(aggregates)
+
+    return aggregates.results(currency)
+
+
+def _group(*keys):
+    """
+    Sorts rows by keys and finds where each distinct key starts
+
+    Args:
+        keys: Arrays of the same length, the last one sorting first
+
+    Returns:
+        order: int64 array of row positions sorted by key
+        starts: int64 array with the position in order of each distinct key
+    """
+    order = np.lexsort(keys)
+    return order, _run_starts(*(key[order] for key in keys))
+
+
+def _run_starts(*sorted_keys):
+    """
+    Finds where each run of equal keys starts in sorted arrays
+
+    Args:
+        sorted_keys: Arrays of the same length, sorted together
+
+    Returns:
+        int64 array with the position of the first row of each run
+    """
+    if len(sorted_keys[0]) == 0:
+        return np.zeros(0, dtype=np.int64)
+    is_new = np.zeros(len(sorted_keys[0]), dtype=bool)
+    is_new[0] = True
+    for key in sorted_keys:
+        is_new[1:] |= key[1:] != key[:-1]
+    return np.flatnonzero(is_new)
+
+
+def _group_sum(values, starts):
+    """
+    Sums runs of values that start at starts
+    """
+    if len(starts) == 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.add.reduceat(values, starts).astype(np.int64)
@@ -0,0 +1,197 @@
+"""
+Shared pytest fixtures, including a local stand-in for the Etsy API.
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+from urllib.parse import parse_qs, urlparse
+import pytest
+import api_lib
+
+STATES = ["CO", "VA", "TX", "MA", "CA"]
+
+
+def make_receipts(num_receipts, num_buyers=90, newest=1711485436):
+    """
+    Makes fake Etsy receipts, newest first like the receipts endpoint
+
+    Args:
+        num_receipts: Int with how many receipts to make
+        num_buyers: Int with how many different buyers place them
+        newest: Int unix timestamp of the newest receipt
+
+    Returns:
+        List of dicts in the format of the Etsy receipts endpoint
+    """
+    return [
+        {
+            "receipt_id": 5000 + index,
+            "buyer_user_id": 700000 + (index * 7) % num_buyers,
+            "name": f"Buyer {index}",
+            "state": STATES[index % len(STATES)],
+            "subtotal": {
+                "amount": 1000 + index,
+                "divisor": 100,
+                "currency_code": "USD",
+            },
+            "create_timestamp": newest - index * 3600,
+        }
+        for index in range(num_receipts)
+    ]
+
+
+class FakeEtsy:
+    """
+    In-memory Etsy shop served over HTTP by the fake_etsy fixture
+
+    Attributes:
+        receipts: List of receipt dicts, newest first
+        access_token: String with the only access token that is accepted
+        refresh_count: Int with how many times the token was refreshed
+        request_log: List of (method, path, query dict) of every request
+        errors: List of (status code, headers dict) to answer the next
+        receipts requests with, in order, before serving receipts again
+    """
+
+    def __init__(self, receipts):
+        self.receipts = receipts
+        self.access_token = "access-0"
+        self.refresh_count = 0
+        self.request_log = []
+        self.errors = []
+        self.lock = threading.Lock()
+
+    def receipts_page(self, query):
+        """
+        Returns the receipts endpoint response for the given query dict
+        """
+        limit = int(query.get("limit", ["25"])[0])
+        offset = int(query.get("offset", ["0"])[0])
+        receipts = self.receipts
+        if "min_created" in query:
+            min_created = int(query["min_created"][0])
+            receipts = [
+                receipt
+                for receipt in receipts
+                if receipt["create_timestamp"] >= min_created
+            ]
+        return {
+            "count": len(receipts),
+            "results": receipts[offset : offset + limit],
+        }
+
+    def refresh(self):
+        """
+        Issues a new access token and returns the token endpoint response
+        """
+        with self.lock:
+            self.refresh_count += 1
+            self.access_token = f"access-{self.refresh_count}"
+        return {
+            "access_token": self.access_token,
+            "refresh_token": f"refresh-{self.refresh_count}",
+        }
+
+
+def make_handler(shop):
+    """
+    Makes a request handler class that serves shop
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        """
+        Routes receipts and token requests to the FakeEtsy shop
+        """
+
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):  # pylint: disable=arguments-differ
+            pass
+
+        def send_json(self, status, body, headers=None):
+            """
+            Sends body as a JSON response with the given status code
+            """
+            payload = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):  # pylint: disable=invalid-name
+            """
+            Serves the receipts endpoint
+            """
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            with shop.lock:
+                shop.request_log.append(("GET", url.path, query))
+                error = shop.errors.pop(0) if shop.errors else None
+            if error is not None:
+                status, headers = error
+                self.send_json(status, {"error": "injected"}, headers)
+                return
+            expected = f"Bearer {shop.access_token}"
+            if self.headers.get("Authorization") != expected:
+                self.send_json(401, {"error": "invalid_token"})
+                return
+            self.send_json(200, shop.receipts_page(query))
+
+        def do_POST(self):  # pylint: disable=invalid-name
+            """
+            Serves the token endpoint
+            """
+            url = urlparse(self.path)
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            with shop.lock:
+                shop.request_log.append(("POST", url.path, {}))
+            self.send_json(200, shop.refresh())
+
+    return Handler
+
+
+@pytest.fixture(name="fake_etsy")
+def fixture_fake_etsy(monkeypatch):
+    """
+    Serves a FakeEtsy shop on localhost and points api_lib at it
+    """
+    shop = FakeEtsy(make_receipts(250))
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(shop))
+    thread = threading.Thread(
+        target=server.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True
+    )
+    thread.start()
+
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    monkeypatch.setattr(api_lib, "API_URL", url)
+    monkeypatch.setattr(api_lib, "TOKEN_URL", f"{url}/oauth/token")
+
+    yield shop
+
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(name="key_path")
+def fixture_key_path(tmp_path):
+    """
+    Writes a keys.json that the fake_etsy shop accepts and returns its path
+    """
+    path = tmp_path / "keys.json"
+    path.write_text(
+        json.dumps(
+            {
+                "access_token": "access-0",
+                "token_type": "Bearer",
+                "expires_in": 3600,
+                "refresh_token": "refresh-0",
+                "keystring": "test-keystring",
+            }
+        ),
+        encoding="utf-8",
+    )
+    return str(path)
@@ -0,0 +1,166 @@
+"""
+Score customers by recency, frequency and monetary value and estimate their
+lifetime value
+"""
+
+import numpy as np
+from analyze_data import currency_mask, data_frame
+from metrics import instrument
+from money import divide, sum_by_group
+from order_table import SECONDS_PER_DAY, as_order_table, factorize
+
+DAYS_PER_YEAR = 365.25
+
+
+@instrument
+def calculate_customer_value(
+    orders,
+    bins=5,
+    horizon_years=3,
+    as_of=None,
+    start=None,
+    end=None,
+    outliers=None,
+    currency=None,
+):
+    """
+    Calculates RFM scores and a predicted lifetime value for every customer.
+
+    Orders are grouped by customer once, so the work after grouping and the
+    memory of the result only grow with the number of customers. Each score
+    runs from 1 to bins and is higher for better customers: bins times the
+    share of customers with a worse value, rounded down, plus one. Customers
+    with the same value get the same score.
+
+    The predicted lifetime value is a customer's average order value times
+    their orders per year times horizon_years. Orders per year are counted
+    over at least one year, so a new customer's rate isn't extrapolated from
+    a few days.
+
+    Args:
+        orders (iterable or OrderTable): All order data, such as a list of
+        order dicts or the output of iter_orders
+        bins (int): The number of score levels, from 1 to 9
+        horizon_years (float): The number of years to predict value for
+        as_of (int): Unix timestamp to measure recency and tenure from.
+        Defaults to the time of the last order.
+        start (int): Optional unix timestamp, orders created before it are
+        left out
+        end (int): Optional unix timestamp, orders created at or after it are
+        left out
+        outliers (OutlierFilter or list): Optional rules, or buyer ids, of the
+        customers whose orders are left out
+        currency (str): Currency code of the subtotals to total, such as
+        "USD". Needed when the orders are in more than one currency.
+
+    Returns:
+        customer_df (df): A DataFrame with a row for each customer, in the
+        order customers first appear, of the buyer_user_id, recency_days since
+        their last order, frequency of orders, monetary total of their
+        subtotals, r_score, f_score, m_score, rfm_score with the three scores
+        as digits, and predicted clv
+
+    Raises:
+        ValueError: If bins is out of range, or the orders are in more than
+        one currency and no currency is given
+    """
+    if not 1 <= bins <= 9:
+        raise ValueError(f"bins must be from 1 to 9, got {bins}")
+
+    table = as_order_table(
+        orders,
+        "buyer_user_id",
+        "subtotal",
+        "create_timestamp",
+        start=start,
+        end=end,
+        outliers=outliers,
+    )
+    buyer_codes, customers = factorize(table.buyer_user_id)
+    num_customers = len(customers)
+    if as_of is None:
+        as_of = int(table.create_timestamp.max()) if len(table) > 0 else 0
+
+    frequency = np.bincount(buyer_codes, minlength=num_customers)
+    monetary = sum_subtotals(buyer_codes, table, num_customers, currency)
+    first_order = np.full(num_customers, np.iinfo(np.int64).max)
+    np.minimum.at(first_order, buyer_codes, table.create_timestamp)
+    last_order = np.full(num_customers, np.iinfo(np.int64).min)
+    np.maximum.at(last_order, buyer_codes, table.create_timestamp)
+
+    recency_days = (as_of - last_order) / SECONDS_PER_DAY
+    tenure_years = np.maximum(
+        (as_of - first_order) / SECONDS_PER_DAY / DAYS_PER_YEAR, 1
+    )
+    r_score = _quantile_scores(-recency_days, bins)
+    f_score = _quantile_scores(frequency, bins)
+    m_score = _quantile_scores(monetary, bins)
+
+    return data_frame(
+        {
+            "buyer_user_id": customers,
+            "recency_days": recency_days,
+            "frequency": frequency,
+            "monetary": monetary,
+            "r_score": r_score,
+            "f_score": f_score,
+            "m_score": m_score,
+            "rfm_score": (
+                r_score.astype(np.int16) * 100
+                + f_score.astype(np.int16) * 10
+                + m_score
+            ),
+            "clv": monetary / tenure_years * horizon_years,
+        }
+    )
+
+
+def sum_subtotals(buyer_codes, table, num_customers, currency=None):
+    """
+    Sums the subtotals of each customer's orders in whole currency units.
+
+    Amounts are summed as integers at a common divisor and divided once per
+    customer, so totals don't pick up a rounding error from every order, and
+    subtotals of different currencies are never added together.
+
+    Args:
+        buyer_codes (array): The code of the customer that placed each order
+        table (OrderTable): Order data with subtotals
+        num_customers (int): The number of customer codes
+        currency (str): Optional currency code of the subtotals to total
+
+    Returns:
+        totals (array): The total subtotal of each customer in currency
+
+    Raises:
+        ValueError: If the orders are in more than one currency and no
+        currency is given
+    """
+    in_currency = currency_mask(table, currency)
+    amount, divisor = table.amount, table.divisor
+    if in_currency is not None:
+        buyer_codes = buyer_codes[in_currency]
+        amount, divisor = amount[in_currency], divisor[in_currency]
+
+    sums, _, common = sum_by_group(amount, divisor, buyer_codes, num_customers)
+    return divide(sums, common)
+
+
+def _quantile_scores(values, bins):
+    """
+    Scores values from 1 to bins by the share of values below each one.
+
+    Args:
+        values (array): Values where higher is better
+        bins (int): The number of score levels
+
+    Returns:
+        scores (array): int8 score of each value
+    """
+    if len(values) == 0:
+        return np.zeros(0, dtype=np.int8)
+
+    below = np.searchsorted(np.sort(values), values, side="left")
+    scores = below * bins // len(values) + 1
+
+    return scores.astype(np.int8)
@@ -0,0 +1,146 @@
+"""
+Persistent mapping from real Etsy buyer ids to anonymized ids
+"""
+
+import sqlite3
+
+
+class IdMap:
+    """
+    Dict-like mapping from real buyer ids to anonymized ids stored in SQLite
+
+    New ids are kept in memory and written to the database in batches, so
+    anonymizing a long stream of orders doesn't need one write per buyer or
+    the whole mapping in memory. Lookups go through the in-memory batch and
+    then the table's integer primary key index.
+
+    The database also keeps the ids of the receipts created in the newest
+    second of the saved orders, so sync_orders can ask for that second again
+    without saving its receipts twice.
+
+    Attributes:
+        file_path: String with path to the SQLite database file
+        batch_size: Int with how many new ids to hold before writing them
+    """
+
+    def __init__(self, file_path, batch_size=10000):
+        self.file_path = file_path
+        self.batch_size = batch_size
+        self._connection = sqlite3.connect(file_path)
+        self._connection.executescript(
+            "CREATE TABLE IF NOT EXISTS id_map ("
+            "buyer_user_id INTEGER PRIMARY KEY, new_id INTEGER NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS newest_receipts ("
+            "receipt_id INTEGER PRIMARY KEY, create_timestamp INTEGER NOT NULL)"
+        )
+        self._pending = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        self.flush()
+        return self._connection.execute(
+            "SELECT COUNT(*) FROM id_map"
+        ).fetchone()[0]
+
+    def __contains__(self, buyer_user_id):
+        return self.get(buyer_user_id) is not None
+
+    def __getitem__(self, buyer_user_id):
+        new_id = self.get(buyer_user_id)
+        if new_id is None:
+            raise KeyError(buyer_user_id)
+        return new_id
+
+    def __setitem__(self, buyer_user_id, new_id):
+        self._pending[buyer_user_id] = new_id
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def get(self, buyer_user_id, default=None):
+        """
+        Returns the anonymized id of buyer_user_id, or default if it has none
+        """
+        if buyer_user_id in self._pending:
+            return self._pending[buyer_user_id]
+        row = self._connection.execute(
+            "SELECT new_id FROM id_map WHERE buyer_user_id = ?",
+            (buyer_user_id,),
+        ).fetchone()
+        return default if row is None else row[0]
+
+    def items(self):
+        """
+        Returns a list of (real id, anonymized id) pairs ordered by new id
+        """
+        self.flush()
+        return self._connection.execute(
+            "SELECT buyer_user_id, new_id FROM id_map ORDER BY new_id"
+        ).fetchall()
+
+    def add_receipts(self, receipts):
+        """
+        Remembers the receipts created in the newest second seen so far
+
+        Args:
+            receipts: Iterable of receipt dicts from the receipts endpoint
+        """
+        rows = [
+            (receipt["receipt_id"], receipt["create_timestamp"])
+            for receipt in receipts
+            if "receipt_id" in receipt
+        ]
+        if not rows:
+            return
+        newest = max(timestamp for _, timestamp in rows)
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO newest_receipts VALUES (?, ?)",
+                [row for row in rows if row[1] == newest],
+            )
+            self._connection.execute(
+                "DELETE FROM newest_receipts WHERE create_timestamp < "
+                "(SELECT MAX(create_timestamp) FROM newest_receipts)"
+            )
+
+    def saved_receipts(self, create_timestamp):
+        """
+        Returns the ids of the remembered receipts created at a time
+
+        Args:
+            create_timestamp: Int unix timestamp of the newest saved order
+
+        Returns:
+            Set of receipt ids, empty if none were remembered for that second
+        """
+        return {
+            receipt_id
+            for (receipt_id,) in self._connection.execute(
+                "SELECT receipt_id FROM newest_receipts "
+                "WHERE create_timestamp = ?",
+                (create_timestamp,),
+            )
+        }
+
+    def flush(self):
+        """
+        Writes all new ids held in memory to the database
+        """
+        if self._pending:
+            with self._connection:
+                self._connection.executemany(
+                    "INSERT OR REPLACE INTO id_map VALUES (?, ?)",
+                    self._pending.items(),
+                )
+            self._pending = {}
+
+    def close(self):
+        """
+        Writes any new ids and closes the database
+        """
+        self.flush()
+        self._connection.close()
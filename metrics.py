@@ -0,0 +1,345 @@
+"""
+Record how long each stage of fetching and analyzing orders takes
+
+Instrumentation is off until a sink is set, and every hook then returns right
+away. To record, wrap the work in `recording`:
+
+    from metrics import JsonLinesSink, recording
+
+    with recording(JsonLinesSink("metrics.jsonl")):
+        get_all_orders(...)
+
+Each stage, such as a get_orders call or an analyze_data function, then adds
+a record with its name, wall time, peak memory and how much every counter,
+such as http_requests or rows, went up while it ran.
+"""
+
+from contextlib import contextmanager
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+# Counters included in every record, even when they didn't go up
+COUNTERS = (
+    "http_requests",
+    "retries",
+    "token_refreshes",
+    "bytes_downloaded",
+    "rows",
+)
+
+_sink = None
+_counters = dict.fromkeys(COUNTERS, 0)
+_counters_lock = threading.Lock()
+_local = threading.local()
+
+
+class MemorySink:
+    """
+    Keeps every record in a list
+
+    Attributes:
+        records: List of record dicts, in the order stages finished
+    """
+
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+
+    def emit(self, record):
+        """
+        Adds a finished stage's record
+        """
+        with self._lock:
+            self.records.append(record)
+
+
+class JsonLinesSink:
+    """
+    Appends every record to a file as one line of compact JSON
+
+    Attributes:
+        file_path: String with path to the file to append to
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self._lock = threading.Lock()
+
+    def emit(self, record):
+        """
+        Appends a finished stage's record
+        """
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        with self._lock:
+            with open(self.file_path, "a", encoding="utf-8") as file:
+                file.write(line)
+
+
+class PrometheusSink:
+    """
+    Keeps running totals for each stage in a Prometheus text format file
+
+    The file is rewritten whenever a stage finishes, so a node exporter
+    textfile collector always reads complete totals.
+
+    Attributes:
+        file_path: String with path to the .prom file to write
+        prefix: String put in front of every metric name
+    """
+
+    def __init__(self, file_path, prefix="shop_analysis"):
+        self.file_path = file_path
+        self.prefix = prefix
+        self._totals = {}
+        self._lock = threading.Lock()
+
+    def emit(self, record):
+        """
+        Adds a finished stage's record to its stage's totals and rewrites
+        the file
+        """
+        with self._lock:
+            totals = self._totals.setdefault(
+                record["stage"], {"runs": 0, "seconds": 0.0}
+            )
+            totals["runs"] += 1
+            totals["seconds"] += record["seconds"]
+            for name, value in record.items():
+                if name in ("stage", "start_time", "seconds", "peak_bytes"):
+                    continue
+                totals[name] = totals.get(name, 0) + value
+            if record["peak_bytes"] is not None:
+                totals["peak_bytes"] = max(
+                    totals.get("peak_bytes", 0), record["peak_bytes"]
+                )
+            self._write()
+
+    def _write(self):
+        """
+        Writes every stage's totals to a temporary file and moves it in
+        place
+        """
+        names = sorted(
+            {name for totals in self._totals.values() for name in totals}
+        )
+        lines = []
+        for name in names:
+            metric = f"{self.prefix}_stage_{name}"
+            if name == "peak_bytes":
+                kind = "gauge"
+            else:
+                metric += "_total"
+                kind = "counter"
+            lines.append(f"# TYPE {metric} {kind}")
+            for stage_name, totals in sorted(self._totals.items()):
+                if name in totals:
+                    lines.append(
+                        f'{metric}{{stage="{_escape(stage_name)}"}}'
+                        f" {totals[name]}"
+                    )
+
+        partial_path = self.file_path + ".partial"
+        with open(partial_path, "w", encoding="utf-8") as file:
+            file.write("\n".join(lines) + "\n")
+        os.replace(partial_path, self.file_path)
+
+
+def enabled():
+    """
+    Returns True if a sink is set and stages are being recorded
+    """
+    return _sink is not None
+
+
+def set_sink(sink):
+    """
+    Sends records to sink from now on, or turns recording off if sink is None
+
+    Args:
+        sink: Object with an emit(record) method, such as a MemorySink, or
+        None
+
+    Returns:
+        The sink that was set before
+    """
+    global _sink  # pylint: disable=global-statement
+    previous, _sink = _sink, sink
+    return previous
+
+
+@contextmanager
+def recording(sink, trace_memory=False):
+    """
+    Records stages to sink inside the with block
+
+    Args:
+        sink: Object with an emit(record) method, such as a MemorySink
+        trace_memory: If True, trace memory allocations so records include
+        peak_bytes. Tracing makes Python code a few times slower.
+
+    Yields:
+        The sink
+    """
+    previous = set_sink(sink)
+    start_tracing = trace_memory and not tracemalloc.is_tracing()
+    if start_tracing:
+        tracemalloc.start()
+    try:
+        yield sink
+    finally:
+        if start_tracing:
+            tracemalloc.stop()
+        set_sink(previous)
+
+
+def increment(counter, amount=1):
+    """
+    Adds amount to a counter, such as http_requests, if recording
+
+    Args:
+        counter: String with the counter's name
+        amount: Int to add
+    """
+    if _sink is None:
+        return
+    with _counters_lock:
+        _counters[counter] = _counters.get(counter, 0) + amount
+
+
+def stage(name):
+    """
+    Returns a context manager that records the stage it wraps
+
+    Stages can be nested. Counters are shared by every thread, so a stage
+    counts everything that happened while it ran, including in threads it
+    waited on. Peak memory is only recorded while tracemalloc is tracing and
+    is the most memory allocated above what was allocated when the stage
+    started.
+
+    Args:
+        name: String with the stage's name, such as the function it times
+
+    Returns:
+        Context manager for a with block
+    """
+    if _sink is None:
+        return _NULL_STAGE
+    return _Stage(name, _sink)
+
+
+def instrument(function=None, name=None):
+    """
+    Decorates a function so each call is recorded as a stage
+
+    Can be used as @instrument or @instrument(name="stage name").
+
+    Args:
+        function: The function to decorate
+        name: String with the stage's name. Defaults to the function's name.
+
+    Returns:
+        The decorated function, or a decorator if function isn't given
+    """
+    if function is None:
+        return functools.partial(instrument, name=name)
+
+    stage_name = function.__qualname__ if name is None else name
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if _sink is None:
+            return function(*args, **kwargs)
+        with _Stage(stage_name, _sink):
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+class _NullStage:
+    """
+    Stage that records nothing, used while recording is off
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    """
+    Measures one run of a stage and emits its record when it ends
+    """
+
+    def __init__(self, name, sink):
+        self.name = name
+        self.sink = sink
+        self.child_peak = 0
+
+    def __enter__(self):
+        stack = _stage_stack()
+        self.tracing = tracemalloc.is_tracing()
+        if self.tracing:
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                # Keep the parent's peak before measuring this stage's own.
+                stack[-1].child_peak = max(stack[-1].child_peak, peak)
+            tracemalloc.reset_peak()
+            self.start_memory = current
+        stack.append(self)
+
+        with _counters_lock:
+            self.start_counters = dict(_counters)
+        self.start_time = time.time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self.start
+        with _counters_lock:
+            counters = dict(_counters)
+
+        stack = _stage_stack()
+        stack.pop()
+        peak_bytes = None
+        if self.tracing and tracemalloc.is_tracing():
+            peak = max(tracemalloc.get_traced_memory()[1], self.child_peak)
+            peak_bytes = max(peak - self.start_memory, 0)
+            if stack:
+                stack[-1].child_peak = max(stack[-1].child_peak, peak)
+
+        record = {
+            "stage": self.name,
+            "start_time": self.start_time,
+            "seconds": seconds,
+            "peak_bytes": peak_bytes,
+        }
+        for counter, value in counters.items():
+            record[counter] = value - self.start_counters.get(counter, 0)
+        self.sink.emit(record)
+        return False
+
+
+def _stage_stack():
+    """
+    Returns the list of stages running in this thread, innermost last
+    """
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def _escape(value):
+    """
+    Escapes a Prometheus label value
+    """
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
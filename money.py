@@ -0,0 +1,130 @@
+"""
+Exact sums and averages of order subtotals kept as integer minor units
+"""
+
+import math
+import numpy as np
+
+
+def common_divisor(divisors):
+    """
+    Finds the smallest divisor every subtotal divisor divides evenly
+
+    Args:
+        divisors: Iterable of positive integer divisors, such as 100 for
+        amounts in cents
+
+    Returns:
+        Int with the least common multiple of the divisors, or 1 if there
+        are none
+    """
+    return math.lcm(1, *(int(divisor) for divisor in divisors))
+
+
+def sum_by_group(amount, divisor, group_codes, num_groups):
+    """
+    Sums subtotals in each group as integers at one common divisor
+
+    Every amount is scaled to the common divisor of all the divisors, so the
+    sums are exact and no division happens until the sums are turned into
+    whole currency units. If the sums could overflow int64, they are added as
+    Python ints instead, which is slower but never wraps around.
+
+    Args:
+        amount (array): Integer subtotal amounts
+        divisor (array): Integer divisor of each amount
+        group_codes (array): Int array with the group of each amount, from 0
+        up to num_groups
+        num_groups (int): The number of groups
+
+    Returns:
+        sums (array): int64 array with the sum of each group's amounts at the
+        common divisor, or an object array of Python ints if int64 could
+        overflow
+        counts (array): int64 array with how many amounts each group has
+        common (int): The common divisor of the sums
+    """
+    amount = np.asarray(amount, dtype=np.int64)
+    divisor = np.asarray(divisor, dtype=np.int64)
+    divisors = np.unique(divisor)
+    common = common_divisor(divisors)
+    counts = np.bincount(group_codes, minlength=num_groups).astype(np.int64)
+
+    # The largest possible sum is every amount at its largest, scaled up
+    # from the smallest divisor.
+    int64_max = np.iinfo(np.int64).max
+    largest = int(np.abs(amount).max()) if len(amount) else 0
+    smallest = int(divisors[0]) if len(divisors) else 1
+    if (
+        common <= int64_max
+        and largest * (common // smallest) * len(amount) <= int64_max
+    ):
+        scaled = amount * (common // divisor)
+        sums = np.zeros(num_groups, dtype=np.int64)
+    else:
+        scaled = np.array(
+            [
+                value * (common // scale)
+                for value, scale in zip(amount.tolist(), divisor.tolist())
+            ],
+            dtype=object,
+        )
+        sums = np.zeros(num_groups, dtype=object)
+    np.add.at(sums, group_codes, scaled)
+    return sums, counts, common
+
+
+def divide(sums, divisors):
+    """
+    Divides integer sums by integer divisors, rounding each result once
+
+    Python divides ints exactly before rounding to the nearest float, unlike
+    NumPy, which first converts both ints to floats. Ints up to 2**53 convert
+    to floats exactly, so NumPy divides those, and Python the rest.
+
+    Args:
+        sums (array): Integer sums
+        divisors (array or int): Integer divisor of each sum, or one divisor
+        for all of them
+
+    Returns:
+        float array with each sum divided by its divisor, and NaN where the
+        divisor is zero
+    """
+    sums = np.asarray(sums)
+    divisors = np.broadcast_to(np.asarray(divisors), sums.shape)
+    if sums.dtype != object and divisors.dtype != object and sums.size:
+        exact = 2**53
+        if np.abs(sums).max() <= exact and np.abs(divisors).max() <= exact:
+            quotients = np.full(sums.shape, math.nan)
+            np.divide(sums, divisors, out=quotients, where=divisors != 0)
+            return quotients
+
+    return np.array(
+        [
+            total / count if count else math.nan
+            for total, count in zip(sums.tolist(), divisors.tolist())
+        ],
+        dtype=float,
+    )
+
+
+def mean_of_sums(divisors, sums, count):
+    """
+    Averages subtotals kept as integer sums per divisor, dividing only once
+
+    Args:
+        divisors (array): Distinct integer divisors
+        sums (array): The sum of the amounts with each divisor
+        count (int): The number of amounts summed
+
+    Returns:
+        mean (float): The average subtotal in whole currency units, or NaN if
+        count is zero
+    """
+    common = common_divisor(divisors)
+    total = sum(
+        int(amount_sum) * (common // int(divisor))
+        for divisor, amount_sum in zip(divisors, sums)
+    )
+    return divide([total], [common * count])[0]
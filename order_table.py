@@ -0,0 +1,609 @@
+"""
+Columnar, NumPy-backed storage for cleaned Etsy order data
+"""
+
+import bisect
+from datetime import datetime
+import os
+import time
+import numpy as np
+from api_lib import iter_orders, read_json, save_to_json
+import metrics
+
+COLUMNS = ("buyer_user_id", "state", "subtotal", "create_timestamp")
+
+SECONDS_PER_DAY = 86400
+# Time zone changes happen on the minute
+_OFFSET_STEP = 60
+
+
+class OrderTable:
+    """
+    Cleaned order data stored as one typed array per field.
+
+    States are stored as categorical codes into the states array, which lists
+    each state name once in the order it first appears in the data, and
+    currencies are stored the same way. Columns that were not loaded are None.
+
+    Attributes:
+        buyer_user_id: int64 array of anonymized buyer ids
+        state_codes: int32 array of indices into states
+        states: Object array of state names
+        amount: int64 array of subtotal amounts
+        divisor: int64 array of subtotal divisors
+        currency_codes: int32 array of indices into currencies
+        currencies: Object array of subtotal currency codes, with an empty
+        string for orders that have none
+        create_timestamp: int64 array of unix timestamps
+    """
+
+    def __init__(
+        self,
+        buyer_user_id=None,
+        state_codes=None,
+        states=None,
+        amount=None,
+        divisor=None,
+        create_timestamp=None,
+        currency_codes=None,
+        currencies=None,
+    ):
+        # pylint: disable=too-many-arguments
+        self.buyer_user_id = buyer_user_id
+        self.state_codes = state_codes
+        self.states = states
+        self.amount = amount
+        self.divisor = divisor
+        self.currency_codes = currency_codes
+        self.currencies = currencies
+        self.create_timestamp = create_timestamp
+        self._time_index = None
+
+    def __len__(self):
+        for column in (
+            self.buyer_user_id,
+            self.state_codes,
+            self.amount,
+            self.create_timestamp,
+        ):
+            if column is not None:
+                return len(column)
+        return 0
+
+    @classmethod
+    def from_orders(cls, orders, columns=COLUMNS):
+        """
+        Builds a table from cleaned order dicts in a single pass
+
+        Args:
+            orders: Iterable of dicts in the format saved by clean_anonymize,
+            such as the output of read_json
+            columns: Tuple of order keys to load. Keys that are left out
+            don't need to exist in the order dicts.
+
+        Returns:
+            OrderTable holding the requested columns
+        """
+        want_buyer = "buyer_user_id" in columns
+        want_state = "state" in columns
+        want_subtotal = "subtotal" in columns
+        want_timestamp = "create_timestamp" in columns
+
+        buyer_user_id = []
+        state_codes = []
+        state_lookup = {}
+        amount = []
+        divisor = []
+        currency_codes = []
+        currency_lookup = {}
+        create_timestamp = []
+
+        for order in orders:
+            if want_buyer:
+                buyer_user_id.append(order["buyer_user_id"])
+            if want_state:
+                state_codes.append(
+                    state_lookup.setdefault(order["state"], len(state_lookup))
+                )
+            if want_subtotal:
+                subtotal = order["subtotal"]
+                amount.append(subtotal["amount"])
+                divisor.append(subtotal["divisor"])
+                currency_codes.append(
+                    currency_lookup.setdefault(
+                        subtotal.get("currency_code", ""), len(currency_lookup)
+                    )
+                )
+            if want_timestamp:
+                create_timestamp.append(order["create_timestamp"])
+
+        table = cls()
+        if want_buyer:
+            table.buyer_user_id = np.array(buyer_user_id, dtype=np.int64)
+        if want_state:
+            table.state_codes = np.array(state_codes, dtype=np.int32)
+            table.states = np.empty(len(state_lookup), dtype=object)
+            table.states[:] = list(state_lookup)
+        if want_subtotal:
+            table.amount = np.array(amount, dtype=np.int64)
+            table.divisor = np.array(divisor, dtype=np.int64)
+            table.currency_codes = np.array(currency_codes, dtype=np.int32)
+            table.currencies = np.empty(len(currency_lookup), dtype=object)
+            table.currencies[:] = list(currency_lookup)
+        if want_timestamp:
+            table.create_timestamp = np.array(create_timestamp, dtype=np.int64)
+
+        return table
+
+    @property
+    def state(self):
+        """
+        Object array with the state name of each order
+        """
+        return self.states[self.state_codes]
+
+    @property
+    def currency(self):
+        """
+        Object array with the currency code of each order
+        """
+        return self.currencies[self.currency_codes]
+
+    @property
+    def subtotal(self):
+        """
+        Float array with the subtotal of each order in whole currency units
+        """
+        return self.amount / self.divisor
+
+    @property
+    def time_index(self):
+        """
+        TimeIndex over create_timestamp, built the first time it's used
+        """
+        if self._time_index is None:
+            self._time_index = TimeIndex(self.create_timestamp)
+        return self._time_index
+
+    def window(self, start=None, end=None):
+        """
+        Selects the orders created in a time window
+
+        Args:
+            start: Optional unix timestamp, orders created before it are left
+            out
+            end: Optional unix timestamp, orders created at or after it are
+            left out
+
+        Returns:
+            OrderTable with the orders in the window, in their original
+            order. The columns are views when the orders are sorted by time.
+        """
+        return self.take(self.time_index.positions(start, end))
+
+    def rows(self, start, stop):
+        """
+        Selects a range of orders without copying the columns
+
+        Args:
+            start: Int with the position of the first order to select
+            stop: Int with the position after the last order to select
+
+        Returns:
+            OrderTable with views of the selected rows of each loaded column
+        """
+        return self.take(slice(start, stop))
+
+    def take(self, index):
+        """
+        Selects orders by position
+
+        Args:
+            index: Slice, or int64 array of the positions of the orders to
+            select
+
+        Returns:
+            OrderTable with the selected rows of each loaded column, as views
+            for a slice and as copies for an array
+        """
+
+        def select(column):
+            return None if column is None else column[index]
+
+        return OrderTable(
+            buyer_user_id=select(self.buyer_user_id),
+            state_codes=select(self.state_codes),
+            states=self.states,
+            amount=select(self.amount),
+            divisor=select(self.divisor),
+            create_timestamp=select(self.create_timestamp),
+            currency_codes=select(self.currency_codes),
+            currencies=self.currencies,
+        )
+
+
+class TimeIndex:
+    """
+    Index of order timestamps for finding the orders in a time window with
+    binary search.
+
+    Orders saved from the Etsy API are sorted newest first, so the
+    timestamps are usually searched in place and a window is a range of
+    positions. Otherwise the index keeps the positions of the orders sorted
+    by time.
+
+    Attributes:
+        direction: 1 if the timestamps are sorted oldest first, -1 if newest
+        first and 0 if they aren't sorted
+        order: int64 array of positions sorted by time, or None if the
+        timestamps are sorted
+        sorted_timestamp: int64 array of timestamps sorted oldest first
+    """
+
+    def __init__(self, create_timestamp):
+        steps = np.diff(create_timestamp)
+        self.order = None
+        if (steps >= 0).all():
+            self.direction = 1
+            self.sorted_timestamp = create_timestamp
+        elif (steps <= 0).all():
+            self.direction = -1
+            self.sorted_timestamp = create_timestamp[::-1]
+        else:
+            self.direction = 0
+            self.order = np.argsort(create_timestamp, kind="stable")
+            self.sorted_timestamp = create_timestamp[self.order]
+
+    def positions(self, start=None, end=None):
+        """
+        Finds the orders created from start up to end
+
+        Args:
+            start: Optional unix timestamp of the start of the window
+            end: Optional unix timestamp of the end of the window, which is
+            not included
+
+        Returns:
+            Slice of the positions of the orders in the window if the
+            timestamps are sorted, otherwise an int64 array of the positions
+            in increasing order
+        """
+        timestamps = self.sorted_timestamp
+        low = 0 if start is None else np.searchsorted(timestamps, start)
+        high = (
+            len(timestamps) if end is None else np.searchsorted(timestamps, end)
+        )
+        low, high = int(low), int(max(low, high))
+
+        if self.direction == 1:
+            return slice(low, high)
+        if self.direction == -1:
+            return slice(len(timestamps) - high, len(timestamps) - low)
+        return np.sort(self.order[low:high])
+
+
+class CustomerTimeline:
+    """
+    Order times grouped by customer and sorted, stored as flat arrays.
+
+    The orders of the customer customers[i] are at positions starts[i] up to
+    starts[i + 1] of create_timestamp, oldest first.
+
+    Attributes:
+        customers: Array of customer ids in the order they first appear
+        starts: int64 array with the position of each customer's first order,
+        followed by the number of orders
+        create_timestamp: int64 array of unix timestamps sorted by customer,
+        then time
+    """
+
+    def __init__(self, customers, starts, create_timestamp):
+        self.customers = customers
+        self.starts = starts
+        self.create_timestamp = create_timestamp
+
+    def __len__(self):
+        return len(self.customers)
+
+    @classmethod
+    def from_codes(cls, buyer_codes, customers, timestamps):
+        """
+        Groups and sorts order times by customer with a single sort
+
+        Args:
+            buyer_codes: int64 array with the code of the customer that placed
+            each order, numbered in the order customers first appear
+            customers: Array with the id of the customer with each code
+            timestamps: int64 array with the unix timestamp of each order
+
+        Returns:
+            CustomerTimeline of the orders
+        """
+        order = np.lexsort((timestamps, buyer_codes))
+        starts = np.searchsorted(
+            buyer_codes[order], np.arange(len(customers) + 1)
+        )
+        return cls(customers, starts, np.asarray(timestamps)[order])
+
+    @property
+    def num_orders(self):
+        """
+        int64 array with the number of orders of each customer
+        """
+        return np.diff(self.starts)
+
+    def to_dict(self):
+        """
+        Converts the timeline to a dict of datetimes
+
+        Returns:
+            Dict linking customer ids to a list of their order times as
+            sorted local datetimes
+        """
+        times = [
+            datetime.fromtimestamp(timestamp)
+            for timestamp in self.create_timestamp.tolist()
+        ]
+        bounds = self.starts.tolist()
+        return {
+            customer: times[start:end]
+            for customer, start, end in zip(
+                self.customers.tolist(), bounds[:-1], bounds[1:]
+            )
+        }
+
+
+def as_order_table(orders, *columns, start=None, end=None, outliers=None):
+    """
+    Returns orders as an OrderTable, converting a list of dicts if needed
+
+    Args:
+        orders: OrderTable, or iterable of cleaned order dicts
+        columns: Order keys that must be loaded when converting dicts. All
+        keys are loaded if none are given.
+        start: Optional unix timestamp, orders created before it are left out
+        end: Optional unix timestamp, orders created at or after it are left
+        out
+        outliers: Optional OutlierFilter, or array of buyer ids, of the
+        buyers whose orders are left out. The filter is applied to the orders
+        in the time window.
+
+    Returns:
+        OrderTable with the order data
+    """
+    windowed = start is not None or end is not None
+    if not isinstance(orders, OrderTable):
+        if columns and windowed:
+            columns = columns + ("create_timestamp",)
+        if columns and outliers is not None:
+            columns = columns + getattr(outliers, "columns", ("buyer_user_id",))
+        orders = OrderTable.from_orders(orders, columns or COLUMNS)
+    if windowed:
+        orders = orders.window(start, end)
+    if outliers is not None:
+        if hasattr(outliers, "find"):
+            outliers = outliers.find(orders)
+        orders = orders.take(
+            np.flatnonzero(~np.isin(orders.buyer_user_id, outliers))
+        )
+    metrics.increment("rows", len(orders))
+    return orders
+
+
+def read_order_table(file_path):
+    """
+    Reads the cleaned orders at file_path into an OrderTable
+
+    Orders are streamed from the file, so the list of order dicts is never
+    built in memory.
+
+    Args:
+        file_path: String representing filepath of orders saved as a JSON
+        array or as newline-delimited JSON
+
+    Returns:
+        OrderTable with all order data
+    """
+    return OrderTable.from_orders(iter_orders(file_path))
+
+
+def save_order_table(store_path, table):
+    """
+    Saves table to the directory store_path as one .npy file per column
+
+    Buyer ids are saved as int32 when they fit. State names are saved to
+    states.json next to the state codes, and currency codes to
+    currencies.json.
+
+    Args:
+        store_path: String with path to the directory to save to. It is
+        created if it doesn't exist.
+        table: OrderTable to save
+    """
+    os.makedirs(store_path, exist_ok=True)
+
+    columns = {
+        "buyer_user_id": table.buyer_user_id,
+        "state_codes": table.state_codes,
+        "amount": table.amount,
+        "divisor": table.divisor,
+        "currency_codes": table.currency_codes,
+        "create_timestamp": table.create_timestamp,
+    }
+    if (
+        table.buyer_user_id is not None
+        and len(table.buyer_user_id) > 0
+        and np.abs(table.buyer_user_id).max() <= np.iinfo(np.int32).max
+    ):
+        columns["buyer_user_id"] = table.buyer_user_id.astype(np.int32)
+
+    for name, column in columns.items():
+        path = os.path.join(store_path, f"{name}.npy")
+        if column is not None:
+            np.save(path, column)
+        elif os.path.exists(path):
+            os.remove(path)
+
+    for name, names in (
+        ("states", table.states),
+        ("currencies", table.currencies),
+    ):
+        if names is not None:
+            save_to_json(os.path.join(store_path, f"{name}.json"), list(names))
+
+
+def load_order_table(store_path, mmap=True):
+    """
+    Loads an OrderTable saved by save_order_table
+
+    Args:
+        store_path: String with path to the directory the table was saved to
+        mmap: If True, columns are memory-mapped read-only instead of read
+        into memory, so loading doesn't depend on the number of orders
+
+    Returns:
+        OrderTable with the saved columns
+    """
+    mmap_mode = "r" if mmap else None
+
+    def load_column(name):
+        path = os.path.join(store_path, f"{name}.npy")
+        if not os.path.exists(path):
+            return None
+        return np.load(path, mmap_mode=mmap_mode)
+
+    table = OrderTable(
+        buyer_user_id=load_column("buyer_user_id"),
+        state_codes=load_column("state_codes"),
+        amount=load_column("amount"),
+        divisor=load_column("divisor"),
+        create_timestamp=load_column("create_timestamp"),
+        currency_codes=load_column("currency_codes"),
+    )
+
+    for name in ("states", "currencies"):
+        names_path = os.path.join(store_path, f"{name}.json")
+        if os.path.exists(names_path):
+            saved_names = read_json(names_path)
+            names = np.empty(len(saved_names), dtype=object)
+            names[:] = saved_names
+            setattr(table, name, names)
+
+    return table
+
+
+def convert_json_to_store(json_path, store_path):
+    """
+    Converts orders saved as JSON into a directory of .npy columns
+
+    Args:
+        json_path: String with path of orders saved as a JSON array or as
+        newline-delimited JSON
+        store_path: String with path to the directory to save to
+
+    Returns:
+        Int with the number of orders converted
+    """
+    table = read_order_table(json_path)
+    save_order_table(store_path, table)
+    return len(table)
+
+
+def local_seconds(timestamps):
+    """
+    Converts unix timestamps to seconds since the epoch in local time
+
+    The result matches the wall clock time given by datetime.fromtimestamp,
+    including daylight saving time, without making a datetime per timestamp.
+    The local UTC offset is looked up once per day between the first and last
+    timestamp. On days when it changes, the minute it changes is found with a
+    binary search, so memory grows with the number of days and offset
+    changes rather than with the number of minutes.
+
+    Args:
+        timestamps: Array of unix timestamps
+
+    Returns:
+        int64 array with the local wall clock time of each timestamp as
+        seconds since 1970-01-01 00:00
+    """
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    if len(timestamps) == 0:
+        return timestamps.copy()
+
+    first_day = int(timestamps.min()) // SECONDS_PER_DAY
+    last_day = int(timestamps.max()) // SECONDS_PER_DAY
+    day_starts = range(
+        first_day * SECONDS_PER_DAY,
+        (last_day + 2) * SECONDS_PER_DAY,
+        SECONDS_PER_DAY,
+    )
+    day_offsets = [time.localtime(second).tm_gmtoff for second in day_starts]
+
+    # Each change starts at the first minute of its day with a new offset.
+    change_starts = [day_starts[0]]
+    offsets = [day_offsets[0]]
+    for day, (offset, next_offset) in enumerate(
+        zip(day_offsets[:-1], day_offsets[1:])
+    ):
+        if offset != next_offset:
+            step = bisect.bisect_left(
+                range(SECONDS_PER_DAY // _OFFSET_STEP),
+                True,
+                key=lambda step, day=day, offset=offset: (
+                    time.localtime(
+                        day_starts[day] + step * _OFFSET_STEP
+                    ).tm_gmtoff
+                    != offset
+                ),
+            )
+            change_starts.append(day_starts[day] + step * _OFFSET_STEP)
+            offsets.append(next_offset)
+
+    # Offsets change on the minute, so the minute of each timestamp decides.
+    minute_starts = timestamps - timestamps % _OFFSET_STEP
+    change = np.searchsorted(
+        np.array(change_starts, dtype=np.int64), minute_starts, side="right"
+    )
+    return timestamps + np.array(offsets, dtype=np.int64)[change - 1]
+
+
+def local_months(timestamps):
+    """
+    Finds the local calendar month of unix timestamps
+
+    Args:
+        timestamps: Array of unix timestamps
+
+    Returns:
+        int64 array with the number of months between January 1970 and the
+        local month of each timestamp. Taking it modulo 12 gives the month
+        of the year counting from 0 for January.
+    """
+    return (
+        local_seconds(timestamps)
+        .astype("datetime64[s]")
+        .astype("datetime64[M]")
+        .astype(np.int64)
+    )
+
+
+def factorize(values):
+    """
+    Encodes values as integer codes in order of first appearance
+
+    Args:
+        values: 1-d array of values to encode
+
+    Returns:
+        codes: int64 array the same length as values with the index of each
+        value in uniques
+        uniques: Array of the distinct values, in the order they first appear
+    """
+    uniques, first_index, inverse = np.unique(
+        values, return_index=True, return_inverse=True
+    )
+    order = np.argsort(first_index, kind="stable")
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    return rank[inverse.reshape(-1)], uniques[order]
@@ -0,0 +1,199 @@
+"""
+Find buyers to leave out of the analysis, such as resellers placing far more
+orders than anyone else
+"""
+
+import numpy as np
+from customer_value import sum_subtotals
+from order_table import as_order_table, factorize
+
+
+class OutlierFilter:
+    """
+    Rules for the buyers to leave out of every analyze_data metric
+
+    A buyer is left out if any rule flags them. Pass the filter as the
+    outliers argument of an analyze_data function, or pass the ids returned
+    by find to compute the rules once for several functions. Thresholds are
+    upper limits, so only buyers with many orders or a high spend are left
+    out.
+
+    Order count thresholds are computed over repeat customers only. Most
+    customers place one order, so over all customers the spread of order
+    counts is usually zero and every repeat customer would be an outlier.
+
+    Attributes:
+        exclude_ids: Collection of buyer ids to always leave out
+        top_k: Int with how many buyers with the most orders to leave out,
+        breaking ties by who ordered first
+        order_count_mad: Optional float, leave out buyers whose order count is
+        more than this many scaled median absolute deviations above the median
+        order_count_iqr: Optional float, leave out buyers whose order count is
+        more than this many interquartile ranges above the third quartile
+        spend_mad: Optional float, like order_count_mad for the total subtotal
+        of each buyer's orders
+        spend_iqr: Optional float, like order_count_iqr for the total subtotal
+        of each buyer's orders
+        currency: Optional currency code of the subtotals the spend rules
+        total, such as "USD". Needed when the orders are in more than one
+        currency.
+    """
+
+    def __init__(
+        self,
+        exclude_ids=(),
+        top_k=0,
+        order_count_mad=None,
+        order_count_iqr=None,
+        spend_mad=None,
+        spend_iqr=None,
+        currency=None,
+    ):
+        # pylint: disable=too-many-arguments
+        self.exclude_ids = exclude_ids
+        self.top_k = top_k
+        self.order_count_mad = order_count_mad
+        self.order_count_iqr = order_count_iqr
+        self.spend_mad = spend_mad
+        self.spend_iqr = spend_iqr
+        self.currency = currency
+
+    @property
+    def columns(self):
+        """
+        Tuple of the order keys the rules need
+        """
+        if self.spend_mad is None and self.spend_iqr is None:
+            return ("buyer_user_id",)
+        return ("buyer_user_id", "subtotal")
+
+    def find(self, orders):
+        """
+        Finds the buyers the rules leave out
+
+        Args:
+            orders (iterable or OrderTable): All order data, such as a list of
+            order dicts or the output of iter_orders
+
+        Returns:
+            excluded (array): Sorted int64 array of the ids of the buyers to
+            leave out
+
+        Raises:
+            ValueError: If a spend rule is set and the orders are in more
+            than one currency but no currency is
+        """
+        table = as_order_table(orders, *self.columns)
+        buyer_codes, customers = factorize(table.buyer_user_id)
+        order_counts = np.bincount(buyer_codes, minlength=len(customers))
+
+        flagged = np.isin(
+            customers, np.asarray(self.exclude_ids, dtype=np.int64)
+        )
+        flagged[_top_k(order_counts, self.top_k)] = True
+
+        is_repeat = order_counts > 1
+        flagged |= _above_threshold(
+            order_counts,
+            order_counts[is_repeat],
+            self.order_count_mad,
+            self.order_count_iqr,
+        )
+        if self.spend_mad is not None or self.spend_iqr is not None:
+            spend = sum_subtotals(
+                buyer_codes, table, len(customers), self.currency
+            )
+            flagged |= _above_threshold(
+                spend, spend, self.spend_mad, self.spend_iqr
+            )
+
+        return np.sort(customers[flagged]).astype(np.int64)
+
+
+def quantiles(values, probabilities):
+    """
+    Finds quantiles like np.quantile by partitioning instead of sorting
+
+    Args:
+        values: 1-d array of numbers
+        probabilities: Sequence of floats from 0 to 1
+
+    Returns:
+        float array with the quantile of each probability, linearly
+        interpolated between the closest values
+    """
+    values = np.asarray(values)
+    if len(values) == 0:
+        return np.full(len(probabilities), np.nan)
+
+    positions = np.asarray(probabilities, dtype=float) * (len(values) - 1)
+    below = np.floor(positions).astype(np.int64)
+    above = np.minimum(below + 1, len(values) - 1)
+    partitioned = np.partition(values, np.unique(np.append(below, above)))
+    low = partitioned[below].astype(float)
+    high = partitioned[above].astype(float)
+    return low + (high - low) * (positions - below)
+
+
+def _top_k(order_counts, k):
+    """
+    Finds the k customers with the most orders
+
+    Args:
+        order_counts (array): The number of orders of each customer, in the
+        order customers first appear
+        k (int): The number of customers to find
+
+    Returns:
+        top (array): The indices of the customers
+    """
+    k = min(k, len(order_counts))
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+
+    kth_largest = np.partition(order_counts, len(order_counts) - k)[
+        len(order_counts) - k
+    ]
+    above = np.flatnonzero(order_counts > kth_largest)
+    tied = np.flatnonzero(order_counts == kth_largest)[: k - len(above)]
+    return np.concatenate((above, tied))
+
+
+def _above_threshold(values, reference, mad=None, iqr=None):
+    """
+    Flags values far above the bulk of a reference set of values
+
+    The median absolute deviation is scaled by 1.4826 to match the standard
+    deviation of normal data. When it is zero, the mean absolute deviation
+    from the median scaled by 1.2533 is used instead.
+
+    Args:
+        values (array): The values to flag
+        reference (array): The values to compute the median and quartiles of
+        mad (float): Optional number of scaled median absolute deviations
+        above the median to flag values beyond
+        iqr (float): Optional number of interquartile ranges above the third
+        quartile to flag values beyond
+
+    Returns:
+        flagged (array): Boolean array that is True for each flagged value
+    """
+    flagged = np.zeros(len(values), dtype=bool)
+    if len(reference) == 0:
+        return flagged
+
+    if mad is not None:
+        median = quantiles(reference, [0.5])[0]
+        deviation = np.abs(reference - median)
+        scale = 1.4826 * quantiles(deviation, [0.5])[0]
+        if scale == 0:
+            scale = 1.2533 * deviation.mean()
+        if scale > 0:
+            flagged |= values > median + mad * scale
+
+    if iqr is not None:
+        first, third = quantiles(reference, [0.25, 0.75])
+        if third > first:
+            flagged |= values > third + iqr * (third - first)
+
+    return flagged
@@ -0,0 +1,163 @@
+"""
+Analyze order data on several cores by splitting customers between processes
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import os
+import numpy as np
+from analyze_data import time_between_orders
+from chunked import PartialAggregates
+from metrics import instrument
+from order_table import CustomerTimeline, OrderTable, as_order_table, factorize
+
+# Multiplier of Fibonacci hashing, so partitions stay balanced even when
+# buyer ids share a common factor with the number of workers
+_HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+
+def partition_buyers(buyer_user_id, workers):
+    """
+    Assigns every order to a partition by hashing its buyer id
+
+    All orders of a customer land in the same partition, so whether a
+    customer is a repeat customer can be decided within one partition.
+
+    Args:
+        buyer_user_id: Array with the id of the customer that placed each
+        order
+        workers: Int with the number of partitions
+
+    Returns:
+        int64 array with the partition of each order, from 0 to workers - 1
+    """
+    hashed = np.asarray(buyer_user_id).astype(np.uint64) * _HASH_MULTIPLIER
+    return ((hashed >> np.uint64(32)) % np.uint64(workers)).astype(np.int64)
+
+
+@instrument
+def analyze_parallel(orders, workers=None, currency=None):
+    """
+    Calculates every metric of analyze_all using a pool of worker processes
+
+    Orders are split between workers by buyer. Each worker tallies its
+    customers' orders, subtotals, states and months and finds the time
+    between their orders, and the partial results are merged in the order
+    customers first appear. The results are identical to analyze_all.
+
+    Args:
+        orders (iterable or OrderTable): All order data, such as a list of
+        order dicts or the output of iter_orders
+        workers (int): The number of processes to use. Defaults to the
+        number of CPUs. With 1 worker no processes are started.
+        currency (str): Currency code of the orders to average, as in
+        analyze_all. Needed when the orders are in more than one currency.
+
+    Returns:
+        results (dict): The same results as analyze_all
+
+    Raises:
+        ValueError: If the orders are in more than one currency and no
+        currency is given
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    table = as_order_table(orders)
+    partition = partition_buyers(table.buyer_user_id, workers)
+    jobs = []
+    for worker in range(workers):
+        positions = np.flatnonzero(partition == worker)
+        # Keep the first partition even if it's empty, so there is always
+        # something to merge.
+        if len(positions) > 0 or worker == 0:
+            jobs.append((table.take(positions), positions))
+
+    if workers == 1:
+        partials = [_analyze_partition(*job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            partials = list(executor.map(_analyze_partition, *zip(*jobs)))
+
+    # Partitions have no buyers in common, so their tallies are merged with
+    # one concatenation and one reordering rather than pairwise.
+    results = PartialAggregates.merge_all(
+        [partial[0] for partial in partials]
+    ).results(currency)
+
+    # Put each partition's customers back in order of first appearance.
+    customer_first = np.concatenate([partial[1] for partial in partials])
+    order = np.argsort(customer_first, kind="stable")
+    timelines = [partial[3] for partial in partials]
+    num_orders = np.concatenate([timeline.num_orders for timeline in timelines])
+    years = _reorder_segments(
+        np.concatenate([partial[2] for partial in partials]),
+        np.maximum(num_orders - 1, 0),
+        order,
+    )
+    timeline = CustomerTimeline(
+        np.concatenate([timeline.customers for timeline in timelines])[order],
+        np.append(0, np.cumsum(num_orders[order])),
+        _reorder_segments(
+            np.concatenate(
+                [timeline.create_timestamp for timeline in timelines]
+            ),
+            num_orders,
+            order,
+        ),
+    )
+
+    results["buyer_user_id"] = table.buyer_user_id
+    if isinstance(orders, OrderTable):
+        results["years"], results["orders_by_customer"] = years, timeline
+    else:
+        results["buyer_user_id"] = table.buyer_user_id.tolist()
+        results["years"] = years.tolist()
+        results["orders_by_customer"] = timeline.to_dict()
+
+    return results
+
+
+def _analyze_partition(table, positions):
+    """
+    Calculates the partial results of one partition of customers
+
+    Args:
+        table (OrderTable): The orders of the partition's customers
+        positions (array): The position of each order in the whole data
+
+    Returns:
+        aggregates (PartialAggregates): Tallies of the partition's orders
+        customer_first (array): The position of each customer's first order,
+        in the order customers first appear
+        years (array): The time deltas between orders in years
+        timeline (CustomerTimeline): The sorted order times of each customer
+    """
+    aggregates = PartialAggregates.from_table(table, positions=positions)
+    buyer_codes, customers = factorize(table.buyer_user_id)
+    first = np.full(len(customers), len(positions), dtype=np.int64)
+    np.minimum.at(first, buyer_codes, np.arange(len(positions)))
+    years, timeline = time_between_orders(
+        buyer_codes, customers, table.create_timestamp
+    )
+    return aggregates, positions[first], years, timeline
+
+
+def _reorder_segments(values, lengths, order):
+    """
+    Rearranges consecutive segments of values
+
+    Args:
+        values (array): Segments of values one after another
+        lengths (array): The length of each segment
+        order (array): The segments to output, in output order
+
+    Returns:
+        Array of the segments of values in the given order
+    """
+    starts = np.cumsum(lengths) - lengths
+    new_lengths = lengths[order]
+    new_starts = np.cumsum(new_lengths) - new_lengths
+    index = np.arange(new_lengths.sum(), dtype=np.int64) + np.repeat(
+        starts[order] - new_starts, new_lengths
+    )
+    return values[index]
@@ -0,0 +1,346 @@
+"""
+On-disk cache of analysis results, keyed by a fingerprint of the data
+"""
+
+import copyreg
+import hashlib
+import io
+import os
+import pickle
+import sqlite3
+import time
+import numpy as np
+import analyze_data
+from api_lib import read_json
+from order_table import OrderTable
+
+DEFAULT_CACHE_PATH = "analysis_cache.db"
+DEFAULT_MAX_BYTES = 256 * 2**20
+# Change when cached results would no longer match what the functions return
+CACHE_VERSION = 2
+
+ANALYSIS_FUNCTIONS = (
+    "calculate_orders_per_customer",
+    "calculate_avg_order_size",
+    "calculate_time_between_orders",
+    "find_order_dates",
+    "count_orders_by_state",
+    "calculate_reorder_rate_by_state",
+)
+
+
+class ResultCache:
+    """
+    Least recently used cache of function results stored in SQLite
+
+    Results are pickled and stored with their size and when they were last
+    read. Whenever the stored results add up to more than max_bytes, the
+    least recently used ones are removed.
+
+    Attributes:
+        file_path: String with path to the SQLite database file
+        max_bytes: Int with the most bytes of pickled results to keep
+    """
+
+    def __init__(
+        self, file_path=DEFAULT_CACHE_PATH, max_bytes=DEFAULT_MAX_BYTES
+    ):
+        self.file_path = file_path
+        self.max_bytes = max_bytes
+        self._connection = sqlite3.connect(file_path)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, "
+            "size INTEGER NOT NULL, last_used INTEGER NOT NULL)"
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self._connection.execute(
+            "SELECT COUNT(*) FROM results"
+        ).fetchone()[0]
+
+    def __contains__(self, key):
+        return (
+            self._connection.execute(
+                "SELECT 1 FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            is not None
+        )
+
+    @property
+    def total_bytes(self):
+        """
+        Int with the size of all stored results
+        """
+        return self._connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM results"
+        ).fetchone()[0]
+
+    def get(self, key, default=None):
+        """
+        Returns the result stored under key, or default if there is none
+        """
+        row = self._connection.execute(
+            "SELECT value FROM results WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return default
+        with self._connection:
+            self._connection.execute(
+                "UPDATE results SET last_used = ? WHERE key = ?",
+                (time.time_ns(), key),
+            )
+        return pickle.loads(row[0])
+
+    def put(self, key, value):
+        """
+        Stores value under key, removing least recently used results to make
+        room. Values larger than max_bytes are not stored.
+        """
+        data = _dumps(value)
+        if len(data) > self.max_bytes:
+            return
+        with self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                (key, data, len(data), time.time_ns()),
+            )
+            self._evict()
+
+    def call(self, function, *args, **kwargs):
+        """
+        Returns function(*args, **kwargs), computing it only if the same
+        function was not already called with arguments of the same content
+
+        Args:
+            function: Function to call, such as one from analyze_data
+            args: Arguments to pass to function
+            kwargs: Keyword arguments to pass to function
+
+        Returns:
+            The result of the function
+        """
+        key = _make_key(
+            f"{function.__module__}.{function.__qualname__}",
+            *(fingerprint(arg) for arg in args),
+            *(f"{name}={fingerprint(kwargs[name])}" for name in sorted(kwargs)),
+        )
+        result = self.get(key, _MISSING)
+        if result is _MISSING:
+            result = function(*args, **kwargs)
+            self.put(key, result)
+        return result
+
+    def analyze_file(self, orders_path, content=False):
+        """
+        Runs every analyze_data function on the orders saved at orders_path,
+        reusing results from earlier runs on the same file
+
+        The orders are only read if some result isn't cached. Results are
+        keyed by the file's path, size and modification time, so they are
+        recomputed whenever the file changes.
+
+        Args:
+            orders_path: String with path to orders saved as a JSON array
+            content: If True, key results by a hash of the file's contents
+            instead, so an unchanged copy of the file also hits the cache
+
+        Returns:
+            results (dict): The return value of each function in
+            ANALYSIS_FUNCTIONS, keyed by function name. Functions are called
+            like in the essay, with buyer_user_id from
+            calculate_orders_per_customer and orders_by_customer from
+            calculate_time_between_orders.
+        """
+        dataset = fingerprint_file(orders_path, content=content)
+        keys = {
+            name: _make_key(f"analyze_file.{name}", dataset)
+            for name in ANALYSIS_FUNCTIONS
+        }
+        results = {name: self.get(key, _MISSING) for name, key in keys.items()}
+        missing = [
+            name for name, result in results.items() if result is _MISSING
+        ]
+        if not missing:
+            return results
+
+        orders = read_json(orders_path)
+        arguments = {
+            "calculate_orders_per_customer": lambda: (orders,),
+            "calculate_avg_order_size": lambda: (
+                results["calculate_orders_per_customer"][0],
+                orders,
+            ),
+            "calculate_time_between_orders": lambda: (
+                results["calculate_orders_per_customer"][0],
+                orders,
+            ),
+            "find_order_dates": lambda: (
+                results["calculate_time_between_orders"][1],
+            ),
+            "count_orders_by_state": lambda: (orders,),
+            "calculate_reorder_rate_by_state": lambda: (orders,),
+        }
+        # Earlier results are inputs of later ones, cached or not.
+        for name in missing:
+            results[name] = getattr(analyze_data, name)(*arguments[name]())
+            self.put(keys[name], results[name])
+
+        return results
+
+    def clear(self):
+        """
+        Removes every stored result
+        """
+        with self._connection:
+            self._connection.execute("DELETE FROM results")
+
+    def close(self):
+        """
+        Closes the database
+        """
+        self._connection.close()
+
+    def _evict(self):
+        """
+        Removes least recently used results until the rest fit in max_bytes
+        """
+        excess = self.total_bytes - self.max_bytes
+        if excess <= 0:
+            return
+        stale = []
+        for key, size in self._connection.execute(
+            "SELECT key, size FROM results ORDER BY last_used"
+        ).fetchall():
+            if excess <= 0:
+                break
+            stale.append((key,))
+            excess -= size
+        self._connection.executemany("DELETE FROM results WHERE key = ?", stale)
+
+
+def fingerprint_file(file_path, content=False):
+    """
+    Fingerprints a file so that a changed file gets a different fingerprint
+
+    Args:
+        file_path: String with path to the file
+        content: If True, hash the file's contents instead of using its path,
+        size and modification time
+
+    Returns:
+        String fingerprint of the file
+    """
+    if not content:
+        stat = os.stat(file_path)
+        return (
+            f"file:{os.path.realpath(file_path)}:{stat.st_size}"
+            f":{stat.st_mtime_ns}"
+        )
+
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(2**20), b""):
+            digest.update(block)
+    return f"sha256:{digest.hexdigest()}"
+
+
+def fingerprint(value):
+    """
+    Hashes the content of an argument to an analysis function
+
+    Arrays and OrderTable columns are hashed from their raw bytes. Anything
+    else is hashed from its pickle.
+
+    Args:
+        value: Any picklable value, such as a list of order dicts
+
+    Returns:
+        String fingerprint of the value
+    """
+    digest = hashlib.sha256()
+    if isinstance(value, OrderTable):
+        for column in (
+            value.buyer_user_id,
+            value.state_codes,
+            value.amount,
+            value.divisor,
+            value.create_timestamp,
+        ):
+            _update_array(digest, column)
+        digest.update(
+            _dumps(None if value.states is None else list(value.states))
+        )
+        if value.currency_codes is not None:
+            _update_array(digest, value.currency_codes)
+            digest.update(_dumps(list(value.currencies)))
+    elif isinstance(value, np.ndarray) and value.dtype != object:
+        _update_array(digest, value)
+    else:
+        digest.update(_dumps(value))
+    return f"sha256:{digest.hexdigest()}"
+
+
+class _ResultPickler(pickle.Pickler):
+    """
+    Pickler that also handles the dict views returned for num_reorders and
+    num_customers
+    """
+
+    dispatch_table = copyreg.dispatch_table.copy()
+    dispatch_table[type({}.keys())] = lambda view: (_dict_keys, (list(view),))
+    dispatch_table[type({}.values())] = lambda view: (
+        _dict_values,
+        (list(view),),
+    )
+
+
+def _dict_keys(items):
+    """
+    Rebuilds a pickled dict_keys view
+    """
+    return dict.fromkeys(items).keys()
+
+
+def _dict_values(items):
+    """
+    Rebuilds a pickled dict_values view
+    """
+    return dict(enumerate(items)).values()
+
+
+def _dumps(value):
+    """
+    Pickles value with _ResultPickler
+    """
+    buffer = io.BytesIO()
+    _ResultPickler(buffer, protocol=pickle.HIGHEST_PROTOCOL).dump(value)
+    return buffer.getvalue()
+
+
+def _update_array(digest, array):
+    """
+    Adds an array's dtype, shape and bytes to a hash
+    """
+    if array is None:
+        digest.update(b"none")
+        return
+    array = np.ascontiguousarray(array)
+    digest.update(f"{array.dtype.str}{array.shape}".encode("utf-8"))
+    digest.update(array.data)
+
+
+def _make_key(*parts):
+    """
+    Joins the cache version and key parts into one key
+    """
+    return "|".join((f"v{CACHE_VERSION}", *parts))
+
+
+_MISSING = object()
@@ -0,0 +1,461 @@
+"""
+Persistent per-state tallies of customers, orders and revenue for map queries
+"""
+
+import sqlite3
+import numpy as np
+from analyze_data import MIN_STATE_CUSTOMERS
+from money import divide, sum_by_group
+from order_table import as_order_table, factorize, local_months
+
+# Month number stored for an order a customer hasn't placed
+_NO_MONTH = np.iinfo(np.int64).min
+
+
+class StateIndex:
+    """
+    Per-state tallies of orders, stored in SQLite and updated as orders arrive
+
+    For each state the index keeps its distinct customers, repeat customers,
+    orders and revenue, and the same tallies by local month so they can be
+    limited to a range of months. Queries are answered from tallies kept in
+    memory, so asking again with another min_customers threshold doesn't
+    touch the database. The tallies of each range of months are kept until
+    orders are added.
+
+    Each order is tallied by its state, its month and the months of the
+    customer's two orders to that state before it. A customer ordered in a
+    range of months if one of their orders is in the range and the order
+    before it isn't, and is a repeat customer if the order before that isn't,
+    so any range is answered by summing these tallies. Only the months of
+    each customer's last two orders are kept per customer, so the database
+    grows with the number of customers and months, not orders.
+
+    States are listed in the order their first order was added, like the
+    state results of analyze_data.
+
+    Attributes:
+        file_path: String with path to the SQLite database file
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self._connection = sqlite3.connect(file_path)
+        with self._connection:
+            self._connection.executescript(
+                "CREATE TABLE IF NOT EXISTS states ("
+                "code INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);"
+                "CREATE TABLE IF NOT EXISTS pairs ("
+                "state INTEGER, buyer INTEGER, last_month INTEGER NOT NULL, "
+                "previous_month INTEGER NOT NULL, "
+                "PRIMARY KEY (state, buyer)) WITHOUT ROWID;"
+                "CREATE TABLE IF NOT EXISTS order_months ("
+                "state INTEGER, month INTEGER, previous_month INTEGER, "
+                "second_previous_month INTEGER, orders INTEGER NOT NULL, "
+                "PRIMARY KEY (state, month, previous_month, "
+                "second_previous_month)) WITHOUT ROWID;"
+                "CREATE TABLE IF NOT EXISTS state_months ("
+                "state INTEGER, month INTEGER, currency TEXT, divisor INTEGER, "
+                "orders INTEGER NOT NULL, amount INTEGER NOT NULL, "
+                "PRIMARY KEY (state, month, currency, divisor)) WITHOUT ROWID"
+            )
+        self._states = np.array(
+            [
+                name
+                for (name,) in self._connection.execute(
+                    "SELECT name FROM states ORDER BY code"
+                )
+            ],
+            dtype=object,
+        )
+        self._cache = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return len(self._states)
+
+    def add(self, orders):
+        """
+        Adds new orders to the tallies
+
+        Orders must not have been added before, like the new orders returned
+        by sync_orders, and must not be in an earlier month than an order
+        already added for the same customer and state. Orders within one call
+        can be in any order.
+
+        Args:
+            orders (iterable or OrderTable): New order data, such as a list of
+            order dicts or the output of iter_orders
+
+        Raises:
+            ValueError: If an order is in an earlier month than an order
+            already added for its customer and state
+        """
+        table = as_order_table(orders)
+        if len(table) == 0:
+            return
+
+        state = self._state_codes(table)
+        buyer = table.buyer_user_id.astype(np.int64)
+        month = local_months(table.create_timestamp)
+        currency = (
+            np.full(len(table), "", dtype=object)
+            if table.currency_codes is None
+            else table.currency
+        )
+
+        # Line up each customer's orders to a state by time, after the months
+        # of their last two orders already added.
+        order = np.lexsort((table.create_timestamp, buyer, state))
+        pairs, first, pair_index, pair_orders = np.unique(
+            np.stack((state[order], buyer[order]), axis=1),
+            axis=0,
+            return_index=True,
+            return_inverse=True,
+            return_counts=True,
+        )
+        pair_index = pair_index.reshape(-1)
+        last_month, previous_month = self._last_months(pairs)
+        sorted_month = month[order]
+        if np.any(sorted_month[first] < last_month):
+            raise ValueError(
+                "Orders must not be in an earlier month than orders already"
+                " added for the same customer and state"
+            )
+
+        position = np.arange(len(order)) - first[pair_index]
+        before = np.concatenate(([_NO_MONTH] * 2, sorted_month))
+        order_previous = np.where(
+            position >= 1, before[1:-1], last_month[pair_index]
+        )
+        order_second_previous = np.where(
+            position >= 2,
+            before[:-2],
+            np.where(
+                position == 1,
+                last_month[pair_index],
+                previous_month[pair_index],
+            ),
+        )
+        order_months, order_month_orders = np.unique(
+            np.stack(
+                (
+                    state[order],
+                    sorted_month,
+                    order_previous,
+                    order_second_previous,
+                ),
+                axis=1,
+            ),
+            axis=0,
+            return_counts=True,
+        )
+
+        last = first + pair_orders - 1
+        new_previous = np.where(
+            pair_orders >= 2, sorted_month[last - 1], last_month
+        )
+
+        currency_codes, currencies = factorize(currency)
+        state_months, state_month_index = np.unique(
+            np.stack(
+                (state, month, currency_codes, table.divisor.astype(np.int64)),
+                axis=1,
+            ),
+            axis=0,
+            return_inverse=True,
+        )
+        state_month_index = state_month_index.reshape(-1)
+        state_month_orders = np.bincount(state_month_index)
+        state_month_amount = np.zeros(len(state_months), dtype=np.int64)
+        np.add.at(state_month_amount, state_month_index, table.amount)
+        state_month_rows = [
+            (state_code, month_number, currencies[code], divisor, *values)
+            for state_code, month_number, code, divisor, *values in _rows(
+                state_months, state_month_orders, state_month_amount
+            )
+        ]
+
+        with self._connection:
+            self._connection.executemany(
+                "INSERT INTO pairs VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (state, buyer) DO UPDATE SET "
+                "last_month = excluded.last_month, "
+                "previous_month = excluded.previous_month",
+                _rows(pairs, sorted_month[last], new_previous),
+            )
+            self._connection.executemany(
+                "INSERT INTO order_months VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (state, month, previous_month, "
+                "second_previous_month) DO UPDATE SET "
+                "orders = orders + excluded.orders",
+                _rows(order_months, order_month_orders),
+            )
+            self._connection.executemany(
+                "INSERT INTO state_months VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (state, month, currency, divisor) DO UPDATE SET "
+                "orders = orders + excluded.orders, "
+                "amount = amount + excluded.amount",
+                state_month_rows,
+            )
+        self._cache = {}
+
+    def query(
+        self, min_customers=0, start_month=None, end_month=None, currency=None
+    ):
+        """
+        Returns the tallies of each state with enough customers
+
+        Args:
+            min_customers: Int, states with this many customers or fewer are
+            left out. analyze_data lists reorder rates of states with more
+            than MIN_STATE_CUSTOMERS customers.
+            start_month: Optional month like "2023-01", orders in local months
+            before it are left out
+            end_month: Optional month like "2024-01", orders in local months
+            from it on are left out
+            currency: Currency code of the revenue to total, such as "USD".
+            Needed when the orders are in more than one currency.
+
+        Returns:
+            columns (dict): Arrays of the state, num_customers,
+            repeat_customers, reorder_rate as a percentage of customers,
+            number_of_orders in any currency, and the revenue in currency of
+            each state listed. Revenue is summed exactly as the amount at a
+            common divisor, in the same form as an order's subtotal, and
+            divided once.
+
+        Raises:
+            ValueError: If the orders are in more than one currency and no
+            currency is given
+        """
+        columns, revenue = self._tallies(start_month, end_month)
+
+        if currency is None:
+            if len(revenue) > 1:
+                raise ValueError(
+                    "The orders are in more than one currency ("
+                    + ", ".join(sorted(revenue))
+                    + "). Pass a currency."
+                )
+            currency = next(iter(revenue), "")
+        amount, divisor = revenue.get(
+            currency, (np.zeros(len(self._states), dtype=np.int64), 1)
+        )
+        columns = dict(
+            columns,
+            amount=amount,
+            divisor=np.full(len(amount), divisor, dtype=amount.dtype),
+            revenue=divide(amount, divisor),
+        )
+
+        listed = columns["num_customers"] > min_customers
+        return {name: values[listed] for name, values in columns.items()}
+
+    def reorder_rate_by_state(
+        self, min_customers=MIN_STATE_CUSTOMERS, **months
+    ):
+        """
+        Returns the reorder rate of each state like
+        calculate_reorder_rate_by_state
+
+        Args:
+            min_customers: Int, states with this many customers or fewer are
+            left out
+            months: Optional start_month and end_month, as in query
+
+        Returns:
+            columns (dict): Arrays of the state name and reorder percentage of
+            each state with more than min_customers customers
+        """
+        columns, _ = self._tallies(**months)
+        listed = columns["num_customers"] > min_customers
+        return {
+            "state": columns["state"][listed],
+            "reorder_rate": columns["reorder_rate"][listed],
+        }
+
+    def orders_by_state(self, **months):
+        """
+        Returns the number of orders of each state like count_orders_by_state
+
+        Args:
+            months: Optional start_month and end_month, as in query
+
+        Returns:
+            columns (dict): Arrays of the state name and number of orders of
+            each state with orders
+        """
+        columns, _ = self._tallies(**months)
+        listed = columns["number_of_orders"] > 0
+        return {
+            "state": columns["state"][listed],
+            "number_of_orders": columns["number_of_orders"][listed],
+        }
+
+    def close(self):
+        """
+        Closes the database
+        """
+        self._connection.close()
+
+    def _tallies(self, start_month=None, end_month=None):
+        """
+        Returns the tallies of _tally for a range of months, reading them
+        only if they aren't kept yet
+        """
+        key = (_month_number(start_month), _month_number(end_month))
+        if key not in self._cache:
+            self._cache[key] = self._tally(*key)
+        return self._cache[key]
+
+    def _state_codes(self, table):
+        """
+        Looks up the code of the state of each order, adding new states in
+        the order they first appear
+        """
+        codes, used = factorize(table.state_codes)
+        lookup = {name: code for code, name in enumerate(self._states)}
+        new_states = [name for name in table.states[used] if name not in lookup]
+        if new_states:
+            with self._connection:
+                self._connection.executemany(
+                    "INSERT INTO states VALUES (?, ?)",
+                    enumerate(new_states, start=len(self._states)),
+                )
+            self._states = np.append(
+                self._states, np.array(new_states, dtype=object)
+            )
+            lookup.update(
+                (name, code)
+                for code, name in enumerate(new_states, start=len(lookup))
+            )
+        state_of_code = np.array(
+            [lookup[name] for name in table.states[used]], dtype=np.int64
+        )
+        return state_of_code[codes]
+
+    def _last_months(self, pairs):
+        """
+        Reads the months of the last two orders already added for each
+        (state, buyer) pair, or _NO_MONTH for orders the pair hasn't placed
+        """
+        last_month = np.full(len(pairs), _NO_MONTH, dtype=np.int64)
+        previous_month = np.full(len(pairs), _NO_MONTH, dtype=np.int64)
+        with self._connection:
+            self._connection.execute(
+                "CREATE TEMP TABLE IF NOT EXISTS new_pairs ("
+                "row INTEGER PRIMARY KEY, state INTEGER, buyer INTEGER)"
+            )
+            self._connection.execute("DELETE FROM new_pairs")
+            self._connection.executemany(
+                "INSERT INTO new_pairs VALUES (?, ?, ?)",
+                _rows(np.column_stack((np.arange(len(pairs)), pairs))),
+            )
+            for row, last, previous in self._connection.execute(
+                "SELECT new.row, old.last_month, old.previous_month "
+                "FROM new_pairs AS new JOIN pairs AS old "
+                "ON old.state = new.state AND old.buyer = new.buyer"
+            ):
+                last_month[row] = last
+                previous_month[row] = previous
+        return last_month, previous_month
+
+    def _tally(self, start, end):
+        """
+        Reads the tallies of every state for a range of month numbers
+
+        Returns:
+            columns (dict): Arrays of the state, num_customers,
+            repeat_customers, reorder_rate and number_of_orders of every state
+            revenue (dict): Maps each currency with orders in the range to an
+            array with the amount of each state at a common divisor, and the
+            divisor
+        """
+        num_states = len(self._states)
+        customers = np.zeros(num_states, dtype=np.int64)
+        repeat_customers = np.zeros(num_states, dtype=np.int64)
+        number_of_orders = np.zeros(num_states, dtype=np.int64)
+        start, end = _month_bounds(start, end)
+
+        # A customer's first order in the range follows an order before it,
+        # and their second follows an order in the range that follows one
+        # before it.
+        for state, state_customers, state_repeat in self._connection.execute(
+            "SELECT state, SUM(orders * (previous_month < ?)), "
+            "SUM(orders * (previous_month >= ? "
+            "AND second_previous_month < ?)) "
+            "FROM order_months WHERE month >= ? AND month < ? GROUP BY state",
+            (start, start, start, start, end),
+        ):
+            customers[state] = state_customers
+            repeat_customers[state] = state_repeat
+
+        rows = self._connection.execute(
+            "SELECT state, currency, divisor, SUM(orders), SUM(amount) "
+            "FROM state_months WHERE month >= ? AND month < ? "
+            "GROUP BY state, currency, divisor",
+            (start, end),
+        ).fetchall()
+        revenue = {}
+        for currency in sorted({row[1] for row in rows}):
+            state, divisor, amount = (
+                np.array(column, dtype=np.int64)
+                for column in zip(
+                    *(
+                        (row[0], row[2], row[4])
+                        for row in rows
+                        if row[1] == currency
+                    )
+                )
+            )
+            sums, _, common = sum_by_group(amount, divisor, state, num_states)
+            revenue[currency] = (sums, common)
+        for state, _, _, orders, _ in rows:
+            number_of_orders[state] += orders
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            reorder_rate = repeat_customers / customers * 100
+
+        columns = {
+            "state": self._states.copy(),
+            "num_customers": customers,
+            "repeat_customers": repeat_customers,
+            "reorder_rate": reorder_rate,
+            "number_of_orders": number_of_orders,
+        }
+        return columns, revenue
+
+
+def _rows(keys, *values):
+    """
+    Joins the key columns and value arrays into rows of Python ints
+    """
+    return zip(*keys.T.tolist(), *(value.tolist() for value in values))
+
+
+def _month_number(month):
+    """
+    Converts a month like "2023-01" to months since January 1970
+    """
+    if month is None:
+        return None
+    return int(np.datetime64(month, "M").astype(np.int64))
+
+
+def _month_bounds(start, end):
+    """
+    Fills in missing month numbers with bounds that include every month
+
+    The start bound is above _NO_MONTH, so an order with no order before it
+    always counts as the first order in a range.
+    """
+    return (
+        _NO_MONTH + 1 if start is None else start,
+        np.iinfo(np.int64).max if end is None else end,
+    )
@@ -0,0 +1,98 @@
+"""
+Test functions in aggregator file.
+"""
+
+import pytest
+from aggregator import OrderAggregator
+from analyze_data import analyze_all
+from api_lib import read_json
+
+ORDERS_PATH = "orders.json"
+
+
+def order(buyer_user_id, amount, create_timestamp, state="CO"):
+    """
+    Makes a cleaned order dict for the tests
+    """
+    return {
+        "buyer_user_id": buyer_user_id,
+        "state": state,
+        "subtotal": {"amount": amount, "divisor": 100, "currency_code": "USD"},
+        "create_timestamp": create_timestamp,
+    }
+
+
+@pytest.mark.parametrize("batch_size", [1, 500])
+def test_aggregator_matches_analyze_all(batch_size):
+    """
+    Test that adding orders in batches gives the same metrics as analyze_all
+
+    Args:
+        batch_size: Int with how many orders to add at once
+    """
+    all_orders = read_json(ORDERS_PATH)
+    aggregator = OrderAggregator()
+    for start in range(0, len(all_orders), batch_size):
+        aggregator.add_many(all_orders[start : start + batch_size])
+    results = analyze_all(all_orders)
+
+    num_reorders, num_customers = aggregator.orders_per_customer()
+    assert dict(zip(num_reorders, num_customers)) == dict(
+        zip(results["num_reorders"], results["num_customers"])
+    )
+    assert aggregator.avg_order_size() == (
+        results["single_order_value"],
+        results["multiple_order_value"],
+    )
+    assert aggregator.order_dates() == (
+        results["single_by_month"],
+        results["multiple_by_month"],
+    )
+    assert aggregator.reorder_rate_by_state().equals(
+        results["state_reorder_df"]
+    )
+
+
+def test_customer_becomes_repeat():
+    """
+    Test that a customer's first order moves to the repeat tallies when they
+    order again
+    """
+    aggregator = OrderAggregator()
+    aggregator.add(order(1, 1000, 1704110400))
+    aggregator.add(order(2, 3000, 1706788800))
+    assert aggregator.reorder_rate() == 0
+    assert aggregator.order_dates()[0][:2] == [1, 1]
+
+    aggregator.add(order(1, 2000, 1709294400))
+    assert aggregator.num_customers == 2
+    assert aggregator.reorder_rate() == 0.5
+    assert aggregator.avg_order_size() == (30.0, 15.0)
+    single_by_month, multiple_by_month = aggregator.order_dates()
+    assert single_by_month[:3] == [0, 1, 0]
+    assert multiple_by_month[:3] == [1, 0, 1]
+    assert aggregator.orders_per_customer() == ([1, 2], [1, 1])
+
+
+def test_avg_order_size_by_currency():
+    """
+    Test that orders in different currencies are averaged separately, and
+    not at all without a currency
+    """
+    aggregator = OrderAggregator()
+    for buyer_user_id, amount, currency in (
+        (1, 1000, "USD"),
+        (2, 5000, "EUR"),
+        (3, 3000, "EUR"),
+        (4, 4000, "USD"),
+        (1, 2000, "USD"),
+        (2, 7000, "EUR"),
+    ):
+        new_order = order(buyer_user_id, amount, 1704110400)
+        new_order["subtotal"]["currency_code"] = currency
+        aggregator.add(new_order)
+
+    with pytest.raises(ValueError, match="more than one currency"):
+        aggregator.avg_order_size()
+    assert aggregator.avg_order_size("EUR") == (30.0, 60.0)
+    assert aggregator.avg_order_size("USD") == (40.0, 15.0)
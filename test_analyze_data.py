@@ -3,15 +3,27 @@ Test functions in analyze_data file.
 """
 
 from datetime import datetime
+import subprocess
+import sys
+import numpy as np
+import pytest
 from analyze_data import (
+    analyze_all,
     calculate_avg_order_size,
+    calculate_cohort_retention,
+    calculate_order_value_by_group,
     calculate_orders_per_customer,
     calculate_reorder_rate_by_state,
+    calculate_rolling_metrics,
     calculate_time_between_orders,
     count_orders_by_state,
     find_order_dates,
+    main,
 )
+from api_lib import read_json
+from order_table import OrderTable
 
+ORDERS_PATH = "orders.json"
 
 orders = [
     {
@@ -122,3 +134,282 @@ def test_calculate_reorder_rate_by_state():
     reorder_df = calculate_reorder_rate_by_state(test_orders)
     expected_output = [["CO", 5], ["VA", 20]]
     assert reorder_df.values.tolist() == expected_output
+
+
+def test_order_table_matches_list():
+    """
+    Test that passing an OrderTable gives the same results as a list.
+    """
+    table = OrderTable.from_orders(orders)
+    buyer_user_id, num_reorders, num_customers = calculate_orders_per_customer(
+        orders
+    )
+    table_ids, table_reorders, table_customers = calculate_orders_per_customer(
+        table
+    )
+    assert table_ids.tolist() == buyer_user_id
+    assert list(table_reorders) == list(num_reorders)
+    assert list(table_customers) == list(num_customers)
+    assert calculate_avg_order_size(
+        table_ids, table
+    ) == calculate_avg_order_size(buyer_user_id, orders)
+    assert count_orders_by_state(table).equals(count_orders_by_state(orders))
+
+
+def test_time_between_orders_table_matches_list():
+    """
+    Test that the array path for an OrderTable gives the same gaps and
+    monthly tallies as the datetime path for a list.
+    """
+    buyer_user_id = [order["buyer_user_id"] for order in orders]
+    years, orders_by_customer = calculate_time_between_orders(
+        buyer_user_id, orders
+    )
+    table_years, timeline = calculate_time_between_orders(
+        buyer_user_id, OrderTable.from_orders(orders)
+    )
+    assert table_years.tolist() == years
+    assert timeline.to_dict() == orders_by_customer
+    assert find_order_dates(timeline) == find_order_dates(orders_by_customer)
+
+
+def test_analyze_all():
+    """
+    Test that analyze_all gives exactly the results of each function on the
+    saved order data.
+    """
+    all_orders = read_json(ORDERS_PATH)
+    results = analyze_all(all_orders)
+
+    buyer_user_id, num_reorders, num_customers = calculate_orders_per_customer(
+        all_orders
+    )
+    assert results["buyer_user_id"] == buyer_user_id
+    assert list(results["num_reorders"]) == list(num_reorders)
+    assert list(results["num_customers"]) == list(num_customers)
+
+    assert (
+        results["single_order_value"],
+        results["multiple_order_value"],
+    ) == calculate_avg_order_size(buyer_user_id, all_orders)
+
+    years, orders_by_customer = calculate_time_between_orders(
+        buyer_user_id, all_orders
+    )
+    assert results["years"] == years
+    assert results["orders_by_customer"] == orders_by_customer
+    assert (
+        results["single_by_month"],
+        results["multiple_by_month"],
+    ) == find_order_dates(orders_by_customer)
+
+    assert results["state_list"].equals(count_orders_by_state(all_orders))
+    assert results["state_reorder_df"].equals(
+        calculate_reorder_rate_by_state(all_orders)
+    )
+
+
+def test_analyze_all_without_frames():
+    """
+    Test that frames=False gives the state results as plain lists
+    """
+    all_orders = read_json(ORDERS_PATH)
+    results = analyze_all(all_orders, frames=False)
+    assert results["state_list"] == (
+        count_orders_by_state(all_orders).to_dict("list")
+    )
+    assert results["state_reorder_df"] == (
+        calculate_reorder_rate_by_state(all_orders).to_dict("list")
+    )
+
+
+def test_main(tmp_path):
+    """
+    Test that the command line saves the same metrics as analyze_all
+    """
+    output_path = str(tmp_path / "metrics.json")
+    main([ORDERS_PATH, "--output", output_path])
+    metrics = read_json(output_path)
+    results = analyze_all(read_json(ORDERS_PATH), frames=False)
+    assert metrics["num_reorders"] == list(results["num_reorders"])
+    assert metrics["years"] == results["years"]
+    assert metrics["state_reorder_df"] == results["state_reorder_df"]
+
+
+def test_import_skips_pandas_and_requests():
+    """
+    Test that importing analyze_data doesn't import pandas or requests
+    """
+    output = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys, analyze_data;"
+            "print('pandas' in sys.modules, 'requests' in sys.modules)",
+        ],
+        capture_output=True,
+        check=True,
+        text=True,
+    )
+    assert output.stdout.split() == ["False", "False"]
+
+
+def test_calculate_cohort_retention():
+    """
+    Test that retention matches counting each cohort's customers by hand
+    """
+    all_orders = read_json(ORDERS_PATH)
+    cohorts, retention = calculate_cohort_retention(all_orders)
+
+    months_by_customer = {}
+    for order in all_orders:
+        date = datetime.fromtimestamp(order["create_timestamp"])
+        months_by_customer.setdefault(order["buyer_user_id"], set()).add(
+            date.year * 12 + date.month - 1
+        )
+    start = cohorts[0].astype(int) + 1970 * 12
+    expected = np.zeros(retention.shape)
+    cohort_sizes = np.zeros(len(cohorts))
+    for months in months_by_customer.values():
+        first = min(months)
+        cohort_sizes[first - start] += 1
+        for month in months:
+            expected[first - start, month - first] += 1
+
+    assert retention.shape == (len(cohorts), len(cohorts))
+    observed = ~np.isnan(retention)
+    assert (observed[cohort_sizes > 0].sum(axis=1) > 0).all()
+    assert np.allclose(
+        retention[observed],
+        (expected / np.maximum(cohort_sizes, 1)[:, None])[observed],
+    )
+    assert (retention[cohort_sizes > 0, 0] == 1).all()
+    assert np.isnan(retention[-1, 1:]).all()
+
+
+def test_windowed_functions():
+    """
+    Test that passing a time window matches analyzing only its orders
+    """
+    all_orders = read_json(ORDERS_PATH)
+    timestamps = sorted(order["create_timestamp"] for order in all_orders)
+    start, end = timestamps[len(timestamps) // 3], timestamps[-100]
+    in_window = [
+        order
+        for order in all_orders
+        if start <= order["create_timestamp"] < end
+    ]
+
+    buyer_user_id, num_reorders, num_customers = calculate_orders_per_customer(
+        all_orders, start=start, end=end
+    )
+    expected = calculate_orders_per_customer(in_window)
+    assert buyer_user_id == expected[0]
+    assert list(num_reorders) == list(expected[1])
+    assert list(num_customers) == list(expected[2])
+    assert calculate_avg_order_size(
+        buyer_user_id, all_orders, start=start, end=end
+    ) == calculate_avg_order_size(buyer_user_id, in_window)
+    assert calculate_time_between_orders(
+        buyer_user_id, all_orders, start=start, end=end
+    ) == calculate_time_between_orders(buyer_user_id, in_window)
+
+    results = analyze_all(
+        OrderTable.from_orders(all_orders), start=start, end=end
+    )
+    assert results["buyer_user_id"].tolist() == buyer_user_id
+
+
+def test_calculate_rolling_metrics():
+    """
+    Test that each rolling window matches analyzing its orders on their own
+    """
+    all_orders = read_json(ORDERS_PATH)
+    rolling_df = calculate_rolling_metrics(
+        all_orders, window_days=60, step_days=30
+    )
+    last = max(order["create_timestamp"] for order in all_orders)
+    assert rolling_df["window_end"].iloc[-1] == np.datetime64(last + 1, "s")
+
+    row = rolling_df.iloc[-3]
+    end = int(row["window_end"].timestamp())
+    in_window = [
+        order
+        for order in all_orders
+        if end - 60 * 86400 <= order["create_timestamp"] < end
+    ]
+    buyer_user_id, num_reorders, num_customers = calculate_orders_per_customer(
+        in_window
+    )
+    counts = dict(zip(num_reorders, num_customers))
+    assert row["reorder_rate"] == pytest.approx(
+        100 - counts[1] / len(set(buyer_user_id)) * 100
+    )
+    assert (
+        row["single_order_value"],
+        row["multiple_order_value"],
+    ) == calculate_avg_order_size(buyer_user_id, in_window)
+
+
+def test_calculate_order_value_by_group():
+    """
+    Test that totals per group are exact and each currency is kept apart
+    """
+    all_orders = read_json(ORDERS_PATH)
+    by_type = calculate_order_value_by_group(all_orders)
+    assert by_type["customer_type"].tolist() == ["single", "multiple"]
+    assert by_type["mean"].tolist() == list(
+        calculate_avg_order_size(
+            calculate_orders_per_customer(all_orders)[0], all_orders
+        )
+    )
+    assert by_type["amount"].sum() == sum(
+        order["subtotal"]["amount"] for order in all_orders
+    )
+
+    by_state = calculate_order_value_by_group(all_orders, by="state")
+    assert (
+        by_state["number_of_orders"].tolist()
+        == count_orders_by_state(all_orders)["number_of_orders"].tolist()
+    )
+    by_month = calculate_order_value_by_group(all_orders, by="month")
+    assert by_month["number_of_orders"].sum() == len(all_orders)
+    assert by_month["month"].is_monotonic_increasing
+
+    mixed = [
+        {
+            "buyer_user_id": buyer,
+            "state": "VA",
+            "subtotal": {
+                "amount": amount,
+                "divisor": divisor,
+                "currency_code": currency,
+            },
+            "create_timestamp": 1711485436 - buyer,
+        }
+        for buyer, amount, divisor, currency in (
+            (1, 1001, 100, "USD"),
+            (1, 2, 1, "USD"),
+            (2, 10, 10, "USD"),
+            (3, 500, 1, "JPY"),
+        )
+    ]
+    values = calculate_order_value_by_group(mixed)
+    assert values.to_dict("list") == {
+        "customer_type": ["single", "single", "multiple"],
+        "currency_code": ["USD", "JPY", "USD"],
+        "number_of_orders": [1, 1, 2],
+        "amount": [100, 50000, 1201],
+        "divisor": [100, 100, 100],
+        "total": [1.0, 500.0, 12.01],
+        "mean": [1.0, 500.0, 6.005],
+    }
+
+    buyer_user_id = calculate_orders_per_customer(mixed)[0]
+    with pytest.raises(ValueError):
+        calculate_avg_order_size(buyer_user_id, mixed)
+    assert calculate_avg_order_size(
+        buyer_user_id, mixed, currency="USD"
+    ) == pytest.approx((1.0, 6.005))
+    with pytest.raises(ValueError):
+        calculate_order_value_by_group(mixed, by="buyer")
@@ -2,8 +2,27 @@
 Test functions in api_lib library.
 """
 
+from concurrent.futures import ThreadPoolExecutor
 import pytest
-from api_lib import extract_data, clean_anonymize, get_orders, read_json
+import requests
+from id_map import IdMap
+import api_lib
+from conftest import make_receipts
+from api_lib import (
+    EtsyClient,
+    append_jsonl,
+    extract_data,
+    clean_anonymize,
+    get_all_orders,
+    get_orders,
+    iter_json,
+    iter_jsonl,
+    iter_order_pages,
+    iter_orders,
+    read_json,
+    shared_client,
+    sync_orders,
+)
 
 KEY_PATH = "keys.json"
 ORDERS_PATH = "orders.json"
@@ -218,3 +237,293 @@ def test_clean_anonymize(order_data, result):
     output = clean_anonymize(order_data)
     assert isinstance(output, list)
     assert output == result
+
+
+def test_get_orders_refreshes_expired_key(fake_etsy, key_path):
+    """
+    Test that get_orders gets a new key and retries when the key has expired
+    """
+    fake_etsy.access_token = "access-expired"
+    output = get_orders(key_path, SHOP_ID, limit=5)
+    assert len(output["results"]) == 5
+    assert fake_etsy.refresh_count == 1
+    assert read_json(key_path)["access_token"] == fake_etsy.access_token
+
+
+def test_get_orders_shares_client(fake_etsy, key_path, monkeypatch):
+    """
+    Test that get_orders calls without a client read the key once and share
+    one refresh of an expired key
+    """
+    reads = []
+
+    def counting_read_json(file_path):
+        reads.append(file_path)
+        return read_json(file_path)
+
+    monkeypatch.setattr(api_lib, "read_json", counting_read_json)
+    fake_etsy.access_token = "access-expired"
+    get_orders(key_path, SHOP_ID, limit=5)
+    num_reads = len(reads)
+    for offset in range(5, 15, 5):
+        output = get_orders(key_path, SHOP_ID, limit=5, offset=offset)
+        assert len(output["results"]) == 5
+    assert len(reads) == num_reads
+    assert fake_etsy.refresh_count == 1
+    assert shared_client(key_path) is shared_client(key_path)
+
+
+@pytest.mark.parametrize("status", [429, 500, 503])
+def test_get_orders_retries(fake_etsy, key_path, status):
+    """
+    Test that rate-limited and server error responses are retried without
+    refreshing the key
+
+    Args:
+        status: Int with the status code of the failed responses
+    """
+    fake_etsy.errors = [(status, {"Retry-After": "0"})] * 2
+    client = EtsyClient(key_path, backoff=0.01)
+    output = get_orders(key_path, SHOP_ID, limit=5, client=client)
+    assert len(output["results"]) == 5
+    assert len(fake_etsy.request_log) == 3
+    assert fake_etsy.refresh_count == 0
+
+
+def test_get_orders_gives_up(fake_etsy, key_path):
+    """
+    Test that a request still failing after every retry raises an error
+    """
+    fake_etsy.errors = [(500, {})] * 3
+    client = EtsyClient(key_path, max_retries=2, backoff=0.01)
+    with pytest.raises(requests.HTTPError):
+        get_orders(key_path, SHOP_ID, client=client)
+    assert len(fake_etsy.request_log) == 3
+
+
+def test_client_refreshes_once(fake_etsy, key_path):
+    """
+    Test that threads sharing a client refresh an expired token only once
+    """
+    client = EtsyClient(key_path)
+    fake_etsy.access_token = "access-expired"
+    url = f"{api_lib.API_URL}/shops/{SHOP_ID}/receipts"
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        outputs = list(executor.map(client.get_json, [url] * 8))
+    assert all(len(output["results"]) > 0 for output in outputs)
+    assert fake_etsy.refresh_count == 1
+    assert client.key["access_token"] == fake_etsy.access_token
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_get_all_orders(fake_etsy, key_path, tmp_path, workers):
+    """
+    Test that get_all_orders saves every order in API order for any number of
+    workers
+
+    Args:
+        workers: Int with the number of pages to fetch at the same time
+    """
+    data_path = str(tmp_path / "orders.json")
+    get_all_orders(key_path, data_path, SHOP_ID, workers=workers)
+    output = read_json(data_path)
+    assert output == clean_anonymize(fake_etsy.receipts)
+
+
+def test_iter_order_pages_requests_a_bounded_window(fake_etsy, key_path):
+    """
+    Test that pages are only requested a few at a time ahead of the consumer
+    """
+    fake_etsy.receipts = make_receipts(2000)
+    pages = iter_order_pages(key_path, SHOP_ID, workers=3)
+    first_page = next(pages)
+    assert first_page == fake_etsy.receipts[:100]
+    # The count request, the yielded page and the pages still pending
+    assert len(fake_etsy.request_log) <= 1 + 3
+    remaining = list(pages)
+    assert len(remaining) == 20
+    assert [receipt for page in remaining for receipt in page] == (
+        fake_etsy.receipts[100:]
+    )
+
+
+def test_sync_orders(fake_etsy, key_path, tmp_path):
+    """
+    Test that sync_orders only fetches new orders and keeps anonymized ids
+    the same for returning buyers
+    """
+    data_path = str(tmp_path / "orders.json")
+    id_map_path = str(tmp_path / "id_map.db")
+    all_receipts = fake_etsy.receipts
+    fake_etsy.receipts = all_receipts[60:]
+    get_all_orders(key_path, data_path, SHOP_ID, id_map_path=id_map_path)
+
+    fake_etsy.receipts = all_receipts
+    fake_etsy.request_log.clear()
+    num_new_orders = sync_orders(key_path, data_path, SHOP_ID, id_map_path)
+
+    output = read_json(data_path)
+    with IdMap(id_map_path) as id_map:
+        id_dict = dict(id_map.items())
+    assert num_new_orders == 60
+    assert len(output) == len(all_receipts)
+    for receipt, order in zip(all_receipts, output):
+        assert order["create_timestamp"] == receipt["create_timestamp"]
+        assert order["buyer_user_id"] == id_dict[receipt["buyer_user_id"]]
+    assert sorted(id_dict.values()) == list(range(1, len(id_dict) + 1))
+    for _, _, query in fake_etsy.request_log:
+        assert query["min_created"] == [
+            str(all_receipts[60]["create_timestamp"])
+        ]
+
+
+def test_get_all_orders_keeps_ids(fake_etsy, key_path, tmp_path):
+    """
+    Test that fetching every order again keeps each buyer's anonymized id
+    """
+    data_path = str(tmp_path / "orders.json")
+    id_map_path = str(tmp_path / "id_map.db")
+    all_receipts = fake_etsy.receipts
+    fake_etsy.receipts = all_receipts[100:]
+    get_all_orders(key_path, data_path, SHOP_ID, id_map_path=id_map_path)
+    with IdMap(id_map_path) as id_map:
+        first_ids = dict(id_map.items())
+
+    fake_etsy.receipts = all_receipts
+    get_all_orders(key_path, data_path, SHOP_ID, id_map_path=id_map_path)
+    with IdMap(id_map_path) as id_map:
+        id_dict = dict(id_map.items())
+    assert {buyer: id_dict[buyer] for buyer in first_ids} == first_ids
+    for receipt, order in zip(all_receipts, read_json(data_path)):
+        assert order["buyer_user_id"] == id_dict[receipt["buyer_user_id"]]
+
+
+def test_sync_orders_same_second(fake_etsy, key_path, tmp_path):
+    """
+    Test that an order created in the same second as the newest saved order
+    is added once
+    """
+    data_path = str(tmp_path / "orders.json")
+    id_map_path = str(tmp_path / "id_map.db")
+    all_receipts = fake_etsy.receipts
+    all_receipts[0]["create_timestamp"] = all_receipts[1]["create_timestamp"]
+    fake_etsy.receipts = all_receipts[1:]
+    get_all_orders(key_path, data_path, SHOP_ID, id_map_path=id_map_path)
+
+    fake_etsy.receipts = all_receipts
+    assert sync_orders(key_path, data_path, SHOP_ID, id_map_path) == 1
+    assert sync_orders(key_path, data_path, SHOP_ID, id_map_path) == 0
+    output = read_json(data_path)
+    assert [order["create_timestamp"] for order in output] == [
+        receipt["create_timestamp"] for receipt in all_receipts
+    ]
+    assert [order["subtotal"] for order in output] == [
+        receipt["subtotal"] for receipt in all_receipts
+    ]
+
+
+def test_sync_orders_needs_id_map(fake_etsy, key_path, tmp_path):
+    """
+    Test that sync_orders refuses to add to orders saved without an id map
+    """
+    data_path = str(tmp_path / "orders.json")
+    get_all_orders(key_path, data_path, SHOP_ID)
+    with pytest.raises(FileNotFoundError):
+        sync_orders(key_path, data_path, SHOP_ID, str(tmp_path / "ids.db"))
+    assert fake_etsy.refresh_count == 0
+
+
+@pytest.mark.parametrize("chunk_size", [7, 100, 65536])
+def test_iter_json(chunk_size):
+    """
+    Test that iter_json yields the same orders as read_json for any chunk size
+
+    Args:
+        chunk_size: Int with how many characters to read at once
+    """
+    assert list(iter_json(ORDERS_PATH, chunk_size=chunk_size)) == read_json(
+        ORDERS_PATH
+    )
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 4, 5])
+@pytest.mark.parametrize(
+    "text,expected",
+    [
+        ("[1, 23, 456]", [1, 23, 456]),
+        (" [\n1,\n23,456 ]\n", [1, 23, 456]),
+        ("[1.5, 2e3, 7]", [1.5, 2000.0, 7]),
+        ("[-0.25,3.5E-2,1e+2]", [-0.25, 0.035, 100.0]),
+    ],
+)
+def test_iter_json_numbers(tmp_path, text, expected, chunk_size):
+    """
+    Test that integers, floats and exponents split across chunks are read
+    whole
+
+    Args:
+        text: String with the JSON array to read
+        expected: List of the numbers in text
+        chunk_size: Int with how many characters to read at once
+    """
+    path = tmp_path / "numbers.json"
+    path.write_text(text, encoding="utf-8")
+    assert list(iter_json(str(path), chunk_size=chunk_size)) == expected
+
+
+def test_append_jsonl(tmp_path):
+    """
+    Test that orders appended with append_jsonl are read back in order
+    """
+    path = str(tmp_path / "orders.jsonl")
+    orders = read_json(ORDERS_PATH)
+    assert append_jsonl(path, orders[:10]) == 10
+    assert append_jsonl(path, orders[10:20]) == 10
+    assert list(iter_jsonl(path)) == orders[:20]
+    assert list(iter_orders(path)) == orders[:20]
+    assert list(iter_orders(ORDERS_PATH)) == orders
+
+
+def test_get_all_orders_stream_failure(
+    fake_etsy, key_path, tmp_path, monkeypatch
+):
+    """
+    Test that a streamed fetch that fails halfway leaves the saved orders
+    as they were
+    """
+    data_path = str(tmp_path / "orders.jsonl")
+    get_all_orders(key_path, data_path, SHOP_ID, stream=True)
+    saved = list(iter_jsonl(data_path))
+
+    def failing_pages(*args, **kwargs):
+        yield fake_etsy.receipts[:10]
+        raise requests.ConnectionError("connection lost")
+
+    monkeypatch.setattr(api_lib, "iter_order_pages", failing_pages)
+    with pytest.raises(requests.ConnectionError):
+        get_all_orders(key_path, data_path, SHOP_ID, stream=True)
+    assert list(iter_jsonl(data_path)) == saved
+
+
+def test_get_all_orders_stream(fake_etsy, key_path, tmp_path):
+    """
+    Test that streaming get_all_orders saves the same orders as JSON lines,
+    and that sync_orders appends new orders to them
+    """
+    data_path = str(tmp_path / "orders.jsonl")
+    id_map_path = str(tmp_path / "id_map.db")
+    all_receipts = fake_etsy.receipts
+    fake_etsy.receipts = all_receipts[30:]
+    get_all_orders(
+        key_path, data_path, SHOP_ID, id_map_path=id_map_path, stream=True
+    )
+    assert list(iter_jsonl(data_path)) == clean_anonymize(all_receipts[30:])
+
+    fake_etsy.receipts = all_receipts
+    assert sync_orders(key_path, data_path, SHOP_ID, id_map_path) == 30
+    output = list(iter_jsonl(data_path))
+    assert len(output) == len(all_receipts)
+    assert (
+        output[-30:][0]["create_timestamp"]
+        == all_receipts[0]["create_timestamp"]
+    )
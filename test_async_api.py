@@ -0,0 +1,155 @@
+"""
+Test functions in async_api file.
+"""
+
+import asyncio
+import pytest
+import api_lib
+import async_api
+from id_map import IdMap
+from api_lib import clean_anonymize, iter_jsonl, read_json
+from async_api import AsyncEtsyClient, get_all_orders, get_orders
+
+httpx = pytest.importorskip("httpx")
+
+SHOP_ID = 23574688
+
+
+def test_get_orders_refreshes_expired_key(fake_etsy, key_path):
+    """
+    Test that get_orders gets a new key and retries when the key has expired
+    """
+    fake_etsy.access_token = "access-expired"
+    output = asyncio.run(get_orders(key_path, SHOP_ID, limit=5))
+    assert len(output["results"]) == 5
+    assert fake_etsy.refresh_count == 1
+    assert read_json(key_path)["access_token"] == fake_etsy.access_token
+
+
+@pytest.mark.parametrize("status", [429, 500, 503])
+def test_get_orders_retries(fake_etsy, key_path, status):
+    """
+    Test that rate-limited and server error responses are retried without
+    refreshing the key
+
+    Args:
+        status: Int with the status code of the failed responses
+    """
+
+    async def get():
+        async with AsyncEtsyClient(key_path, backoff=0.01) as client:
+            return await get_orders(key_path, SHOP_ID, limit=5, client=client)
+
+    fake_etsy.errors = [(status, {"Retry-After": "0"})] * 2
+    output = asyncio.run(get())
+    assert len(output["results"]) == 5
+    assert len(fake_etsy.request_log) == 3
+    assert fake_etsy.refresh_count == 0
+
+
+def test_get_orders_gives_up(fake_etsy, key_path):
+    """
+    Test that a request still failing after every retry raises an error
+    """
+
+    async def get():
+        async with AsyncEtsyClient(
+            key_path, max_retries=2, backoff=0.01
+        ) as client:
+            return await get_orders(key_path, SHOP_ID, client=client)
+
+    fake_etsy.errors = [(500, {})] * 3
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(get())
+    assert len(fake_etsy.request_log) == 3
+
+
+def test_client_refreshes_once(fake_etsy, key_path):
+    """
+    Test that tasks sharing a client refresh an expired token only once
+    """
+
+    async def get_all():
+        async with AsyncEtsyClient(key_path) as client:
+            url = f"{api_lib.API_URL}/shops/{SHOP_ID}/receipts"
+            outputs = await asyncio.gather(
+                *(client.get_json(url) for _ in range(8))
+            )
+            return outputs, client.key
+
+    fake_etsy.access_token = "access-expired"
+    outputs, key = asyncio.run(get_all())
+    assert all(len(output["results"]) > 0 for output in outputs)
+    assert fake_etsy.refresh_count == 1
+    assert key["access_token"] == fake_etsy.access_token
+
+
+@pytest.mark.parametrize("concurrency", [1, 4])
+@pytest.mark.parametrize("stream", [False, True])
+def test_get_all_orders(fake_etsy, key_path, tmp_path, concurrency, stream):
+    """
+    Test that get_all_orders saves every order in API order for any
+    concurrency
+
+    Args:
+        concurrency: Int with the number of pages to fetch at the same time
+        stream: Whether to save orders as newline-delimited JSON
+    """
+    data_path = str(tmp_path / "orders.json")
+    asyncio.run(
+        get_all_orders(
+            key_path,
+            data_path,
+            SHOP_ID,
+            concurrency=concurrency,
+            stream=stream,
+        )
+    )
+    output = list(iter_jsonl(data_path)) if stream else read_json(data_path)
+    assert output == clean_anonymize(fake_etsy.receipts)
+
+
+def test_get_all_orders_stream_failure(
+    fake_etsy, key_path, tmp_path, monkeypatch
+):
+    """
+    Test that a streamed fetch that fails halfway leaves the saved orders
+    as they were
+    """
+    data_path = str(tmp_path / "orders.jsonl")
+    asyncio.run(get_all_orders(key_path, data_path, SHOP_ID, stream=True))
+    saved = list(iter_jsonl(data_path))
+
+    async def failing_pages(*args, **kwargs):
+        yield fake_etsy.receipts[:10]
+        raise httpx.ConnectError("connection lost")
+
+    monkeypatch.setattr(async_api, "iter_order_pages", failing_pages)
+    with pytest.raises(httpx.ConnectError):
+        asyncio.run(get_all_orders(key_path, data_path, SHOP_ID, stream=True))
+    assert list(iter_jsonl(data_path)) == saved
+
+
+def test_get_all_orders_keeps_ids(fake_etsy, key_path, tmp_path):
+    """
+    Test that fetching every order again keeps each buyer's anonymized id
+    """
+    data_path = str(tmp_path / "orders.json")
+    id_map_path = str(tmp_path / "id_map.db")
+    all_receipts = fake_etsy.receipts
+    fake_etsy.receipts = all_receipts[100:]
+    asyncio.run(
+        get_all_orders(key_path, data_path, SHOP_ID, id_map_path=id_map_path)
+    )
+    with IdMap(id_map_path) as id_map:
+        first_ids = dict(id_map.items())
+
+    fake_etsy.receipts = all_receipts
+    asyncio.run(
+        get_all_orders(key_path, data_path, SHOP_ID, id_map_path=id_map_path)
+    )
+    with IdMap(id_map_path) as id_map:
+        id_dict = dict(id_map.items())
+    assert {buyer: id_dict[buyer] for buyer in first_ids} == first_ids
+    for receipt, order in zip(all_receipts, read_json(data_path)):
+        assert order["buyer_user_id"] == id_dict[receipt["buyer_user_id"]]
@@ -0,0 +1,71 @@
+"""
+Test functions in batch file.
+"""
+
+import os
+import shutil
+from batch import RESULTS_FILE, run_batch
+from conftest import make_receipts
+
+
+def make_shops(key_path, tmp_path, num_shops):
+    """
+    Lists shops that each have their own copy of the fake shop's keys
+
+    Args:
+        key_path: String with path to keys the fake_etsy shop accepts
+        tmp_path: Path to a temporary directory
+        num_shops: Int with how many shops to list
+
+    Returns:
+        List of shop dicts
+    """
+    shops = []
+    for shop_id in range(1, num_shops + 1):
+        shop_key_path = str(tmp_path / f"keys_{shop_id}.json")
+        shutil.copy(key_path, shop_key_path)
+        shops.append({"shop_id": shop_id, "key_path": shop_key_path})
+    return shops
+
+
+def test_run_batch(fake_etsy, key_path, tmp_path):
+    """
+    Test that every shop is fetched and analyzed and a failing shop doesn't
+    stop the others
+    """
+    fake_etsy.receipts = make_receipts(250, num_buyers=200)
+    shops = make_shops(key_path, tmp_path, 3)
+    shops.append({"shop_id": 99, "key_path": str(tmp_path / "missing.json")})
+    output_dir = str(tmp_path / "batch")
+
+    results = run_batch(shops, output_dir, max_connections=4, fetch_workers=2)
+
+    assert results["shop_id"].tolist() == ["1", "2", "3", "99"]
+    assert results["status"].tolist() == ["ok", "ok", "ok", "failed"]
+    assert "FileNotFoundError" in results["error"].iloc[3]
+    assert (results["num_orders"].iloc[:3] == len(fake_etsy.receipts)).all()
+    assert (results["num_customers"].iloc[:3] == 200).all()
+    assert (results["repeat_customers"].iloc[:3] == 50).all()
+    assert os.path.exists(os.path.join(output_dir, RESULTS_FILE))
+    assert os.path.exists(os.path.join(output_dir, "1", "orders.json"))
+
+
+def test_run_batch_resumes(fake_etsy, key_path, tmp_path):
+    """
+    Test that running a batch again only refetches shops that failed
+    """
+    fake_etsy.receipts = make_receipts(250, num_buyers=200)
+    shops = make_shops(key_path, tmp_path, 2)
+    output_dir = str(tmp_path / "batch")
+    shutil.move(shops[1]["key_path"], str(tmp_path / "later.json"))
+    first = run_batch(shops, output_dir)
+    assert first["status"].tolist() == ["ok", "failed"]
+
+    num_requests = len(fake_etsy.request_log)
+    shutil.move(str(tmp_path / "later.json"), shops[1]["key_path"])
+    second = run_batch(shops, output_dir)
+
+    assert second["status"].tolist() == ["ok", "ok"]
+    assert second.iloc[0].equals(first.iloc[0])
+    # Only the second shop's pages were requested again.
+    assert len(fake_etsy.request_log) - num_requests == 4
@@ -0,0 +1,134 @@
+"""
+Test functions in benchmark file.
+"""
+
+from collections import Counter
+import pytest
+from benchmark import (
+    BenchmarkInputs,
+    benchmark_cases,
+    compare_benchmarks,
+    generate_order_table,
+    generate_orders,
+    parallel_speedups,
+    run_benchmarks,
+)
+
+generate_cases = [
+    # Test a small shop with only single-order customers
+    (50, {1: 1.0}, {"CO": 1}),
+    # Test a shop where every customer orders twice
+    (1000, {2: 1.0}, {"CO": 1, "VA": 3}),
+    # Test the default distributions
+    (1234, None, None),
+]
+
+
+@pytest.mark.parametrize(
+    "num_orders,orders_per_customer,state_weights", generate_cases
+)
+def test_generate_orders(num_orders, orders_per_customer, state_weights):
+    """
+    Test that synthetic orders have the orders.json format and distributions
+
+    Args:
+        num_orders: Int with how many orders to generate
+        orders_per_customer: Dict mapping a number of orders to the share of
+        customers placing that many orders
+        state_weights: Dict mapping state names to how likely they are
+    """
+    orders = generate_orders(
+        num_orders,
+        orders_per_customer=orders_per_customer,
+        state_weights=state_weights,
+    )
+    assert len(orders) == num_orders
+    assert set(orders[0]) == {
+        "buyer_user_id",
+        "state",
+        "subtotal",
+        "create_timestamp",
+    }
+    timestamps = [order["create_timestamp"] for order in orders]
+    assert timestamps == sorted(timestamps, reverse=True)
+
+    counts = Counter(order["buyer_user_id"] for order in orders)
+    if orders_per_customer == {1: 1.0}:
+        assert set(counts.values()) == {1}
+    if orders_per_customer == {2: 1.0}:
+        assert set(counts.values()) == {2}
+    if state_weights is not None:
+        assert {order["state"] for order in orders} <= set(state_weights)
+
+
+def test_generate_order_table_seed():
+    """
+    Test that the same seed generates the same shop
+    """
+    first = generate_order_table(500, seed=3)
+    second = generate_order_table(500, seed=3)
+    assert first.buyer_user_id.tolist() == second.buyer_user_id.tolist()
+    assert first.amount.tolist() == second.amount.tolist()
+
+
+def test_run_benchmarks():
+    """
+    Test that every function is measured and results can be compared
+    """
+    results = run_benchmarks(sizes=[200], repeat=1)
+    measured = {result["function"] for result in results["results"]}
+    assert "analyze_all" in measured
+    assert "clean_anonymize" in measured
+    assert "save_to_json" in measured
+    for result in results["results"]:
+        assert result["seconds"] >= 0
+        assert result["peak_bytes"] >= 0
+
+    comparison = compare_benchmarks(results, results)
+    assert len(comparison) == len(results["results"])
+    assert all(change["seconds_ratio"] == 1 for change in comparison)
+
+
+def test_parallel_speedups():
+    """
+    Test that analyze_parallel is compared with analyze_all on each input
+    """
+    results = {
+        "results": [
+            {
+                "function": function,
+                "input": input_name,
+                "num_orders": 100,
+                "seconds": seconds,
+            }
+            for function, input_name, seconds in (
+                ("analyze_all", "list", 3.0),
+                ("analyze_parallel", "list", 1.5),
+                ("analyze_all", "table", 2.0),
+            )
+        ]
+    }
+    assert parallel_speedups(results) == [
+        {"input": "list", "num_orders": 100, "speedup": 2.0}
+    ]
+
+
+def test_benchmark_cases_build_inputs_lazily(tmp_path):
+    """
+    Test that cases only build the inputs they need, and the dict case of
+    find_order_dates is given a dict
+    """
+    inputs = BenchmarkInputs(300, str(tmp_path))
+    cases = benchmark_cases(inputs)
+    for _, input_name, setup in cases:
+        if input_name == "table":
+            setup()
+    assert "orders" not in vars(inputs)
+    assert not (tmp_path / "orders.json").exists()
+
+    (setup,) = [
+        setup
+        for name, input_name, setup in cases
+        if (name, input_name) == ("find_order_dates", "dict")
+    ]
+    assert isinstance(setup().args[0], dict)
@@ -0,0 +1,109 @@
+"""
+Test functions in chunked file.
+"""
+
+import pytest
+from analyze_data import analyze_all
+from api_lib import read_json
+from chunked import (
+    PartialAggregates,
+    analyze_chunked,
+    chunk_size_for_budget,
+    iter_order_chunks,
+)
+from order_table import OrderTable, read_order_table, save_order_table
+
+ORDERS_PATH = "orders.json"
+
+METRICS = (
+    "num_reorders",
+    "num_customers",
+    "single_by_month",
+    "multiple_by_month",
+)
+
+
+def assert_same_results(results, expected):
+    """
+    Asserts that chunked results match the results of analyze_all
+
+    Args:
+        results: Dict returned by analyze_chunked
+        expected: Dict returned by analyze_all
+    """
+    for metric in METRICS:
+        assert list(results[metric]) == list(expected[metric])
+    assert results["single_order_value"] == expected["single_order_value"]
+    assert results["multiple_order_value"] == expected["multiple_order_value"]
+    assert results["state_list"].equals(expected["state_list"])
+    assert results["state_reorder_df"].equals(expected["state_reorder_df"])
+
+
+@pytest.mark.parametrize("chunk_size", [1, 97, 1000000])
+def test_analyze_chunked_matches_analyze_all(chunk_size):
+    """
+    Test that any chunk size gives exactly the results of analyze_all
+
+    Args:
+        chunk_size: Int with how many orders to read at once
+    """
+    expected = analyze_all(read_json(ORDERS_PATH))
+    results = analyze_chunked(ORDERS_PATH, chunk_size=chunk_size)
+    assert_same_results(results, expected)
+
+
+def test_analyze_chunked_store(tmp_path):
+    """
+    Test that a saved column store gives the same results as its JSON
+    """
+    store_path = str(tmp_path / "orders")
+    table = read_order_table(ORDERS_PATH)
+    save_order_table(store_path, table)
+    results = analyze_chunked(store_path, memory_budget=100000)
+    assert_same_results(results, analyze_all(table))
+
+
+def test_merge_order_does_not_matter():
+    """
+    Test that merging chunks from last to first gives the same results
+    """
+    table = read_order_table(ORDERS_PATH)
+    aggregates = PartialAggregates()
+    for start, chunk in reversed(list(iter_order_chunks(table, 250))):
+        aggregates = PartialAggregates.from_table(chunk, start).merge(
+            aggregates
+        )
+    assert_same_results(aggregates.results(), analyze_all(table))
+
+
+@pytest.mark.parametrize("chunk_size", [1, 97])
+def test_analyze_chunked_by_currency(chunk_size):
+    """
+    Test that subtotals of different currencies are never averaged together,
+    even when each chunk is in one currency
+
+    Args:
+        chunk_size: Int with how many orders to read at once
+    """
+    all_orders = read_json(ORDERS_PATH)
+    for order in all_orders[::3]:
+        order["subtotal"]["currency_code"] = "EUR"
+        order["subtotal"]["divisor"] = 1000
+        order["subtotal"]["amount"] *= 10
+    table = OrderTable.from_orders(all_orders)
+
+    with pytest.raises(ValueError, match="more than one currency"):
+        analyze_chunked(table, chunk_size=chunk_size)
+    for currency in ("EUR", "USD"):
+        results = analyze_chunked(
+            table, chunk_size=chunk_size, currency=currency
+        )
+        assert_same_results(results, analyze_all(table, currency=currency))
+
+
+def test_chunk_size_for_budget():
+    """
+    Test that chunk sizes grow with the budget and are at least 1
+    """
+    assert chunk_size_for_budget(0) == 1
+    assert chunk_size_for_budget(2**20) < chunk_size_for_budget(2**30)
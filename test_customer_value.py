@@ -0,0 +1,112 @@
+"""
+Test functions in customer_value file.
+"""
+
+import numpy as np
+import pytest
+from api_lib import read_json
+from customer_value import calculate_customer_value
+from order_table import OrderTable
+
+ORDERS_PATH = "orders.json"
+
+orders = [
+    {
+        "buyer_user_id": 1,
+        "state": "VA",
+        "subtotal": {"amount": 9000, "divisor": 100, "currency_code": "USD"},
+        "create_timestamp": 1711485436,
+    },
+    {
+        "buyer_user_id": 2,
+        "state": "VA",
+        "subtotal": {"amount": 4800, "divisor": 100, "currency_code": "USD"},
+        "create_timestamp": 1711472846,
+    },
+    {
+        "buyer_user_id": 1,
+        "state": "VA",
+        "subtotal": {"amount": 250, "divisor": 10, "currency_code": "USD"},
+        "create_timestamp": 1680000000,
+    },
+    {
+        "buyer_user_id": 3,
+        "state": "TX",
+        "subtotal": {"amount": 1500, "divisor": 100, "currency_code": "USD"},
+        "create_timestamp": 1600000000,
+    },
+]
+
+
+def test_calculate_customer_value():
+    """
+    Test the scores and values of a few customers worked out by hand
+    """
+    customer_df = calculate_customer_value(orders, bins=3, horizon_years=2)
+    assert customer_df["buyer_user_id"].tolist() == [1, 2, 3]
+    assert customer_df["frequency"].tolist() == [2, 1, 1]
+    assert customer_df["monetary"].tolist() == [115.0, 48.0, 15.0]
+    assert customer_df["recency_days"].tolist() == pytest.approx(
+        [0, 12590 / 86400, 111485436 / 86400]
+    )
+    assert customer_df["r_score"].tolist() == [3, 2, 1]
+    assert customer_df["f_score"].tolist() == [3, 1, 1]
+    assert customer_df["m_score"].tolist() == [3, 2, 1]
+    assert customer_df["rfm_score"].tolist() == [333, 212, 111]
+    tenure_years = 111485436 / 86400 / 365.25
+    assert customer_df["clv"].tolist() == pytest.approx(
+        [115 * 2, 48 * 2, 15 / tenure_years * 2]
+    )
+
+
+def test_calculate_customer_value_matches_loop():
+    """
+    Test that grouping matches summing every customer's orders in a loop
+    """
+    all_orders = read_json(ORDERS_PATH)
+    customer_df = calculate_customer_value(OrderTable.from_orders(all_orders))
+
+    totals, counts, last = {}, {}, {}
+    for order in all_orders:
+        buyer = order["buyer_user_id"]
+        subtotal = order["subtotal"]
+        totals[buyer] = (
+            totals.get(buyer, 0) + subtotal["amount"] / subtotal["divisor"]
+        )
+        counts[buyer] = counts.get(buyer, 0) + 1
+        last[buyer] = max(last.get(buyer, 0), order["create_timestamp"])
+
+    assert customer_df["buyer_user_id"].tolist() == list(totals)
+    assert customer_df["frequency"].tolist() == list(counts.values())
+    assert customer_df["monetary"].tolist() == pytest.approx(
+        list(totals.values())
+    )
+    as_of = max(last.values())
+    assert customer_df["recency_days"].tolist() == pytest.approx(
+        [(as_of - time) / 86400 for time in last.values()]
+    )
+    for score in ("r_score", "f_score", "m_score"):
+        assert customer_df[score].between(1, 5).all()
+    assert np.all(np.diff(customer_df.sort_values("monetary")["m_score"]) >= 0)
+
+
+def test_calculate_customer_value_bins():
+    """
+    Test that scores that don't fit in one digit are rejected
+    """
+    with pytest.raises(ValueError):
+        calculate_customer_value(orders, bins=10)
+
+
+def test_calculate_customer_value_by_currency():
+    """
+    Test that subtotals in different currencies are never added together
+    """
+    mixed = [dict(order, subtotal=dict(order["subtotal"])) for order in orders]
+    mixed[0]["subtotal"]["currency_code"] = "EUR"
+    with pytest.raises(ValueError, match="more than one currency"):
+        calculate_customer_value(mixed)
+
+    customer_df = calculate_customer_value(mixed, currency="USD")
+    assert customer_df["monetary"].tolist() == [25.0, 48.0, 15.0]
+    assert customer_df["frequency"].tolist() == [2, 1, 1]
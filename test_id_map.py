@@ -0,0 +1,58 @@
+"""
+Test functions in id_map file.
+"""
+
+from api_lib import clean_anonymize, iter_clean_anonymize
+from id_map import IdMap
+
+receipts = [
+    {"buyer_user_id": 4023984, "state": "MA", "create_timestamp": 3},
+    {"buyer_user_id": 8542943928, "state": "CO", "create_timestamp": 2},
+    {"buyer_user_id": 4023984, "state": "MA", "create_timestamp": 1},
+]
+for receipt in receipts:
+    receipt["subtotal"] = {
+        "amount": 100,
+        "divisor": 100,
+        "currency_code": "USD",
+    }
+
+
+def test_id_map_persists(tmp_path):
+    """
+    Test that ids written to an IdMap are there after reopening it
+    """
+    path = str(tmp_path / "ids.db")
+    with IdMap(path, batch_size=1) as id_map:
+        id_map[4023984] = 1
+        id_map[8542943928] = 2
+    with IdMap(path) as id_map:
+        assert len(id_map) == 2
+        assert id_map[8542943928] == 2
+        assert 555 not in id_map
+        assert id_map.get(555) is None
+
+
+def test_id_map_batches_writes(tmp_path):
+    """
+    Test that new ids can be read before their batch is written
+    """
+    path = str(tmp_path / "ids.db")
+    with IdMap(path, batch_size=100) as id_map:
+        for buyer_user_id in range(250):
+            id_map[buyer_user_id] = buyer_user_id + 1
+        assert id_map[249] == 250
+        assert len(id_map) == 250
+
+
+def test_clean_anonymize_with_id_map(tmp_path):
+    """
+    Test that returning buyers keep their id across runs with an IdMap
+    """
+    path = str(tmp_path / "ids.db")
+    with IdMap(path) as id_map:
+        first_run = clean_anonymize(receipts[1:], id_map)
+    with IdMap(path) as id_map:
+        second_run = list(iter_clean_anonymize(receipts[:1], id_map))
+    assert [order["buyer_user_id"] for order in first_run] == [1, 2]
+    assert second_run[0]["buyer_user_id"] == 2
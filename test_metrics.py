@@ -0,0 +1,161 @@
+"""
+Test functions in metrics file.
+"""
+
+import json
+import numpy as np
+import metrics
+from analyze_data import analyze_all, main
+from api_lib import EtsyClient, get_orders, read_json
+from metrics import (
+    JsonLinesSink,
+    MemorySink,
+    PrometheusSink,
+    instrument,
+    recording,
+    stage,
+)
+
+ORDERS_PATH = "orders.json"
+SHOP_ID = 23574688
+
+
+def records_by_stage(sink):
+    """
+    Groups a MemorySink's records by stage name
+
+    Args:
+        sink: MemorySink with records
+
+    Returns:
+        Dict mapping each stage name to a list of its records
+    """
+    grouped = {}
+    for record in sink.records:
+        grouped.setdefault(record["stage"], []).append(record)
+    return grouped
+
+
+def test_nothing_recorded_without_sink():
+    """
+    Test that stages and counters do nothing while recording is off
+    """
+    calls = []
+
+    @instrument
+    def work():
+        calls.append(1)
+        metrics.increment("rows", 5)
+        return "done"
+
+    assert not metrics.enabled()
+    assert work() == "done"
+    with stage("unrecorded") as running:
+        assert running is stage("another")
+    assert calls == [1]
+
+
+def test_stages_count_rows_and_nest():
+    """
+    Test that analyze_all and the functions it calls are recorded with the
+    rows they processed
+    """
+    orders = read_json(ORDERS_PATH)
+    with recording(MemorySink()) as sink:
+        analyze_all(orders)
+    assert not metrics.enabled()
+
+    grouped = records_by_stage(sink)
+    assert len(grouped["analyze_all"]) == 1
+    assert len(grouped["find_order_dates"]) == 1
+    record = grouped["analyze_all"][0]
+    assert record["rows"] == len(orders)
+    assert record["seconds"] >= grouped["find_order_dates"][0]["seconds"]
+    assert record["peak_bytes"] is None
+    assert set(metrics.COUNTERS) <= set(record)
+
+
+def test_peak_memory():
+    """
+    Test that an outer stage's peak includes the peak of a stage inside it
+    """
+
+    @instrument
+    def allocate():
+        return np.ones(2**20).sum()
+
+    with recording(MemorySink(), trace_memory=True) as sink:
+        with stage("outer"):
+            allocate()
+
+    inner, outer = sink.records
+    assert inner["stage"] == allocate.__qualname__
+    assert inner["peak_bytes"] >= 8 * 2**20
+    assert outer["peak_bytes"] >= inner["peak_bytes"]
+
+
+def test_api_counters(fake_etsy, key_path):
+    """
+    Test that requests, retries, token refreshes and bytes are counted
+    """
+    fake_etsy.access_token = "access-expired"
+    fake_etsy.errors = [(429, {"Retry-After": "0"})]
+    client = EtsyClient(key_path, backoff=0.01)
+    with recording(MemorySink()) as sink:
+        get_orders(key_path, SHOP_ID, limit=5, client=client)
+
+    grouped = records_by_stage(sink)
+    record = grouped["get_orders"][0]
+    assert record["http_requests"] == len(fake_etsy.request_log)
+    assert record["retries"] == 1
+    assert record["token_refreshes"] == 1
+    assert record["bytes_downloaded"] > 0
+    assert len(grouped["refresh_key"]) == 1
+
+
+def test_file_sinks(tmp_path):
+    """
+    Test that records are saved as JSON lines and totaled in Prometheus text
+    format
+    """
+    jsonl_path = str(tmp_path / "metrics.jsonl")
+    prom_path = str(tmp_path / "metrics.prom")
+    prometheus = PrometheusSink(prom_path)
+    with recording(JsonLinesSink(jsonl_path)):
+        for _ in range(2):
+            with stage("load"):
+                metrics.increment("rows", 3)
+    with recording(prometheus):
+        for _ in range(2):
+            with stage('say "hi"'):
+                metrics.increment("rows", 3)
+
+    with open(jsonl_path, encoding="utf-8") as file:
+        records = [json.loads(line) for line in file]
+    assert [record["rows"] for record in records] == [3, 3]
+
+    with open(prom_path, encoding="utf-8") as file:
+        lines = file.read().splitlines()
+    assert "# TYPE shop_analysis_stage_rows_total counter" in lines
+    assert 'shop_analysis_stage_rows_total{stage="say \\"hi\\""} 6' in lines
+    assert 'shop_analysis_stage_runs_total{stage="say \\"hi\\""} 2' in lines
+
+
+def test_main_metrics(tmp_path):
+    """
+    Test that the command line records its stages when asked to
+    """
+    metrics_path = str(tmp_path / "stages.jsonl")
+    main(
+        [
+            ORDERS_PATH,
+            "--output",
+            str(tmp_path / "out.json"),
+            "--metrics",
+            metrics_path,
+        ]
+    )
+    with open(metrics_path, encoding="utf-8") as file:
+        stages = [json.loads(line)["stage"] for line in file]
+    assert "analyze_all" in stages
+    assert not metrics.enabled()
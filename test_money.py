@@ -0,0 +1,63 @@
+"""
+Test functions in money file.
+"""
+
+from fractions import Fraction
+import numpy as np
+from money import common_divisor, divide, mean_of_sums, sum_by_group
+
+
+def test_common_divisor():
+    """
+    Test that the common divisor is the least common multiple
+    """
+    assert common_divisor([]) == 1
+    assert common_divisor(np.array([100, 1, 1000])) == 1000
+    assert common_divisor([4, 6]) == 12
+
+
+def test_sum_by_group_is_exact():
+    """
+    Test that group sums and means match exact fractions
+    """
+    rng = np.random.default_rng(0)
+    amount = rng.integers(1, 10**9, size=5000)
+    divisor = rng.choice([1, 100, 1000], size=5000)
+    group_codes = rng.integers(0, 7, size=5000)
+    sums, counts, common = sum_by_group(amount, divisor, group_codes, 8)
+
+    assert counts.tolist() == np.bincount(group_codes, minlength=8).tolist()
+    means = divide(sums, counts * common)
+    for group in range(7):
+        in_group = group_codes == group
+        total = sum(
+            Fraction(int(value), int(scale))
+            for value, scale in zip(amount[in_group], divisor[in_group])
+        )
+        assert Fraction(int(sums[group]), common) == total
+        assert means[group] == float(total / int(counts[group]))
+    assert np.isnan(means[7])
+
+
+def test_sum_by_group_does_not_overflow():
+    """
+    Test that sums too large for int64 are added as Python ints
+    """
+    amount = np.array([2**62, 2**62, 3, 2**61], dtype=np.int64)
+    divisor = np.array([100, 100, 7, 100])
+    sums, counts, common = sum_by_group(amount, divisor, [0, 0, 1, 1], 2)
+
+    assert common == 700
+    assert sums.tolist() == [2**63 * 7, 3 * 100 + 2**61 * 7]
+    assert counts.tolist() == [2, 2]
+
+
+def test_mean_of_sums_rounds_once():
+    """
+    Test that huge sums are divided exactly before rounding
+    """
+    sums = [2**60 + 1, 3]
+    divisors = [100, 7]
+    expected = (Fraction(2**60 + 1, 100) + Fraction(3, 7)) / 3
+    assert mean_of_sums(divisors, sums, 3) == float(expected)
+    assert np.isnan(mean_of_sums([100], [0], 0))
@@ -0,0 +1,238 @@
+"""
+Test functions in order_table file.
+"""
+
+from datetime import datetime
+import time
+import tracemalloc
+import numpy as np
+import pytest
+from analyze_data import (
+    calculate_orders_per_customer,
+    calculate_reorder_rate_by_state,
+)
+from order_table import (
+    SECONDS_PER_DAY,
+    OrderTable,
+    as_order_table,
+    convert_json_to_store,
+    factorize,
+    load_order_table,
+    local_months,
+    local_seconds,
+    read_order_table,
+    save_order_table,
+)
+
+ORDERS_PATH = "orders.json"
+
+orders = [
+    {
+        "buyer_user_id": 1,
+        "state": "VA",
+        "subtotal": {"amount": 9000, "divisor": 100, "currency_code": "USD"},
+        "create_timestamp": 1711485436,
+    },
+    {
+        "buyer_user_id": 2,
+        "state": "TX",
+        "subtotal": {"amount": 4850, "divisor": 100, "currency_code": "USD"},
+        "create_timestamp": 1711472846,
+    },
+    {
+        "buyer_user_id": 1,
+        "state": "VA",
+        "subtotal": {"amount": 1200, "divisor": 100, "currency_code": "USD"},
+        "create_timestamp": 1711400574,
+    },
+]
+
+factorize_cases = [
+    # Test that codes follow the order values first appear in
+    ([5, 3, 5, 9, 3], [0, 1, 0, 2, 1], [5, 3, 9]),
+    # Test a single repeated value
+    ([7, 7, 7], [0, 0, 0], [7]),
+    # Test that it works with strings
+    (["VA", "CO", "VA"], [0, 1, 0], ["VA", "CO"]),
+]
+
+
+def test_from_orders():
+    """
+    Test that every column is loaded with the right values and types
+    """
+    table = OrderTable.from_orders(orders)
+    assert len(table) == 3
+    assert table.buyer_user_id.dtype == np.int64
+    assert table.buyer_user_id.tolist() == [1, 2, 1]
+    assert table.states.tolist() == ["VA", "TX"]
+    assert table.state.tolist() == ["VA", "TX", "VA"]
+    assert table.amount.tolist() == [9000, 4850, 1200]
+    assert table.subtotal.tolist() == [90.0, 48.5, 12.0]
+    assert table.create_timestamp.tolist() == [
+        1711485436,
+        1711472846,
+        1711400574,
+    ]
+
+
+def test_from_orders_selected_columns():
+    """
+    Test that only requested columns are loaded and others can be missing
+    """
+    table = OrderTable.from_orders(
+        [{"buyer_user_id": 4, "state": "CO"}], ("buyer_user_id", "state")
+    )
+    assert len(table) == 1
+    assert table.amount is None
+    assert table.create_timestamp is None
+
+
+def test_as_order_table():
+    """
+    Test that tables are passed through and lists are converted
+    """
+    table = OrderTable.from_orders(orders)
+    assert as_order_table(table) is table
+    assert as_order_table(orders).buyer_user_id.tolist() == [1, 2, 1]
+
+
+def test_read_order_table():
+    """
+    Test that read_order_table loads every order at ORDERS_PATH
+    """
+    table = read_order_table(ORDERS_PATH)
+    assert len(table) > 0
+    assert len(table.buyer_user_id) == len(table.create_timestamp)
+
+
+@pytest.mark.parametrize("values,codes,uniques", factorize_cases)
+def test_factorize(values, codes, uniques):
+    """
+    Test that factorize encodes values in order of first appearance
+
+    Args:
+        values: List of values to encode
+        codes: Expected code of each value
+        uniques: Expected distinct values
+    """
+    output_codes, output_uniques = factorize(np.array(values))
+    assert output_codes.tolist() == codes
+    assert output_uniques.tolist() == uniques
+
+
+def test_convert_json_to_store(tmp_path):
+    """
+    Test that a converted store loads memory-mapped with the same data
+    """
+    store_path = str(tmp_path / "orders")
+    num_orders = convert_json_to_store(ORDERS_PATH, store_path)
+    table = read_order_table(ORDERS_PATH)
+    loaded = load_order_table(store_path)
+    assert num_orders == len(table) == len(loaded)
+    assert isinstance(loaded.create_timestamp, np.memmap)
+    assert loaded.buyer_user_id.dtype == np.int32
+    assert loaded.buyer_user_id.tolist() == table.buyer_user_id.tolist()
+    assert loaded.state.tolist() == table.state.tolist()
+    assert loaded.subtotal.tolist() == table.subtotal.tolist()
+    assert (
+        loaded.currency.tolist()
+        == table.currency.tolist()
+        == ["USD"] * len(table)
+    )
+    assert list(calculate_orders_per_customer(loaded)[2]) == list(
+        calculate_orders_per_customer(table)[2]
+    )
+    assert calculate_reorder_rate_by_state(loaded).equals(
+        calculate_reorder_rate_by_state(table)
+    )
+
+
+def test_save_order_table_selected_columns(tmp_path):
+    """
+    Test that columns that were not loaded stay missing after saving
+    """
+    store_path = str(tmp_path / "orders")
+    table = OrderTable.from_orders(orders, ("create_timestamp",))
+    save_order_table(store_path, table)
+    loaded = load_order_table(store_path, mmap=False)
+    assert loaded.buyer_user_id is None
+    assert loaded.states is None
+    assert loaded.currencies is None
+    assert loaded.create_timestamp.tolist() == table.create_timestamp.tolist()
+
+
+def test_local_seconds():
+    """
+    Test that local times and months match datetime.fromtimestamp
+    """
+    timestamps = read_order_table(ORDERS_PATH).create_timestamp
+    epoch = datetime(1970, 1, 1)
+    times = [datetime.fromtimestamp(second) for second in timestamps.tolist()]
+    assert local_seconds(timestamps).tolist() == [
+        int((time - epoch).total_seconds()) for time in times
+    ]
+    assert (local_months(timestamps) % 12 + 1).tolist() == [
+        time.month for time in times
+    ]
+
+
+@pytest.mark.parametrize(
+    "time_zone", ["America/New_York", "Australia/Lord_Howe", "UTC"]
+)
+def test_local_seconds_across_offset_changes(monkeypatch, time_zone):
+    """
+    Test that times around daylight saving changes match
+    datetime.fromtimestamp, and that memory doesn't grow with the span of
+    days
+
+    Args:
+        time_zone: String with the name of the time zone to convert to
+    """
+    monkeypatch.setenv("TZ", time_zone)
+    time.tzset()
+    try:
+        rng = np.random.default_rng(0)
+        timestamps = np.sort(
+            rng.integers(1_600_000_000, 1_720_000_000, size=20000)
+        )
+        epoch = datetime(1970, 1, 1)
+        assert local_seconds(timestamps).tolist() == [
+            int((datetime.fromtimestamp(second) - epoch).total_seconds())
+            for second in timestamps.tolist()
+        ]
+
+        tracemalloc.start()
+        try:
+            local_seconds(np.array([0, 10 * 365 * SECONDS_PER_DAY]))
+            _, peak_bytes = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        assert peak_bytes < 2_000_000
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+
+
+@pytest.mark.parametrize("shuffle", [False, True])
+def test_window(shuffle):
+    """
+    Test that a time window holds the same orders as filtering by timestamp,
+    whether or not the orders are sorted by time
+
+    Args:
+        shuffle: Bool, whether to shuffle the orders first
+    """
+    table = read_order_table(ORDERS_PATH)
+    if shuffle:
+        table = table.take(np.random.default_rng(0).permutation(len(table)))
+    timestamps = table.create_timestamp
+    start, end = np.quantile(timestamps, [0.25, 0.75]).astype(np.int64)
+    window = table.window(start, end)
+    in_window = (timestamps >= start) & (timestamps < end)
+    assert window.create_timestamp.tolist() == timestamps[in_window].tolist()
+    assert window.buyer_user_id.tolist() == (
+        table.buyer_user_id[in_window].tolist()
+    )
+    assert len(table.window()) == len(table)
+    assert len(table.window(end, start)) == 0
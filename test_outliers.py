@@ -0,0 +1,138 @@
+"""
+Test functions in outliers file.
+"""
+
+import numpy as np
+import pytest
+from analyze_data import analyze_all, calculate_orders_per_customer
+from api_lib import read_json
+from order_table import OrderTable
+from outliers import OutlierFilter, quantiles
+
+ORDERS_PATH = "orders.json"
+
+
+def make_orders(order_counts, amount=1000):
+    """
+    Makes orders for buyers numbered from 1 with the given number of orders
+
+    Args:
+        order_counts: List with the number of orders of each buyer
+        amount: Int with the subtotal amount of every order
+
+    Returns:
+        List of order dicts
+    """
+    return [
+        {
+            "buyer_user_id": buyer,
+            "state": "VA",
+            "subtotal": {"amount": amount, "divisor": 100},
+            "create_timestamp": 1700000000 + buyer * 1000 + index,
+        }
+        for buyer, count in enumerate(order_counts, start=1)
+        for index in range(count)
+    ]
+
+
+@pytest.mark.parametrize("size", [1, 2, 7, 1000])
+def test_quantiles(size):
+    """
+    Test that partitioned quantiles match np.quantile
+
+    Args:
+        size: Int with how many values to take quantiles of
+    """
+    values = np.random.default_rng(size).integers(0, 50, size=size)
+    probabilities = [0, 0.25, 0.5, 0.75, 1]
+    assert quantiles(values, probabilities).tolist() == pytest.approx(
+        np.quantile(values, probabilities).tolist()
+    )
+
+
+def test_top_k_breaks_ties_by_first_order():
+    """
+    Test that top_k leaves out the buyers with the most orders
+    """
+    orders = make_orders([1, 5, 2, 9, 5, 1])
+    assert OutlierFilter(top_k=1).find(orders).tolist() == [4]
+    assert OutlierFilter(top_k=2).find(orders).tolist() == [2, 4]
+    assert OutlierFilter(top_k=100).find(orders).tolist() == [1, 2, 3, 4, 5, 6]
+
+
+def test_thresholds():
+    """
+    Test that order count and spend thresholds only flag the extreme buyers
+    """
+    order_counts = [1] * 200 + [2] * 30 + [3] * 10 + [4] * 3 + [40]
+    orders = make_orders(order_counts)
+    heavy_buyer = len(order_counts)
+    assert OutlierFilter(order_count_mad=5).find(orders).tolist() == [
+        heavy_buyer
+    ]
+    assert OutlierFilter(order_count_iqr=3).find(orders).tolist() == [
+        heavy_buyer
+    ]
+
+    spend_orders = make_orders([1] * 200 + [1])
+    amounts = np.random.default_rng(0).integers(500, 5000, size=200)
+    for order, amount in zip(spend_orders, amounts.tolist() + [10**7]):
+        order["subtotal"]["amount"] = amount
+    for rule in ({"spend_mad": 5}, {"spend_iqr": 3}):
+        assert OutlierFilter(**rule).find(spend_orders).tolist() == [201]
+
+
+def test_spend_rules_by_currency():
+    """
+    Test that spend rules don't add up subtotals of different currencies
+    """
+    orders = make_orders([1] * 200 + [1])
+    amounts = np.random.default_rng(0).integers(500, 5000, size=200)
+    for order, amount in zip(orders, amounts.tolist() + [10**7]):
+        order["subtotal"]["amount"] = amount
+        order["subtotal"]["currency_code"] = "USD"
+    orders[-1]["subtotal"]["currency_code"] = "JPY"
+
+    with pytest.raises(ValueError, match="more than one currency"):
+        OutlierFilter(spend_iqr=3).find(orders)
+    assert OutlierFilter(spend_iqr=3, currency="USD").find(orders).size == 0
+    assert OutlierFilter(top_k=1).find(orders).tolist() == [1]
+
+
+def test_every_metric_leaves_out_outliers():
+    """
+    Test that passing outliers gives the results of the orders without them
+    """
+    all_orders = read_json(ORDERS_PATH)
+    table = OrderTable.from_orders(all_orders)
+    outlier_filter = OutlierFilter(
+        top_k=3, exclude_ids=[all_orders[0]["buyer_user_id"]]
+    )
+    excluded = outlier_filter.find(table)
+    assert len(excluded) == 4
+    kept = [
+        order for order in all_orders if order["buyer_user_id"] not in excluded
+    ]
+
+    expected = analyze_all(kept, frames=False)
+    for outliers in (outlier_filter, excluded):
+        results = analyze_all(all_orders, frames=False, outliers=outliers)
+        for name in (
+            "buyer_user_id",
+            "single_order_value",
+            "multiple_order_value",
+            "years",
+            "single_by_month",
+            "multiple_by_month",
+        ):
+            assert results[name] == expected[name]
+        for name in ("state_list", "state_reorder_df"):
+            assert sorted(zip(*results[name].values())) == sorted(
+                zip(*expected[name].values())
+            )
+        assert list(results["num_customers"]) == list(expected["num_customers"])
+
+    buyer_user_id, _, _ = calculate_orders_per_customer(
+        table, outliers=excluded
+    )
+    assert buyer_user_id.tolist() == expected["buyer_user_id"]
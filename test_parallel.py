@@ -0,0 +1,95 @@
+"""
+Test functions in parallel file.
+"""
+
+import numpy as np
+import pytest
+from analyze_data import analyze_all
+from api_lib import read_json
+from order_table import OrderTable
+from parallel import analyze_parallel, partition_buyers
+
+ORDERS_PATH = "orders.json"
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_analyze_parallel_matches_analyze_all(workers):
+    """
+    Test that any number of workers gives exactly the results of analyze_all
+
+    Args:
+        workers: Int with the number of processes to use
+    """
+    all_orders = read_json(ORDERS_PATH)
+    expected = analyze_all(all_orders)
+    results = analyze_parallel(all_orders, workers=workers)
+
+    assert results.keys() == expected.keys()
+    for name in (
+        "state_list",
+        "state_reorder_df",
+    ):
+        assert results[name].equals(expected[name])
+    for name in ("num_reorders", "num_customers"):
+        assert list(results[name]) == list(expected[name])
+    for name in (
+        "buyer_user_id",
+        "single_order_value",
+        "multiple_order_value",
+        "years",
+        "orders_by_customer",
+        "single_by_month",
+        "multiple_by_month",
+    ):
+        assert results[name] == expected[name]
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_analyze_parallel_by_currency(workers):
+    """
+    Test that subtotals of different currencies are never averaged together
+
+    Args:
+        workers: Int with the number of processes to use
+    """
+    all_orders = read_json(ORDERS_PATH)
+    for order in all_orders[::3]:
+        order["subtotal"]["currency_code"] = "EUR"
+        order["subtotal"]["divisor"] = 1000
+        order["subtotal"]["amount"] *= 10
+    table = OrderTable.from_orders(all_orders)
+
+    with pytest.raises(ValueError, match="more than one currency"):
+        analyze_parallel(table, workers=workers)
+    for currency in ("EUR", "USD"):
+        results = analyze_parallel(table, workers=workers, currency=currency)
+        expected = analyze_all(table, currency=currency)
+        for name in ("single_order_value", "multiple_order_value"):
+            assert results[name] == expected[name]
+
+
+def test_analyze_parallel_table():
+    """
+    Test that an OrderTable gives the same gaps and order times as
+    analyze_all
+    """
+    table = OrderTable.from_orders(read_json(ORDERS_PATH))
+    expected = analyze_all(table)
+    results = analyze_parallel(table, workers=2)
+    assert results["years"].tolist() == expected["years"].tolist()
+    timeline = results["orders_by_customer"]
+    assert timeline.customers.tolist() == (
+        expected["orders_by_customer"].customers.tolist()
+    )
+    assert timeline.to_dict() == expected["orders_by_customer"].to_dict()
+
+
+def test_partition_buyers():
+    """
+    Test that orders of a buyer share a partition and partitions are
+    balanced
+    """
+    buyer_user_id = np.repeat(np.arange(0, 40000, 4), 2)
+    partition = partition_buyers(buyer_user_id, 4)
+    assert (partition[::2] == partition[1::2]).all()
+    assert np.bincount(partition, minlength=4).min() > 4000
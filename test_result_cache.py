@@ -0,0 +1,104 @@
+"""
+Test functions in result_cache file.
+"""
+
+import os
+import shutil
+from analyze_data import (
+    calculate_orders_per_customer,
+    calculate_reorder_rate_by_state,
+)
+from api_lib import read_json, save_to_json
+from order_table import OrderTable
+from result_cache import ANALYSIS_FUNCTIONS, ResultCache
+
+ORDERS_PATH = "orders.json"
+
+
+def test_analyze_file_reuses_results(tmp_path, monkeypatch):
+    """
+    Test that a second run on an unchanged file doesn't read the orders and
+    gives the same results
+    """
+    orders_path = str(tmp_path / "orders.json")
+    shutil.copy(ORDERS_PATH, orders_path)
+    with ResultCache(str(tmp_path / "cache.db")) as cache:
+        first = cache.analyze_file(orders_path)
+        monkeypatch.setattr("result_cache.read_json", None)
+        second = cache.analyze_file(orders_path)
+
+    assert list(first) == list(ANALYSIS_FUNCTIONS)
+    orders_per_customer = second["calculate_orders_per_customer"]
+    assert orders_per_customer[0] == first["calculate_orders_per_customer"][0]
+    assert list(orders_per_customer[1]) == list(
+        calculate_orders_per_customer(read_json(ORDERS_PATH))[1]
+    )
+    for name in (
+        "calculate_avg_order_size",
+        "calculate_time_between_orders",
+        "find_order_dates",
+    ):
+        assert second[name] == first[name]
+    assert second["calculate_reorder_rate_by_state"].equals(
+        first["calculate_reorder_rate_by_state"]
+    )
+
+
+def test_analyze_file_sees_changes(tmp_path):
+    """
+    Test that changing the file invalidates its results
+    """
+    orders_path = str(tmp_path / "orders.json")
+    orders = read_json(ORDERS_PATH)
+    save_to_json(orders_path, orders)
+    with ResultCache(str(tmp_path / "cache.db")) as cache:
+        first = cache.analyze_file(orders_path)
+        save_to_json(orders_path, orders[:200])
+        stat = os.stat(orders_path)
+        os.utime(orders_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        second = cache.analyze_file(orders_path)
+    assert len(first["calculate_orders_per_customer"][0]) == len(orders)
+    assert len(second["calculate_orders_per_customer"][0]) == 200
+
+
+def test_call_hashes_content(tmp_path):
+    """
+    Test that call reuses results for equal arguments, including tables
+    """
+    calls = []
+
+    def count_orders(orders):
+        calls.append(len(orders))
+        return len(orders)
+
+    orders = read_json(ORDERS_PATH)
+    with ResultCache(str(tmp_path / "cache.db")) as cache:
+        assert cache.call(count_orders, orders) == len(orders)
+        assert cache.call(count_orders, list(orders)) == len(orders)
+        assert cache.call(count_orders, orders[:10]) == 10
+        table = OrderTable.from_orders(orders)
+        expected = calculate_reorder_rate_by_state(table)
+        assert cache.call(calculate_reorder_rate_by_state, table).equals(
+            expected
+        )
+        assert cache.call(
+            calculate_reorder_rate_by_state, OrderTable.from_orders(orders)
+        ).equals(expected)
+    assert calls == [len(orders), 10]
+
+
+def test_evicts_least_recently_used(tmp_path):
+    """
+    Test that the oldest results are removed once the cache is full
+    """
+    with ResultCache(str(tmp_path / "cache.db"), max_bytes=3000) as cache:
+        cache.put("a", b"x" * 1000)
+        cache.put("b", b"x" * 1000)
+        cache.get("a")
+        cache.put("c", b"x" * 1000)
+        assert "a" in cache
+        assert "b" not in cache
+        assert "c" in cache
+        assert cache.total_bytes <= 3000
+        cache.put("huge", b"x" * 5000)
+        assert "huge" not in cache
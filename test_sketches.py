@@ -0,0 +1,163 @@
+"""
+Test functions in sketches file.
+"""
+
+import numpy as np
+import pytest
+from analyze_data import analyze_all
+from benchmark import generate_order_table
+from order_table import read_order_table
+from sketches import (
+    BottomKSample,
+    CountMinSketch,
+    HyperLogLog,
+    SketchAggregates,
+    analyze_approximate,
+)
+
+ORDERS_PATH = "orders.json"
+
+
+def test_hyperloglog():
+    """
+    Test that estimates are within the documented error and that merging
+    shards gives the sketch of all values
+    """
+    values = np.random.default_rng(0).integers(0, 2**40, size=200000)
+    sketch = HyperLogLog()
+    sketch.add(values)
+    num_distinct = len(np.unique(values))
+    assert sketch.estimate() == pytest.approx(
+        num_distinct, rel=4 * sketch.relative_error
+    )
+
+    shards = [HyperLogLog(), HyperLogLog()]
+    shards[0].add(values[:50000])
+    shards[1].add(values[30000:])
+    merged = shards[0].merge(shards[1])
+    assert np.array_equal(merged.registers, sketch.registers)
+
+    with pytest.raises(ValueError):
+        sketch.merge(HyperLogLog(precision=12))
+
+
+def test_count_min_sketch():
+    """
+    Test that counts are never underestimated and merge by adding
+    """
+    values = np.random.default_rng(1).integers(0, 5000, size=50000)
+    sketch = CountMinSketch(width=1024)
+    sketch.add(values[:20000])
+    other = CountMinSketch(width=1024)
+    other.add(values[20000:])
+    merged = sketch.merge(other)
+
+    distinct, counts = np.unique(values, return_counts=True)
+    estimates = merged.query(distinct)
+    assert (estimates >= counts).all()
+    assert np.mean(estimates - counts <= merged.epsilon * merged.total) >= (
+        1 - merged.delta
+    )
+    assert merged.total == len(values)
+
+
+def test_bottom_k_sample_counts_are_exact():
+    """
+    Test that merged samples keep the exact counts of the sampled values
+    """
+    values = np.random.default_rng(2).integers(0, 100000, size=300000)
+    sample = BottomKSample(size=500)
+    for part in np.array_split(values, 7):
+        shard = BottomKSample(size=500)
+        shard.add(part)
+        sample = sample.merge(shard)
+
+    whole = BottomKSample(size=500)
+    whole.add(values)
+    assert sample.saturated
+    assert np.array_equal(sample.values, whole.values)
+    distinct, counts = np.unique(values, return_counts=True)
+    assert np.array_equal(
+        sample.counts, counts[np.searchsorted(distinct, sample.values)]
+    )
+
+
+def test_analyze_approximate_small_shop_is_exact():
+    """
+    Test that a shop with fewer customers than the sample size gets exact
+    counts in any chunk size
+    """
+    table = read_order_table(ORDERS_PATH)
+    expected = analyze_all(table)
+    timeline = expected["orders_by_customer"]
+    results = analyze_approximate(table, chunk_size=97)
+
+    assert results["num_orders"] == len(table)
+    assert results["num_buyers"] == len(timeline)
+    assert results["repeat_rate"] == pytest.approx(
+        np.mean(timeline.num_orders > 1) * 100
+    )
+    num_orders, num_customers = np.unique(
+        timeline.num_orders, return_counts=True
+    )
+    assert results["num_reorders"] == num_orders.tolist()
+    assert results["num_customers"] == num_customers.tolist()
+
+    state_reorder_df = expected["state_reorder_df"]
+    approximate = results["state_reorder_df"].set_index("state")
+    reorder_rate = approximate.loc[state_reorder_df["state"], "reorder_rate"]
+    assert reorder_rate.tolist() == pytest.approx(
+        state_reorder_df["reorder_rate"].tolist()
+    )
+
+
+def test_sketch_aggregates_merge_order_does_not_matter():
+    """
+    Test that sketches of shards merged in either order give the same
+    estimates
+    """
+    table = read_order_table(ORDERS_PATH)
+    half = len(table) // 2
+    first = SketchAggregates.from_table(table.rows(0, half), sample_size=64)
+    second = SketchAggregates.from_table(
+        table.rows(half, len(table)), sample_size=64
+    )
+    forward = first.merge(second).results()
+    backward = second.merge(first).results()
+    assert forward["num_buyers"] == backward["num_buyers"]
+    assert forward["repeat_rate"] == backward["repeat_rate"]
+    assert forward["monthly_customers"].equals(backward["monthly_customers"])
+
+
+def test_repeat_rate_within_documented_error():
+    """
+    Test that the estimated repeat rate of a shop with many more customers
+    than the sample is within three standard errors of the exact rate
+    """
+    table = generate_order_table(300000, seed=2)
+    _, counts = np.unique(table.buyer_user_id, return_counts=True)
+    exact = np.mean(counts > 1) * 100
+
+    aggregates = SketchAggregates.from_table(table)
+    results = aggregates.results()
+    assert aggregates.buyer_sample.saturated
+    assert aggregates.repeat_rate_error == pytest.approx(0.390625)
+    assert abs(results["repeat_rate"] - exact) <= (
+        3 * aggregates.repeat_rate_error
+    )
+
+
+def test_buyer_order_counts():
+    """
+    Test that sampled buyers get exact order counts and other buyers are
+    never underestimated
+    """
+    table = generate_order_table(50000, seed=3)
+    buyers, counts = np.unique(table.buyer_user_id, return_counts=True)
+    aggregates = SketchAggregates.from_table(table, sample_size=256)
+
+    estimates = aggregates.buyer_order_counts(buyers)
+    sampled = np.isin(buyers, aggregates.buyer_sample.values)
+    assert sampled.sum() == 256
+    assert np.array_equal(estimates[sampled], counts[sampled])
+    assert (estimates >= counts).all()
@@ -0,0 +1,144 @@
+"""
+Test functions in state_index file.
+"""
+
+import time
+import numpy as np
+import pytest
+from analyze_data import calculate_reorder_rate_by_state, count_orders_by_state
+from order_table import read_order_table
+from state_index import StateIndex
+
+ORDERS_PATH = "orders.json"
+
+
+def test_matches_analyze_data(tmp_path):
+    """
+    Test that the index gives the state results of analyze_data
+    """
+    table = read_order_table(ORDERS_PATH)
+    with StateIndex(tmp_path / "states.db") as index:
+        index.add(table)
+        reorder_rate = index.reorder_rate_by_state()
+        orders_by_state = index.orders_by_state()
+
+    expected = calculate_reorder_rate_by_state(table)
+    assert reorder_rate["state"].tolist() == expected["state"].tolist()
+    assert reorder_rate["reorder_rate"].tolist() == pytest.approx(
+        expected["reorder_rate"].tolist()
+    )
+    expected = count_orders_by_state(table)
+    assert orders_by_state["state"].tolist() == expected["state"].tolist()
+    assert (
+        orders_by_state["number_of_orders"].tolist()
+        == expected["number_of_orders"].tolist()
+    )
+
+
+def test_incremental_adds_persist(tmp_path):
+    """
+    Test that adding orders in batches across reopening gives the tallies of
+    adding them at once
+    """
+    table = read_order_table(ORDERS_PATH)
+    # Add the oldest orders first, like sync_orders returns them over time.
+    oldest_first = table.take(np.arange(len(table))[::-1])
+    with StateIndex(tmp_path / "whole.db") as index:
+        index.add(oldest_first)
+        expected = index.query()
+
+    path = tmp_path / "batches.db"
+    bounds = [0, 1, 500, 1700, len(table)]
+    for start, stop in zip(bounds, bounds[1:]):
+        with StateIndex(path) as index:
+            index.query()
+            index.add(oldest_first.rows(start, stop))
+    with StateIndex(path) as index:
+        results = index.query()
+        assert len(index) == len(expected["state"])
+
+    for name in expected:
+        assert results[name].tolist() == pytest.approx(
+            expected[name].tolist(), nan_ok=True
+        )
+    assert results["revenue"].sum() == pytest.approx(
+        (table.amount / table.divisor).sum()
+    )
+
+
+def test_month_range(tmp_path):
+    """
+    Test that a range of months gives the results of the orders created in it
+    """
+    table = read_order_table(ORDERS_PATH)
+    start = int(time.mktime((2021, 7, 1, 0, 0, 0, 0, 0, -1)))
+    end = int(time.mktime((2022, 3, 1, 0, 0, 0, 0, 0, -1)))
+    months = {"start_month": "2021-07", "end_month": "2022-03"}
+    with StateIndex(tmp_path / "states.db") as index:
+        index.add(table)
+        orders_by_state = index.orders_by_state(**months)
+        reorder_rate = index.reorder_rate_by_state(**months)
+
+    expected = count_orders_by_state(table, start=start, end=end)
+    assert sorted(zip(*orders_by_state.values())) == sorted(
+        zip(expected["state"], expected["number_of_orders"])
+    )
+    expected = calculate_reorder_rate_by_state(table, start=start, end=end)
+    assert sorted(reorder_rate["state"]) == sorted(expected["state"])
+    assert dict(zip(*reorder_rate.values())) == pytest.approx(
+        dict(zip(expected["state"], expected["reorder_rate"]))
+    )
+
+
+def test_older_orders_are_rejected(tmp_path):
+    """
+    Test that orders in an earlier month than a customer's orders already
+    added to a state are rejected without changing the tallies
+    """
+    table = read_order_table(ORDERS_PATH)
+    with StateIndex(tmp_path / "states.db") as index:
+        index.add(table.rows(0, 1000))
+        expected = index.query()
+        with pytest.raises(ValueError, match="earlier month"):
+            index.add(table.rows(1000, len(table)))
+        results = index.query()
+
+    for name in expected:
+        assert results[name].tolist() == pytest.approx(
+            expected[name].tolist(), nan_ok=True
+        )
+
+
+def test_revenue_by_currency(tmp_path):
+    """
+    Test that revenue is totalled exactly for each currency
+    """
+    orders = [
+        {
+            "buyer_user_id": buyer,
+            "state": "CO",
+            "subtotal": {
+                "amount": amount,
+                "divisor": divisor,
+                "currency_code": currency,
+            },
+            "create_timestamp": 1700000000 + buyer,
+        }
+        for buyer, amount, divisor, currency in (
+            (1, 10, 100, "USD"),
+            (2, 20, 1000, "USD"),
+            (3, 500, 1, "JPY"),
+        )
+    ]
+    with StateIndex(tmp_path / "states.db") as index:
+        index.add(orders)
+        with pytest.raises(ValueError, match="more than one currency"):
+            index.query()
+        usd = index.query(currency="USD")
+        jpy = index.query(currency="JPY")
+
+    assert usd["amount"].tolist() == [120]
+    assert usd["divisor"].tolist() == [1000]
+    assert usd["revenue"].tolist() == [0.12]
+    assert jpy["revenue"].tolist() == [500.0]
+    assert usd["number_of_orders"].tolist() == [3]